@@ -0,0 +1,112 @@
+"""Batch APIのジョブの往復試験
+
+スタブサーバー(bench/stub_openai.py)に対して BatchRunner でジョブを送信し、
+途中でストアとランナーを作り直して(再起動を模して)から結果を回収する.
+全ジョブの結果が1回ずつ返ることを確認し、かかった時間を出力する
+
+usage:
+    python bench/batch_roundtrip.py [--jobs 50] [--max-jobs 20] [--batch-delay 2] [--error-rate 0.05]
+"""
+
+import argparse
+import asyncio
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import openai
+from aiohttp import web
+
+import stub_openai
+
+BOT_DIR = Path(__file__).resolve().parent.parent / "bot"
+sys.path.insert(0, str(BOT_DIR))
+
+from utils.batch import BatchRunner  # noqa: E402
+from utils.store import create_store  # noqa: E402
+
+
+async def start_stub(args: argparse.Namespace) -> tuple[web.AppRunner, str]:
+    """スタブサーバーを同じイベントループで起動する"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    runner = web.AppRunner(stub_openai.StubServer(stub_openai.options_from_args(args)).app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+async def run(args: argparse.Namespace) -> int:
+    stub, base_url = await start_stub(args)
+    client = openai.AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=2)
+    workdir = Path(tempfile.mkdtemp(prefix="batch_roundtrip_"))
+    start = time.perf_counter()
+    try:
+        store = create_store(args.store, workdir / "bot.db", 1.0, 100)
+        await store.open()
+        runner = BatchRunner(client, store, args.max_jobs)
+        await runner.open()
+        expected = set()
+        for index in range(args.jobs):
+            body = {"model": "gpt-4.1-mini", "messages": [{"role": "user", "content": f"job {index}"}], "max_tokens": 64}
+            expected.add(runner.submit(1, 10 + index % 3, 100 + index % 5, body).job_id)
+        batch_ids = await runner.flush()
+        print(f"submitted {args.jobs} jobs in {len(batch_ids)} batches ({time.perf_counter() - start:.2f}s)")
+
+        # 再起動を模す. sqliteなら送信済みのバッチを引き継げる
+        if args.restart:
+            await store.close()
+            store = create_store(args.store, workdir / "bot.db", 1.0, 100)
+            await store.open()
+            runner = BatchRunner(client, store, args.max_jobs)
+            await runner.open()
+            print(f"restarted: {len(runner.in_flight())} batches in flight")
+
+        received = []
+        deadline = time.monotonic() + args.timeout
+        while len(runner.in_flight()) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(args.poll_interval)
+            results = await runner.poll()
+            runner.complete(results)
+            received.extend(results)
+        await store.close()
+    finally:
+        await client.close()
+        await stub.cleanup()
+
+    job_ids = [result.job.job_id for result in received]
+    errors = sum(1 for result in received if result.error is not None)
+    tokens = sum(result.prompt_tokens + result.completion_tokens for result in received)
+    print(f"received {len(received)} results ({errors} errors, {tokens} tokens) in {time.perf_counter() - start:.2f}s")
+
+    missing = expected - set(job_ids)
+    duplicated = len(job_ids) - len(set(job_ids))
+    if len(missing) > 0 or duplicated > 0:
+        print(f"NG: missing={len(missing)} duplicated={duplicated}")
+        return 1
+    print("OK")
+    return 0
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--jobs", type=int, default=50, help="送るジョブ数")
+    arg_parser.add_argument("--max-jobs", type=int, default=20, help="1つのバッチにまとめるジョブの最大数")
+    arg_parser.add_argument("--store", choices=["sqlite", "memory"], default="sqlite")
+    arg_parser.add_argument("--no-restart", dest="restart", action="store_false", help="送信後にストアを作り直さない")
+    arg_parser.add_argument("--poll-interval", type=float, default=0.5, help="結果を確認する間隔(秒)")
+    arg_parser.add_argument("--timeout", type=float, default=60, help="結果を待つ時間の上限(秒)")
+    stub_openai.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    if args.store == "memory":
+        # メモリのストアは再起動で消えるため引き継げない
+        args.restart = False
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
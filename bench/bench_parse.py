@@ -0,0 +1,70 @@
+"""メンション1件あたりの解析コストを旧実装と比較するマイクロベンチマーク
+
+usage:
+    python bench/bench_parse.py [--number 2000]
+"""
+
+import argparse
+import re
+import sys
+import timeit
+from pathlib import Path
+from types import SimpleNamespace
+
+import urlextract
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils import parser  # noqa: E402
+
+MESSAGES = [
+    SimpleNamespace(content="<@1234567890> こんにちは、今日の天気どう？", attachments=[]),
+    SimpleNamespace(content="<@1234567890> この画像なに？ https://example.com/images/cat.png", attachments=[]),
+    SimpleNamespace(
+        content="<@1234567890> これ見て",
+        attachments=[SimpleNamespace(url="https://cdn.discordapp.com/attachments/1/2/photo.jpg?ex=1&is=2&hm=3", content_type="image/jpeg", filename="photo.jpg")],
+    ),
+    SimpleNamespace(content="<@1234567890> " + "長文の質問です。" * 100, attachments=[]),
+]
+
+
+def legacy_parse(message) -> tuple[str, list]:
+    """変更前の parse_message と同じ処理"""
+    attachments_list = []
+    plane_message = re.sub(r"<@\d+>", "", message.content).strip()
+    extention = re.compile(r".png|.jpg|.jpeg|.gif")
+    for attach in message.attachments:
+        if extention.search(attach.url) is not None:
+            attachments_list.append(attach.url)
+    extractor = urlextract.URLExtract()
+    for url in extractor.find_urls(plane_message):
+        if extention.search(url) is not None:
+            attachments_list.append(url)
+            plane_message = plane_message.replace(url, "")
+    return plane_message, attachments_list
+
+
+def current_parse(message) -> tuple[str, list]:
+    plane_message = parser.strip_mentions(message.content)
+    attachments_list = parser.attachment_urls(message.attachments)
+    plane_message, urls = parser.extract_image_urls(plane_message)
+    return plane_message, attachments_list + urls
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--number", type=int, default=2000)
+    args = arg_parser.parse_args()
+
+    # 旧実装は1回ごとにTLDリストを読み込むため回数を減らす
+    legacy_number = max(1, args.number // 20)
+
+    for name, func, number in (("legacy", legacy_parse, legacy_number), ("current", current_parse, args.number)):
+        func(MESSAGES[0])
+        elapsed = timeit.timeit(lambda: [func(message) for message in MESSAGES], number=number)
+        per_message = elapsed / (number * len(MESSAGES)) * 1e6
+        print(f"{name:8s} {per_message:10.1f} us/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+"""BotCogの負荷試験
+
+Discordのメッセージを模したオブジェクトを多数のサーバー・チャンネルから on_message と /search に流し込み、
+OpenAI APIの代わりにスタブサーバー(bench/stub_openai.py)へリクエストを送る.
+スループット、応答時間のパーセンタイル、処理段階ごとの時間、イベントループの遅延、メモリの増加量を出力する
+
+トークンやAPIキーは不要. トークン数の計算にtiktokenの辞書(o200k_base)を使うため、初回は取得が必要
+
+usage:
+    python bench/loadtest.py [--messages 500] [--guilds 20] [--channels 3] [--rate 50] [--latency 0.3] [--error-rate 0.01]
+    python bench/loadtest.py --json result.json --max-loop-lag-ms 50
+    python bench/loadtest.py --guilds 2 --channels 1 --messages 200 --system-prompt-tokens 1500 --compare-layouts
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Dict, List
+
+import stub_openai
+
+BOT_DIR = Path(__file__).resolve().parent.parent / "bot"
+sys.path.insert(0, str(BOT_DIR))
+
+from cogs.gpt import AppConfig, BotCog, storeconfig  # noqa: E402
+from utils.stream import PLACEHOLDER  # noqa: E402
+
+BOT_ID = 1000
+ERROR_PREFIX = "なんかエラー出た"
+QUESTIONS = [
+    "こんにちは、今日の天気どう？",
+    "おすすめの晩ごはん教えて",
+    "Pythonのasyncioってなに？",
+    "この前の話の続きやけど、どう思う？",
+    "長文の質問です。" * 60,
+]
+# --system-prompt-tokens でシステムプロンプトを伸ばす文
+SYSTEM_PROMPT_FILLER = "Keep the tone friendly, answer in the language of the question and keep the reply short. "
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """パーセンタイル(ミリ秒)"""
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": max(values, default=0.0) * 1000,
+    }
+
+
+@dataclass
+class Probe:
+    """1件のリクエストで送信されたメッセージを記録する"""
+
+    started: float
+    first_token: float | None = None
+    error: bool = False
+
+    def observe(self, content: str | None) -> None:
+        if content is None:
+            return
+        if content.startswith(ERROR_PREFIX):
+            self.error = True
+        elif self.first_token is None and content != PLACEHOLDER:
+            self.first_token = time.perf_counter()
+
+
+class FakeMessage:
+    def __init__(self, probe: Probe, content: str | None) -> None:
+        self.__probe = probe
+        self.content = content
+
+    async def edit(self, content: str | None = None, **kwargs) -> "FakeMessage":
+        self.content = content
+        self.__probe.observe(content)
+        return self
+
+
+class FakeChannel:
+    """リクエストごとに作るチャンネル. IDは同じチャンネルで共通"""
+
+    def __init__(self, channel_id: int, probe: Probe) -> None:
+        self.id = channel_id
+        self.__probe = probe
+
+    async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+        self.__probe.observe(content)
+        return FakeMessage(self.__probe, content)
+
+
+class FakeContext:
+    """hybrid commandのContextの代わり"""
+
+    def __init__(self, guild_id: int, channel: FakeChannel, author) -> None:
+        self.guild = SimpleNamespace(id=guild_id)
+        self.channel = channel
+        self.author = author
+        self.send = channel.send
+
+    async def defer(self) -> None:
+        pass
+
+
+@dataclass
+class Results:
+    messages: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    latency: List[float] = field(default_factory=list)
+    first_token: List[float] = field(default_factory=list)
+    loop_lag: List[float] = field(default_factory=list)
+    stages: Dict[str, List[float]] = field(default_factory=dict)
+
+
+def instrument(cog: BotCog, results: Results) -> None:
+    """処理段階ごとの時間を計測するようにメソッドを差し替える"""
+
+    def timed(stage: str, func: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        samples = results.stages.setdefault(stage, [])
+
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        return wrapper
+
+    for stage, name in (
+        ("parse", "parse_message"),
+        ("history.load", "get_history"),
+        ("history.trim", "delete_old_history"),
+        ("send", "send_question_gpt"),
+        ("api.chat", "request_chat"),
+        ("api.search", "request_search"),
+    ):
+        setattr(cog, name, timed(stage, getattr(cog, name)))
+
+
+async def sample_loop_lag(results: Results, interval: float, stop: asyncio.Event) -> None:
+    """sleepの遅れをイベントループの遅延として記録する"""
+    while stop.is_set() is False:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        results.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+
+def make_event(args: argparse.Namespace, index: int, base_url: str) -> dict:
+    guild_id = 1 + random.randrange(args.guilds)
+    channel_id = guild_id * 100 + random.randrange(args.channels)
+    roll = random.random()
+    if roll < args.search_ratio:
+        kind = "search"
+    elif roll < args.search_ratio + args.image_ratio:
+        kind = "image"
+    else:
+        kind = "mention"
+    return {
+        "kind": kind,
+        "guild_id": guild_id,
+        "channel_id": channel_id,
+        "user_id": guild_id * 1000 + random.randrange(args.users),
+        "text": random.choice(QUESTIONS),
+        "image": f"{base_url}/images/{index % args.distinct_images}.png",
+    }
+
+
+async def dispatch(cog: BotCog, event: dict, results: Results) -> None:
+    probe = Probe(time.perf_counter())
+    channel = FakeChannel(event["channel_id"], probe)
+    author = SimpleNamespace(id=event["user_id"], global_name=f"user{event['user_id']}")
+
+    if event["kind"] == "search":
+        ctx = FakeContext(event["guild_id"], channel, author)
+        await cog.web_search_question.callback(cog, ctx, event["text"])
+    else:
+        attachments = []
+        if event["kind"] == "image":
+            attachments.append(SimpleNamespace(url=event["image"], content_type="image/png", filename="image.png"))
+        message = SimpleNamespace(
+            author=author,
+            content=f"<@{BOT_ID}> {event['text']}",
+            mentions=[SimpleNamespace(id=BOT_ID)],
+            reference=None,
+            attachments=attachments,
+            guild=SimpleNamespace(id=event["guild_id"]),
+            channel=channel,
+        )
+        await cog.on_message(message)
+
+    results.messages += 1
+    results.latency.append(time.perf_counter() - probe.started)
+    if probe.first_token is not None:
+        results.first_token.append(probe.first_token - probe.started)
+    if probe.error:
+        results.errors += 1
+
+
+async def drive(cog: BotCog, events: List[dict], args: argparse.Namespace, results: Results) -> None:
+    if args.rate > 0:
+        # 一定間隔で到着させる(応答を待たない)
+        tasks = []
+        start = time.perf_counter()
+        for index, event in enumerate(events):
+            delay = start + index / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(dispatch(cog, event, results)))
+        await asyncio.gather(*tasks)
+    else:
+        # 同時実行数を固定して流し込む
+        queue = list(reversed(events))
+
+        async def worker() -> None:
+            while len(queue) > 0:
+                await dispatch(cog, queue.pop(), results)
+
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+
+async def start_stub(args: argparse.Namespace) -> tuple[asyncio.subprocess.Process, str]:
+    """スタブサーバーを別プロセスで起動する. 同じイベントループで動かすと計測に影響するため"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        str(Path(stub_openai.__file__).resolve()),
+        "--port",
+        str(port),
+        "--latency",
+        str(args.latency),
+        "--jitter",
+        str(args.jitter),
+        "--token-delay",
+        str(args.token_delay),
+        "--tokens",
+        str(args.tokens),
+        "--error-rate",
+        str(args.error_rate),
+        "--rate-limit-rate",
+        str(args.rate_limit_rate),
+        "--retry-after-ms",
+        str(args.retry_after_ms),
+        "--hang-rate",
+        str(args.hang_rate),
+        stdout=asyncio.subprocess.PIPE,
+    )
+    line = await asyncio.wait_for(process.stdout.readline(), timeout=30)
+    if b"listening" not in line:
+        process.kill()
+        raise RuntimeError("stub server failed to start")
+    return process, f"http://127.0.0.1:{port}"
+
+
+def pad_system_prompt(prompt: str, tokens: int) -> str:
+    """スタブの見積もり(4文字で1トークン)でtokens以上になるまでシステムプロンプトを伸ばす
+
+    プロンプトキャッシュは先頭の1024トークン以上が一致しないと効かないため、短いプロンプトではどちらの削除方法でも0%になる
+    """
+    shortage = tokens * stub_openai.CHARS_PER_TOKEN - len(prompt)
+    if shortage <= 0:
+        return prompt
+    return prompt + "\n" + SYSTEM_PROMPT_FILLER * (shortage // len(SYSTEM_PROMPT_FILLER) + 1)
+
+
+def build_config(args: argparse.Namespace, workdir: Path) -> AppConfig:
+    config = AppConfig.load(BOT_DIR / "setting.yaml")
+    system_prompt = pad_system_prompt(config.bot.default_system_promt, args.system_prompt_tokens)
+    # 本番のデータを汚さないように一時ディレクトリを使う(絶対パスはそのまま使われる)
+    return replace(
+        config,
+        store=storeconfig(backend=args.store, path=str(workdir / "bot.db")),
+        # スタブの画像は127.0.0.1から取得する
+        image=replace(config.image, cache_dir=str(workdir / "image_cache"), fetch_hosts=("127.0.0.1",), allow_private_addresses=True),
+        bot=replace(
+            config.bot, stream_response=args.no_stream is False, prompt_layout=args.prompt_layout, default_system_promt=system_prompt
+        ),
+        cache=replace(config.cache, enabled=args.cache),
+        metrics=replace(config.metrics, enabled=False),
+    )
+
+
+def cached_ratio(stub_stats: dict) -> float:
+    """プロンプトのトークンのうちプロンプトキャッシュから読んだ割合"""
+    if stub_stats.get("prompt_tokens", 0) == 0:
+        return 0.0
+    return stub_stats["cached_tokens"] / stub_stats["prompt_tokens"]
+
+
+def report(results: Results, memory: Dict[str, float], stub_stats: dict) -> dict:
+    summary = {
+        "messages": results.messages,
+        "errors": results.errors,
+        "elapsed_s": results.elapsed,
+        "throughput_per_s": results.messages / results.elapsed if results.elapsed > 0 else 0.0,
+        "latency": summarize(results.latency),
+        "first_token": summarize(results.first_token),
+        "loop_lag": summarize(results.loop_lag),
+        "stages": {stage: summarize(samples) for stage, samples in results.stages.items() if len(samples) > 0},
+        "memory": memory,
+        "stub": stub_stats,
+    }
+
+    print(f"messages   {summary['messages']} ({summary['errors']} errors) in {summary['elapsed_s']:.2f}s -> {summary['throughput_per_s']:.1f} msg/s")
+    print(f"{'':14s} {'count':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'max ms':>9s}")
+    rows = [("reply", summary["latency"]), ("first token", summary["first_token"]), ("loop lag", summary["loop_lag"])]
+    rows += [(stage, stats) for stage, stats in summary["stages"].items()]
+    for name, stats in rows:
+        print(f"{name:14s} {stats['count']:7d} {stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f} {stats['max_ms']:9.1f}")
+    if "growth_kib" in memory:
+        print(f"memory     growth {memory['growth_kib']:.0f} KiB, traced peak {memory['peak_kib']:.0f} KiB, max RSS {memory['max_rss_kib']:.0f} KiB")
+        for line in memory["top"]:
+            print(f"           {line}")
+    else:
+        print(f"memory     max RSS {memory['max_rss_kib']:.0f} KiB")
+    print(f"stub       {stub_stats}")
+    if stub_stats.get("prompt_tokens", 0) > 0:
+        print(f"cache      {cached_ratio(stub_stats):.1%} of prompt tokens read from the prompt cache")
+    return summary
+
+
+def compare_layouts(args: argparse.Namespace) -> dict:
+    """同じ入力を prompt_layout の stable と sliding で流し、プロンプトキャッシュから読んだ割合を比べる
+
+    スタブは毎回起動し直すため、キャッシュは前の計測から引き継がない
+    """
+    summaries = {}
+    for layout in ("stable", "sliding"):
+        print(f"== prompt_layout: {layout}")
+        summaries[layout] = asyncio.run(run(argparse.Namespace(**{**vars(args), "prompt_layout": layout})))
+        print()
+
+    print(f"{'layout':10s} {'prompt tokens':>14s} {'cached tokens':>14s} {'cached':>8s}")
+    for layout, summary in summaries.items():
+        stub_stats = summary["stub"]
+        print(f"{layout:10s} {stub_stats['prompt_tokens']:14d} {stub_stats['cached_tokens']:14d} {cached_ratio(stub_stats):8.1%}")
+    return summaries
+
+
+async def run(args: argparse.Namespace) -> dict:
+    random.seed(args.seed)
+    process, base_url = await start_stub(args)
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            bot = SimpleNamespace(user=SimpleNamespace(id=BOT_ID), get_user=lambda user_id: None)
+            cog = BotCog(bot, build_config(args, Path(tmp)))
+            logging.getLogger("gpt").setLevel(args.log_level)
+            await cog.cog_load()
+
+            results = Results()
+            instrument(cog, results)
+
+            # 接続やトークナイザの初期化を計測から外す
+            warmup = Results()
+            for index in range(args.warmup):
+                await dispatch(cog, make_event(args, index, base_url), warmup)
+            for samples in results.stages.values():
+                samples.clear()
+
+            if args.trace_memory:
+                tracemalloc.start()
+                baseline = tracemalloc.take_snapshot()
+
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(sample_loop_lag(results, args.lag_interval, stop))
+            events = [make_event(args, index, base_url) for index in range(args.messages)]
+            start = time.perf_counter()
+            await drive(cog, events, args, results)
+            results.elapsed = time.perf_counter() - start
+            stop.set()
+            await sampler
+
+            memory = {"max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+            if args.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                diff = snapshot.compare_to(baseline, "lineno")
+                memory["growth_kib"] = sum(stat.size_diff for stat in diff) / 1024
+                memory["peak_kib"] = peak / 1024
+                memory["top"] = [str(stat) for stat in diff[:5]]
+
+            await cog.cog_unload()
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", int(base_url.rsplit(":", 1)[1]))
+        writer.write(b"GET /stats HTTP/1.0\r\n\r\n")
+        raw = await reader.read()
+        writer.close()
+        stub_stats = json.loads(raw.split(b"\r\n\r\n", 1)[1])
+    finally:
+        process.terminate()
+        await process.wait()
+
+    return report(results, memory, stub_stats)
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--messages", type=int, default=500, help="送るメッセージ数")
+    arg_parser.add_argument("--guilds", type=int, default=20)
+    arg_parser.add_argument("--channels", type=int, default=3, help="サーバーごとのチャンネル数")
+    arg_parser.add_argument("--users", type=int, default=5, help="サーバーごとのユーザー数")
+    arg_parser.add_argument("--rate", type=float, default=50, help="1秒あたりの到着数. 0なら--concurrencyの並列で流し込む")
+    arg_parser.add_argument("--concurrency", type=int, default=50)
+    arg_parser.add_argument("--search-ratio", type=float, default=0.05, help="/searchの割合")
+    arg_parser.add_argument("--image-ratio", type=float, default=0.1, help="画像付きメッセージの割合")
+    arg_parser.add_argument("--distinct-images", type=int, default=20)
+    arg_parser.add_argument("--warmup", type=int, default=5)
+    arg_parser.add_argument("--store", choices=["sqlite", "memory"], default="sqlite")
+    arg_parser.add_argument("--no-stream", action="store_true", help="ストリーミングせずに応答する")
+    arg_parser.add_argument("--cache", action="store_true", help="応答のキャッシュを有効にする")
+    arg_parser.add_argument("--prompt-layout", choices=["stable", "sliding"], default="stable", help="履歴の削除方法. プロンプトキャッシュの効き方を比べる")
+    arg_parser.add_argument("--compare-layouts", action="store_true", help="stableとslidingの両方で流し、プロンプトキャッシュから読んだ割合を比べる")
+    arg_parser.add_argument(
+        "--system-prompt-tokens", type=int, default=0, help="システムプロンプトをこのトークン数まで伸ばす. 1024未満ではプロンプトキャッシュが効かない"
+    )
+    arg_parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false", help="tracemallocを使わない(計測のオーバーヘッドを除く)")
+    arg_parser.add_argument("--lag-interval", type=float, default=0.01, help="イベントループ遅延の計測間隔(秒)")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--log-level", default="WARNING")
+    arg_parser.add_argument("--json", type=Path, help="結果をJSONで保存する")
+    arg_parser.add_argument("--max-loop-lag-ms", type=float, help="イベントループ遅延のp99がこれを超えたら終了コード1")
+    stub_openai.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.compare_layouts:
+        summaries = compare_layouts(args)
+        output = {"layouts": summaries}
+    else:
+        summaries = {args.prompt_layout: asyncio.run(run(args))}
+        output = summaries[args.prompt_layout]
+    if args.json is not None:
+        args.json.write_text(json.dumps({"args": {k: str(v) for k, v in vars(args).items()}, **output}, ensure_ascii=False, indent=2))
+    if args.max_loop_lag_ms is not None:
+        for layout, summary in summaries.items():
+            if summary["loop_lag"]["p99_ms"] > args.max_loop_lag_ms:
+                print(f"loop lag p99 {summary['loop_lag']['p99_ms']:.1f} ms exceeds {args.max_loop_lag_ms} ms ({layout})")
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
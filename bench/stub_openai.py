@@ -0,0 +1,401 @@
+"""負荷試験用のOpenAI APIスタブサーバー
+
+Chat Completions と Responses API(ストリーミング含む)に固定の応答を返す.
+遅延・エラーを注入でき、テスト用の画像も配信する. 先頭が以前のリクエストと一致する分はプロンプトキャッシュから読んだものとして cached_tokens を返す.
+Batch API(ファイルのアップロード・バッチの作成と取得・結果の取得)も --batch-delay 秒後に完了するものとして模擬する
+
+usage:
+    python bench/stub_openai.py [--port 8787] [--latency 0.3] [--token-delay 0.02] [--error-rate 0.01]
+
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 を設定するとクライアントの向き先を変えられる
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from aiohttp import web
+from PIL import Image
+
+WORDS = "せや な 、 それ は ええ 質問 や で 。 ほんま に 知らん けど 大体 そんな 感じ ちゃう か な".split()
+
+
+@dataclass
+class StubOptions:
+    """スタブの応答設定"""
+
+    # 最初のトークンまでの遅延(秒)
+    latency: float = 0.3
+    # 遅延のばらつき(秒). 0からこの値までをランダムに加える
+    jitter: float = 0.2
+    # ストリーミング時のチャンク間隔(秒)
+    token_delay: float = 0.02
+    # 応答のチャンク数
+    tokens: int = 40
+    # 500を返す割合
+    error_rate: float = 0.0
+    # 429を返す割合
+    rate_limit_rate: float = 0.0
+    # 429で返すretry-after-ms
+    retry_after_ms: int = 200
+    # 応答を返さずに止まる割合
+    hang_rate: float = 0.0
+    # バッチが完了するまでの時間(秒)
+    batch_delay: float = 2.0
+
+
+# プロンプトキャッシュの模擬. 最小のトークン数と、キャッシュされる単位
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CACHE_MAX_PREFIXES = 100000
+# トークン数の見積もりに使う1トークンあたりの文字数
+CHARS_PER_TOKEN = 4
+
+
+def _estimate_tokens(payload) -> int:
+    return max(1, len(json.dumps(payload, ensure_ascii=False)) // CHARS_PER_TOKEN)
+
+
+class StubServer:
+    def __init__(self, options: StubOptions) -> None:
+        self.options = options
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        # 過去に送られたメッセージ列の先頭部分のハッシュ. 追加順
+        self.__prefixes: dict[int, None] = {}
+        self.__images: dict[int, bytes] = {}
+        self.__files: dict[str, tuple[dict, bytes]] = {}
+        self.__batches: dict[str, dict] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/responses", self.responses)
+        app.router.add_post("/v1/files", self.upload_file)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.retrieve_batch)
+        app.router.add_get("/images/{index}.png", self.image)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    async def __inject(self) -> web.Response | None:
+        """遅延とエラーを注入する. エラーを返す場合はそのレスポンス"""
+        self.requests += 1
+        options = self.options
+        await asyncio.sleep(options.latency + random.uniform(0, options.jitter))
+
+        roll = random.random()
+        if roll < options.hang_rate:
+            await asyncio.sleep(3600)
+        roll -= options.hang_rate
+        if roll < options.rate_limit_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after-ms": str(options.retry_after_ms)},
+            )
+        roll -= options.rate_limit_rate
+        if roll < options.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "The server had an error (stub)", "type": "server_error", "code": None}}, status=500)
+        return None
+
+    def __cached_tokens(self, model: str, messages: list) -> int:
+        """以前のリクエストと先頭から一致するメッセージ分のトークン数をキャッシュから読んだものとして返す
+
+        一致した分が CACHE_MIN_TOKENS 以上の場合だけ、CACHE_BLOCK_TOKENS 単位に切り捨てて返す
+        """
+        cached = 0
+        tokens = 0
+        hits = True
+        key = hash(model)
+        for message in messages:
+            # 先頭からのメッセージ列のハッシュを1件ずつ積み上げる
+            key = hash((key, json.dumps(message, ensure_ascii=False, sort_keys=True)))
+            tokens += _estimate_tokens(message)
+            if hits and key in self.__prefixes:
+                cached = tokens
+            else:
+                hits = False
+            self.__prefixes.pop(key, None)
+            self.__prefixes[key] = None
+        while len(self.__prefixes) > CACHE_MAX_PREFIXES:
+            del self.__prefixes[next(iter(self.__prefixes))]
+        return cached // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS if cached >= CACHE_MIN_TOKENS else 0
+
+    def __text(self) -> list[str]:
+        return [random.choice(WORDS) for _ in range(self.options.tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        error = await self.__inject()
+        if error is not None:
+            return error
+
+        chunks = self.__text()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        prompt_tokens = _estimate_tokens(body["messages"])
+        cached_tokens = min(prompt_tokens, self.__cached_tokens(body["model"], body["messages"]))
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(chunks),
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if body.get("stream") is not True:
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(chunks)}, "finish_reason": "stop"}],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def chunk(choices: list, usage: dict | None = None) -> bytes:
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body["model"], "choices": choices}
+            if usage is not None:
+                data["usage"] = usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+        await response.write(chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]))
+        for text in chunks:
+            await asyncio.sleep(self.options.token_delay)
+            await response.write(chunk([{"index": 0, "delta": {"content": text}, "finish_reason": None}]))
+        await response.write(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if body.get("stream_options", {}).get("include_usage"):
+            await response.write(chunk([], usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def responses(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        error = await self.__inject()
+        if error is not None:
+            return error
+
+        chunks = self.__text()
+        response_id = f"resp_{uuid.uuid4().hex}"
+        item_id = f"msg_{uuid.uuid4().hex}"
+        input_tokens = _estimate_tokens(body["input"])
+        cached_tokens = min(input_tokens, self.__cached_tokens(body["model"], body["input"]))
+        self.prompt_tokens += input_tokens
+        self.cached_tokens += cached_tokens
+        result = {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body["model"],
+            "status": "completed",
+            "output": [
+                {
+                    "type": "message",
+                    "id": item_id,
+                    "role": "assistant",
+                    "status": "completed",
+                    "content": [{"type": "output_text", "text": "".join(chunks), "annotations": []}],
+                }
+            ],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": body.get("tools", []),
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": len(chunks),
+                "total_tokens": input_tokens + len(chunks),
+                "input_tokens_details": {"cached_tokens": cached_tokens},
+                "output_tokens_details": {"reasoning_tokens": 0},
+            },
+        }
+
+        if body.get("stream") is not True:
+            return web.json_response(result)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def event(data: dict) -> bytes:
+            return f"event: {data['type']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+        await response.write(event({"type": "response.created", "response": {**result, "status": "in_progress", "output": []}}))
+        for text in chunks:
+            await asyncio.sleep(self.options.token_delay)
+            await response.write(
+                event({"type": "response.output_text.delta", "item_id": item_id, "output_index": 0, "content_index": 0, "delta": text})
+            )
+        await response.write(event({"type": "response.completed", "response": result}))
+        await response.write_eof()
+        return response
+
+    def __add_file(self, filename: str, purpose: str, data: bytes) -> dict:
+        file = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(data),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.__files[file["id"]] = (file, data)
+        return file
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        return web.json_response(self.__add_file(upload.filename, form["purpose"], upload.file.read()))
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if file_id not in self.__files:
+            return web.json_response({"error": {"message": "No such file (stub)", "type": "invalid_request_error", "code": None}}, status=404)
+        return web.Response(body=self.__files[file_id][1], content_type="application/octet-stream")
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body["input_file_id"] not in self.__files:
+            return web.json_response({"error": {"message": "No such file (stub)", "type": "invalid_request_error", "code": None}}, status=400)
+        self.requests += 1
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.__batches[batch["id"]] = batch
+        asyncio.get_running_loop().call_later(self.options.batch_delay, self.__complete_batch, batch["id"])
+        return web.json_response(batch)
+
+    def __complete_batch(self, batch_id: str) -> None:
+        batch = self.__batches[batch_id]
+        lines = [json.loads(line) for line in self.__files[batch["input_file_id"]][1].decode().splitlines() if line.strip()]
+        outputs = []
+        errors = []
+        for line in lines:
+            if random.random() < self.options.error_rate:
+                errors.append(
+                    {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": line["custom_id"],
+                        "response": None,
+                        "error": {"code": "server_error", "message": "stub error"},
+                    }
+                )
+                continue
+            chunks = self.__text()
+            prompt_tokens = _estimate_tokens(line["body"]["messages"])
+            completion = {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": line["body"]["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(chunks)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(chunks), "total_tokens": prompt_tokens + len(chunks)},
+            }
+            outputs.append(
+                {
+                    "id": f"batch_req_{uuid.uuid4().hex}",
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": completion},
+                    "error": None,
+                }
+            )
+
+        def jsonl(items: list) -> bytes:
+            return "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items).encode()
+
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(lines), "completed": len(outputs), "failed": len(errors)}
+        if len(outputs) > 0:
+            batch["output_file_id"] = self.__add_file(f"{batch_id}_output.jsonl", "batch_output", jsonl(outputs))["id"]
+        if len(errors) > 0:
+            batch["error_file_id"] = self.__add_file(f"{batch_id}_error.jsonl", "batch_output", jsonl(errors))["id"]
+
+    async def retrieve_batch(self, request: web.Request) -> web.Response:
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self.__batches:
+            return web.json_response({"error": {"message": "No such batch (stub)", "type": "invalid_request_error", "code": None}}, status=404)
+        return web.json_response(self.__batches[batch_id])
+
+    async def image(self, request: web.Request) -> web.Response:
+        index = int(request.match_info["index"])
+        if index not in self.__images:
+            # 内容の異なる大きめの画像を作る
+            img = Image.new("RGB", (1600, 1200), ((index * 37) % 256, (index * 91) % 256, (index * 53) % 256))
+            out = io.BytesIO()
+            img.save(out, format="PNG")
+            self.__images[index] = out.getvalue()
+        return web.Response(body=self.__images[index], content_type="image/png")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"requests": self.requests, "errors": self.errors, "prompt_tokens": self.prompt_tokens, "cached_tokens": self.cached_tokens}
+        )
+
+
+def add_arguments(arg_parser: argparse.ArgumentParser) -> None:
+    defaults = StubOptions()
+    arg_parser.add_argument("--latency", type=float, default=defaults.latency, help="最初のトークンまでの遅延(秒)")
+    arg_parser.add_argument("--jitter", type=float, default=defaults.jitter, help="遅延のばらつき(秒)")
+    arg_parser.add_argument("--token-delay", type=float, default=defaults.token_delay, help="ストリーミング時のチャンク間隔(秒)")
+    arg_parser.add_argument("--tokens", type=int, default=defaults.tokens, help="応答のチャンク数")
+    arg_parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="500を返す割合")
+    arg_parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate, help="429を返す割合")
+    arg_parser.add_argument("--retry-after-ms", type=int, default=defaults.retry_after_ms)
+    arg_parser.add_argument("--hang-rate", type=float, default=defaults.hang_rate, help="応答を返さずに止まる割合")
+    arg_parser.add_argument("--batch-delay", type=float, default=defaults.batch_delay, help="バッチが完了するまでの時間(秒)")
+
+
+def options_from_args(args: argparse.Namespace) -> StubOptions:
+    return StubOptions(
+        latency=args.latency,
+        jitter=args.jitter,
+        token_delay=args.token_delay,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after_ms=args.retry_after_ms,
+        hang_rate=args.hang_rate,
+        batch_delay=args.batch_delay,
+    )
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8787)
+    add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    server = StubServer(options_from_args(args))
+    web.run_app(server.app(), host=args.host, port=args.port, print=lambda _: print(f"stub listening on http://{args.host}:{args.port}", flush=True))
+
+
+if __name__ == "__main__":
+    main()
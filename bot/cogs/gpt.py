@@ -1,21 +1,35 @@
-import copy
-import datetime
+import asyncio
 import inspect
 import json
 import logging
-import logging.config
-import re
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field, replace
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Type, TypeVar
+from typing import Any, Awaitable, Callable, Dict, Literal, Sequence, Type, TypeVar
 
 import discord
 import openai
-import urlextract
 import yaml
 from discord.ext import commands, tasks
 
+from utils import parser
+from utils.batch import BatchResult, BatchRunner
+from utils.cache import ResponseCache
+from utils.coalesce import Mention, MentionCoalescer, merge_mentions
+from utils.config import ConfigService
+from utils.compaction import CompactionQueue, Summarizer
+from utils.history import SessionHistory, SystemPrompt, TokenCounter, Turn, to_payload
+from utils.image import ImageIngestor
+from utils.logqueue import configure_logging, stop_logging
+from utils.metrics import LoopLagMonitor, Metrics, MetricsServer
+from utils.quota import Admission, QuotaController, QuotaDecision
+from utils.resilience import Attempt, ResilientExecutor, RetryPolicy
+from utils.scheduler import RequestScheduler
+from utils.session import SessionKey, SessionManager
+from utils.store import create_store
+from utils.stream import StreamingReply, split_message
+
 VERSION = "20250527_2100"
 
 
@@ -27,8 +41,35 @@ class ImageReso(Enum):
 T = TypeVar("T", bound="YamlConfig")
 
 
-@dataclass
+@dataclass(frozen=True)
 class YamlConfig:
+    """yamlから読み込む設定. 作成後は変更できないので、変更する場合は dataclasses.replace で作り直す"""
+
+    def __post_init__(self) -> None:
+        # 型を確認する. intの項目にfloat・boolを渡した場合などはエラーにする
+        for key, f in self.__dataclass_fields__.items():
+            val = getattr(self, key)
+            if f.type is bool:
+                valid = isinstance(val, bool)
+            elif f.type is int:
+                valid = isinstance(val, int) and not isinstance(val, bool)
+            elif f.type is float:
+                valid = isinstance(val, (int, float)) and not isinstance(val, bool)
+            elif f.type in (str, tuple):
+                valid = isinstance(val, f.type)
+            else:
+                valid = True
+            if valid is False:
+                raise ValueError(f"{type(self).__name__}.{key} must be {f.type.__name__}, got {val!r}")
+        self.validate()
+
+    def validate(self) -> None:
+        """値の範囲を確認する
+
+        Raises:
+            ValueError: 不正な値の場合
+        """
+
     @classmethod
     def load(cls: Type[T], config_path: Path) -> T:
         def _convert_from_dict(parent_cls: Type[T], data: Dict[str, Any]) -> Dict[str, Any]:
@@ -39,6 +80,8 @@ class YamlConfig:
                     valid_data[key] = child_class(**_convert_from_dict(child_class, val))
                 elif isinstance(child_class, type) and issubclass(child_class, Enum):
                     valid_data[key] = child_class(val)
+                elif isinstance(val, list):
+                    valid_data[key] = tuple(val)
             return valid_data
 
         if config_path.exists() is False:
@@ -50,48 +93,407 @@ class YamlConfig:
             return cls(**config_data)
 
 
-@dataclass
+@dataclass(frozen=True)
 class gptconfig(YamlConfig):
     model: str
     max_token: int
     temperature: float
     image_resolution: ImageReso
-
-
-@dataclass
+    max_concurrency: int = 8
+    max_concurrency_per_guild: int = 2
+    summary_model: str = "gpt-4.1-nano"
+    summary_max_token: int = 400
+    # 要約の同時リクエスト数の上限. 対話のリクエストとは別に数える
+    summary_concurrency: int = 2
+    # 失敗が続いた場合に順番に試すモデル
+    fallback_models: tuple = ()
+
+    def validate(self) -> None:
+        if self.max_token <= 0:
+            raise ValueError(f"gpt.max_token must be positive, got {self.max_token}")
+        if not 0 <= self.temperature <= 2:
+            raise ValueError(f"gpt.temperature must be in [0, 2], got {self.temperature}")
+        if self.max_concurrency <= 0 or self.max_concurrency_per_guild <= 0 or self.summary_concurrency <= 0:
+            raise ValueError("gpt.max_concurrency, gpt.max_concurrency_per_guild and gpt.summary_concurrency must be positive")
+
+
+@dataclass(frozen=True)
 class botconfig(YamlConfig):
     save_api_response: bool
     save_image_input: bool
     history_size: int
     default_system_promt: str
-
-
-@dataclass
+    prompt_token_budget: int = 6000
+    compaction: bool = True
+    session_idle_minutes: int = 60
+    max_sessions: int = 1000
+    stream_response: bool = True
+    stream_edit_interval: float = 1.0
+    coalesce_window: float = 0.8
+    coalesce_max_batch: int = 8
+    # "stable": 上限を超えたらtrim_ratio分まとめて削除し、プロンプトの先頭を保つ "sliding": 1件ずつ削除する
+    prompt_layout: str = "stable"
+    trim_ratio: float = 0.25
+
+    def validate(self) -> None:
+        if self.history_size <= 0:
+            raise ValueError(f"bot.history_size must be positive, got {self.history_size}")
+        if self.prompt_token_budget <= 0:
+            raise ValueError(f"bot.prompt_token_budget must be positive, got {self.prompt_token_budget}")
+        if self.stream_edit_interval <= 0 or self.coalesce_window < 0:
+            raise ValueError("bot.stream_edit_interval must be positive and bot.coalesce_window must not be negative")
+        if self.prompt_layout not in ("stable", "sliding"):
+            raise ValueError(f"bot.prompt_layout must be stable or sliding, got {self.prompt_layout}")
+        if not 0 <= self.trim_ratio < 1:
+            raise ValueError(f"bot.trim_ratio must be in [0, 1), got {self.trim_ratio}")
+
+
+@dataclass(frozen=True)
+class storeconfig(YamlConfig):
+    backend: str = "sqlite"
+    path: str = "data/bot.db"
+    flush_interval: float = 1.0
+    batch_size: int = 100
+
+
+@dataclass(frozen=True)
+class imageconfig(YamlConfig):
+    inline: bool = True
+    cache_dir: str = "data/image_cache"
+    memory_items: int = 128
+    disk_items: int = 2048
+    workers: int = 2
+    max_download_bytes: int = 20 * 1024 * 1024
+    fetch_hosts: tuple = ("cdn.discordapp.com", "media.discordapp.net")
+    allow_private_addresses: bool = False
+
+
+@dataclass(frozen=True)
+class cacheconfig(YamlConfig):
+    enabled: bool = False
+    ttl: float = 600
+    search_ttl: float = 120
+    max_entries: int = 512
+    context_window: int = 4
+
+
+@dataclass(frozen=True)
+class retryconfig(YamlConfig):
+    max_attempts: int = 3
+    attempt_timeout: float = 60
+    stream_idle_timeout: float = 20
+    total_timeout: float = 90
+    base_delay: float = 0.5
+    max_delay: float = 8
+    breaker_threshold: int = 5
+    breaker_reset: float = 30
+
+
+@dataclass(frozen=True)
+class metricsconfig(YamlConfig):
+    enabled: bool = True
+    host: str = "127.0.0.1"
+    port: int = 9464
+    loop_lag_interval: float = 0.5
+
+
+@dataclass(frozen=True)
+class quotaconfig(YamlConfig):
+    enabled: bool = False
+    user_tokens_per_hour: int = 60000
+    user_burst: int = 20000
+    guild_tokens_per_hour: int = 400000
+    guild_burst: int = 100000
+    # 上限を超えた場合. "reject": 拒否する "downgrade": downgrade_modelで応答する
+    over_quota: str = "reject"
+    downgrade_model: str = "gpt-4.1-nano"
+
+    def validate(self) -> None:
+        if self.over_quota not in ("reject", "downgrade"):
+            raise ValueError(f"quota.over_quota must be reject or downgrade, got {self.over_quota}")
+
+
+@dataclass(frozen=True)
+class batchconfig(YamlConfig):
+    enabled: bool = True
+    model: str = "gpt-4.1-mini"
+    max_token: int = 1600
+    interval: float = 60
+    history_limit: int = 100
+    max_jobs: int = 1000
+
+    def validate(self) -> None:
+        if self.interval <= 0:
+            raise ValueError(f"batch.interval must be positive, got {self.interval}")
+        if self.history_limit <= 0:
+            raise ValueError(f"batch.history_limit must be positive, got {self.history_limit}")
+
+
+@dataclass(frozen=True)
 class AppConfig(YamlConfig):
     gpt: gptconfig
     bot: botconfig
+    store: storeconfig = field(default_factory=storeconfig)
+    image: imageconfig = field(default_factory=imageconfig)
+    cache: cacheconfig = field(default_factory=cacheconfig)
+    retry: retryconfig = field(default_factory=retryconfig)
+    metrics: metricsconfig = field(default_factory=metricsconfig)
+    quota: quotaconfig = field(default_factory=quotaconfig)
+    batch: batchconfig = field(default_factory=batchconfig)
 
 
 class BotCog(commands.Cog):
-    def __init__(self, bot) -> None:
+    def __init__(self, bot, config: AppConfig | None = None, config_loader: Callable[[Path], AppConfig] = AppConfig.load) -> None:
         # define logger
         with open(str((Path(__file__).resolve().parent / ".." / "logging_config.json").resolve()), "r") as f:
             log_conf = json.load(f)
-        logging.config.dictConfig(log_conf)
+        configure_logging(log_conf)
         self.__logger = logging.getLogger("gpt")
 
         self.bot = bot
-        self.config = AppConfig.load((Path(__file__).resolve().parent / ".." / "setting.yaml").resolve())
+        # 指定が無ければsetting.yamlから読み込み、変更を監視する
+        if config is None:
+            config_path = (Path(__file__).resolve().parent / ".." / "setting.yaml").resolve()
+            self.__config = ConfigService(config_loader(config_path), config_path, config_loader)
+        else:
+            self.__config = ConfigService(config)
+        self.__config.add_validator(self.__check_config)
+        self.__config.subscribe(self.__apply_config)
+
+        # 再試行はResilientExecutorで行う
+        self.__client = openai.AsyncOpenAI(max_retries=0)
+        self.__executor = ResilientExecutor(
+            RetryPolicy(
+                self.config.retry.max_attempts,
+                self.config.retry.attempt_timeout,
+                self.config.retry.stream_idle_timeout,
+                self.config.retry.total_timeout,
+                self.config.retry.base_delay,
+                self.config.retry.max_delay,
+            ),
+            self.config.retry.breaker_threshold,
+            self.config.retry.breaker_reset,
+        )
+        self.__scheduler = RequestScheduler(self.config.gpt.max_concurrency, self.config.gpt.max_concurrency_per_guild)
+        # 要約は急がないため、対話のリクエストの枠を使わずに別枠で順番に実行する
+        self.__background = RequestScheduler(self.config.gpt.summary_concurrency, 1)
+        self.__quota = QuotaController(
+            self.config.quota.user_burst,
+            self.config.quota.user_tokens_per_hour / 3600,
+            self.config.quota.guild_burst,
+            self.config.quota.guild_tokens_per_hour / 3600,
+            self.config.quota.over_quota == "downgrade",
+        )
+
+        self.__counter = TokenCounter(self.config.gpt.model)
+        self.__charactor: Dict[int, SystemPrompt] = {}
+        self.__sessions: SessionManager[SessionHistory] = SessionManager(self.config.bot.session_idle_minutes * 60, self.config.bot.max_sessions)
+        self.__store = create_store(
+            self.config.store.backend,
+            (Path(__file__).resolve().parent / ".." / self.config.store.path).resolve(),
+            self.config.store.flush_interval,
+            self.config.store.batch_size,
+        )
+        self.__images = ImageIngestor(
+            (Path(__file__).resolve().parent / ".." / self.config.image.cache_dir).resolve(),
+            self.config.image.memory_items,
+            self.config.image.disk_items,
+            self.config.image.workers,
+            self.config.image.max_download_bytes,
+            self.config.image.fetch_hosts,
+            self.config.image.allow_private_addresses,
+        )
+        self.__cache = ResponseCache(self.config.cache.max_entries, self.config.cache.context_window)
+        self.__summarizer = Summarizer(self.__client.with_options(max_retries=2), self.config.gpt.summary_model, self.config.gpt.summary_max_token)
+        self.__compaction = CompactionQueue(self.compact_history)
+        # シャード構成ではワーカーごとに自分が積んだジョブだけを回収する
+        self.__batches = BatchRunner(
+            self.__client.with_options(max_retries=2), self.__store, self.config.batch.max_jobs, getattr(self.bot, "worker_id", 0)
+        )
+        self.__history_epoch: Dict[SessionKey, int] = {}
+        self.__coalescer: MentionCoalescer[Mention] = MentionCoalescer(
+            self.config.bot.coalesce_window, self.answer_mentions, self.config.bot.coalesce_max_batch
+        )
+        # プロセス起動から最初の応答を返すまでの秒数
+        self.__first_reply_seconds: float | None = None
+
+        self.__metrics = Metrics()
+        self.__metrics.register_gauge("bot_requests_in_flight", "Requests being sent to the API", lambda: self.__scheduler.stats().in_flight)
+        self.__metrics.register_gauge("bot_request_queue_depth", "Requests waiting for a slot", self.__scheduler.queue_depth)
+        self.__metrics.register_gauge("bot_active_sessions", "Conversation sessions held in memory", lambda: len(self.__sessions))
+        self.__metrics.register_gauge(
+            "bot_time_to_first_reply_seconds",
+            "Time from process start to the first reply",
+            lambda: self.__first_reply_seconds if self.__first_reply_seconds is not None else float("nan"),
+        )
+        self.__metrics.register_gauge("bot_batch_jobs_pending", "Batch jobs waiting to be submitted", lambda: len(self.__batches.pending()))
+        self.__metrics.register_gauge("bot_batches_in_flight", "Submitted batches waiting for results", lambda: len(self.__batches.in_flight()))
+        self.__metrics.register_gauge("bot_batch_jobs_submitted", "Batch jobs submitted since start", lambda: self.__batches.submitted)
+        self.__metrics.register_gauge("bot_batch_jobs_delivered", "Batch results delivered since start", lambda: self.__batches.delivered)
+        self.__metrics.register_gauge("bot_config_reloads", "Config file reloads since start", lambda: self.__config.reloads)
+        self.__loop_lag = LoopLagMonitor(self.__metrics, self.config.metrics.loop_lag_interval)
+        self.__metrics_server = MetricsServer(self.__metrics, self.config.metrics.host, self.config.metrics.port)
+
+    @property
+    def config(self) -> AppConfig:
+        """設定. リクエストの処理中はその開始時点のスナップショットを返す"""
+        return self.__config.snapshot()
+
+    @staticmethod
+    def __check_config(current: AppConfig, config: AppConfig) -> None:
+        """再起動しないと反映できない設定の変更を拒否する
+
+        Raises:
+            ValueError: ストア・画像・メトリクスの設定が変わっている場合
+        """
+        changed = [name for name in ("store", "image", "metrics") if getattr(current, name) != getattr(config, name)]
+        if len(changed) > 0:
+            raise ValueError(f"{', '.join(changed)} cannot be changed without a restart")
+
+    def __apply_config(self, config: AppConfig) -> None:
+        """設定の差し替え時に、作成済みのオブジェクトへ反映する
+
+        ストア・画像・メトリクスの設定は __check_config で変更を拒否する
+        """
+        self.__counter.set_model(config.gpt.model)
+        self.__summarizer.model = config.gpt.summary_model
+        self.__summarizer.max_tokens = config.gpt.summary_max_token
+        self.__sessions.idle_seconds = config.bot.session_idle_minutes * 60
+        self.__sessions.max_sessions = config.bot.max_sessions
+        if config.cache.enabled is False or config.cache.context_window != self.__cache.context_window:
+            # 無効にした場合やキーの作り方が変わった場合は古い応答を持ち続けない
+            self.__cache.clear()
+        self.__cache.max_entries = config.cache.max_entries
+        self.__cache.context_window = config.cache.context_window
+        self.__scheduler.resize(config.gpt.max_concurrency, config.gpt.max_concurrency_per_guild)
+        self.__background.resize(config.gpt.summary_concurrency, 1)
+        self.__executor.configure(
+            RetryPolicy(
+                config.retry.max_attempts,
+                config.retry.attempt_timeout,
+                config.retry.stream_idle_timeout,
+                config.retry.total_timeout,
+                config.retry.base_delay,
+                config.retry.max_delay,
+            ),
+            config.retry.breaker_threshold,
+            config.retry.breaker_reset,
+        )
+        self.__coalescer.window = config.bot.coalesce_window
+        self.__coalescer.max_batch = max(1, config.bot.coalesce_max_batch)
+        self.__quota.configure(
+            config.quota.user_burst,
+            config.quota.user_tokens_per_hour / 3600,
+            config.quota.guild_burst,
+            config.quota.guild_tokens_per_hour / 3600,
+            config.quota.over_quota == "downgrade",
+        )
+        self.__batches.max_jobs = config.batch.max_jobs
+        self.loop_batch.change_interval(seconds=config.batch.interval)
+        self.__logger.info(f"config applied model={config.gpt.model} max_token={config.gpt.max_token} history_size={config.bot.history_size}")
+
+    async def cog_load(self) -> None:
+        self.__config.start()
+        await self.__store.open()
+        await self.__batches.open()
+        self.loop_batch.change_interval(seconds=self.config.batch.interval)
+        await self.__images.open()
+        self.__loop_lag.start()
+        if self.config.metrics.enabled:
+            try:
+                await self.__metrics_server.start()
+            except OSError:
+                self.__logger.exception("failed to start metrics server")
+
+    async def cog_unload(self) -> None:
+        await self.__config.stop()
+        await self.__metrics_server.stop()
+        await self.__loop_lag.stop()
+        await self.__store.close()
+        await self.__images.close()
+        stop_logging()
+
+    async def get_system_prompt(self, guild_id: int) -> SystemPrompt:
+        """サーバーのシステムプロンプトを取得する. メモリに無ければストアから読み込む"""
+        if guild_id not in self.__charactor:
+            text = await self.__store.load_system(guild_id)
+            if guild_id not in self.__charactor:
+                self.__charactor[guild_id] = SystemPrompt(text or self.config.bot.default_system_promt, self.__counter)
+        return self.__charactor[guild_id]
+
+    async def load_history(self, guild_id: int, channel_id: int) -> SessionHistory | None:
+        """チャンネルの履歴を取得する. メモリに無ければストアから読み込む
+
+        取得したセッションは最近使ったものとして扱い、上限による取り出しの対象から遠ざける
 
-        self.__init_message: list = [{"role": "system", "content": self.config.bot.default_system_promt}]
-        self.__history: dict = {}
-        self.__token_ranking: dict = {}
-        self.__last_activity: datetime = datetime.datetime.now()
+        Returns:
+            SessionHistory | None: 履歴. どこにも無ければNone
+        """
+        key = (guild_id, channel_id)
+        history = self.__sessions.get(key)
+        if history is not None:
+            self.__sessions.touch(key)
+            return history
+
+        system = await self.get_system_prompt(guild_id)
+        state = await self.__store.load_session(guild_id, channel_id)
+        # 読み込み中に他のリクエストが作成した場合はそちらを使う
+        history = self.__sessions.get(key)
+        if history is not None:
+            self.__sessions.touch(key)
+            return history
+        if state is None:
+            return None
+        # メモリから外れていた間や再起動をまたいで期限が切れた履歴は、メモリ上で期限が切れた場合と同じく消す
+        if state.last_active is not None and time.time() - state.last_active > self.config.bot.session_idle_minutes * 60:
+            self.__expire_stored(guild_id, channel_id, state.turns)
+            self.__logger.info(f"stored history expired guild={guild_id} channel={channel_id} turns={len(state.turns)}")
+            return None
+
+        history = SessionHistory(system, self.__counter)
+        history.set_summary(state.summary)
+        for turn in state.turns:
+            history.append(turn)
+        self.__add_session(key, history)
+        self.__logger.info(f"history loaded guild={guild_id} channel={channel_id} turns={len(history)}")
+        return history
+
+    async def get_history(self, guild_id: int, channel_id: int) -> SessionHistory:
+        """チャンネルの履歴を取得する. 無ければ作成する"""
+        history = await self.load_history(guild_id, channel_id)
+        if history is None:
+            history = SessionHistory(await self.get_system_prompt(guild_id), self.__counter)
+            self.__add_session((guild_id, channel_id), history)
+        return history
+
+    def __add_session(self, key: SessionKey, history: SessionHistory) -> None:
+        for evicted_key, _ in self.__sessions.add(key, history):
+            # sqliteなら保存済みなので次のアクセス時に読み込み直す. 期限はストアの最終アクティビティで判定する
+            # memoryのストアでは履歴はここで失われる
+            self.__logger.info(f"session evicted from memory guild={evicted_key[0]} channel={evicted_key[1]}")
+
+    def add_history(self, history: SessionHistory, guild_id: int, channel_id: int, message: dict) -> None:
+        """履歴の末尾にメッセージを追加する
 
-    async def reset_history(self, guild_id: int) -> bool:
+        Args:
+            history (SessionHistory): get_history()で取得した履歴. 途中でメモリから外れていても追加先は変わらない
+        """
+        history.append(message)
+        self.__sessions.touch((guild_id, channel_id))
+        self.__store.append_turn(guild_id, channel_id, message)
+
+    async def reset_history(self, guild_id: int, channel_id: int) -> bool:
         """履歴削除"""
-        if guild_id in self.__history:
-            self.__history[guild_id] = [self.__history[guild_id][0]]
+        history = await self.load_history(guild_id, channel_id)
+        if history is not None:
+            history.clear()
+            history.set_summary(None)
+            self.__store.clear_turns(guild_id, channel_id)
+            self.__store.save_summary(guild_id, channel_id, None)
+            # 実行中の要約が後から反映されないようにする
+            key = (guild_id, channel_id)
+            self.__compaction.discard(key)
+            self.__history_epoch[key] = self.__history_epoch.get(key, 0) + 1
             self.__logger.info("history reset")
             return True
         else:
@@ -99,12 +501,11 @@ class BotCog(commands.Cog):
 
     async def reset_charactor(self, guild_id: int) -> bool:
         """性格をリセットする"""
-        if guild_id in self.__history.keys():
-            self.__history[guild_id][0] = self.__init_message[0]
-            self.__logger.info("system charactor reset")
-            return True
-        else:
-            return False
+        system = await self.get_system_prompt(guild_id)
+        system.set(self.config.bot.default_system_promt)
+        self.__store.save_system(guild_id, None)
+        self.__logger.info("system charactor reset")
+        return True
 
     async def change_charactor(self, guild_id: int, txt: str) -> bool:
         """gptにわたす性格設定を変更する
@@ -113,29 +514,106 @@ class BotCog(commands.Cog):
             txt (str): 変更先の性格設定文
         """
         try:
-            if guild_id in self.__history.keys():
-                self.__history[guild_id][0] = {"role": "system", "content": txt}
-                self.__logger.info(f"system charactor changed -> {txt}")
-            else:
-                self.__history[guild_id] = [{"role": "system", "content": txt}]
-                self.__logger.info(f"charactor created for new server-> {txt}")
+            system = await self.get_system_prompt(guild_id)
+            system.set(txt)
+            self.__store.save_system(guild_id, txt)
+            self.__logger.info(f"system charactor changed -> {txt}")
         except Exception:
             self.__logger.exception("Charactor setting failed")
             return False
         return True
 
-    def check_history_size(self, guild_id: int) -> int:
+    def check_history_size(self, guild_id: int, channel_id: int) -> int:
         """履歴配列長の確認
 
         Returns:
             int : 配列長
         """
-        return int(len(self.__history[guild_id]))
+        history = self.__sessions.get((guild_id, channel_id))
+        return len(history) if history is not None else 0
+
+    async def add_input(
+        self, history: SessionHistory, guild_id: int, channel_id: int, messages: list[dict], reserved: int = 0, user_ids: Sequence[int] = ()
+    ) -> tuple[list[tuple[int, QuotaDecision]], str | None]:
+        """入力を履歴に追加し、上限に収まるように古い履歴を削除する
+
+        入力だけでプロンプトの上限を超える場合や、トークン使用量の上限で拒否する場合は、履歴を変更せずに拒否する
+
+        Args:
+            history (SessionHistory): get_history()で取得した履歴
+            guild_id (int): サーバーID
+            channel_id (int): チャンネルID
+            messages (list[dict]): 1回の入力で追加するメッセージ. 保存する画像を含む
+            reserved (int): 履歴以外に送るトークン数
+            user_ids (Sequence[int]): 入力したユーザー. 指定した場合はトークン使用量の上限を確認する
+
+        Returns:
+            tuple[list[tuple[int, QuotaDecision]], str | None]: ユーザーごとの判定結果, 代わりに使うモデル
+
+        Raises:
+            ValueError: 入力だけで上限を超える場合や、使用量の上限で拒否する場合
+        """
+        turns = [Turn.from_message(message, self.__counter) for message in messages]
+        minimum = history.base_tokens + sum(turn.tokens for turn in turns) + reserved
+        if minimum > self.config.bot.prompt_token_budget:
+            raise ValueError(f"入力が長すぎるで ({minimum} > {self.config.bot.prompt_token_budget} token)")
+        trim_ratio = self.config.bot.trim_ratio if self.config.bot.prompt_layout == "stable" else 0.0
+        predicted = history.predict(self.config.bot.history_size, self.config.bot.prompt_token_budget, reserved, trim_ratio, turns)
+        decisions, model = self.__admit(guild_id, user_ids, predicted)
+
+        for message, turn in zip(messages, turns):
+            history.append(turn)
+            self.__store.append_turn(guild_id, channel_id, message)
+        self.__sessions.touch((guild_id, channel_id))
+        await self.delete_old_history(history, guild_id, channel_id, reserved, keep=len(turns))
+        return decisions, model
+
+    async def delete_old_history(self, history: SessionHistory, guild_id: int, channel_id: int, reserved: int = 0, keep: int = 1) -> None:
+        """履歴数とトークン数の上限に収まるまで古い履歴を削除する
+
+        prompt_layoutがstableの場合は上限を超えた時だけまとめて削除する. 要約もその時だけ更新されるため、
+        それ以外のリクエストではシステムプロンプト・要約・履歴の先頭が前回と同じになりプロンプトキャッシュが効く
+
+        Args:
+            history (SessionHistory): get_history()で取得した履歴
+            guild_id (int): サーバーID
+            channel_id (int): チャンネルID
+            reserved (int): 履歴以外に送るトークン数
+            keep (int): 削除しない最新のメッセージ数
+        """
+        trim_ratio = self.config.bot.trim_ratio if self.config.bot.prompt_layout == "stable" else 0.0
+        evicted = history.fit(self.config.bot.history_size, self.config.bot.prompt_token_budget, reserved, trim_ratio, keep)
+        if len(evicted) > 0:
+            self.__logger.info(f"[History] trimmed guild={guild_id} channel={channel_id} turns={len(evicted)} remaining={len(history)}")
+            self.__store.delete_oldest_turns(guild_id, channel_id, len(evicted))
+            if self.config.bot.compaction:
+                self.__compaction.submit((guild_id, channel_id), evicted)
+
+    async def compact_history(self, key: SessionKey, turns: list) -> None:
+        """履歴から溢れたメッセージを要約に畳み込む"""
+        guild_id, channel_id = key
+        epoch = self.__history_epoch.get(key, 0)
+
+        history = self.__sessions.get(key)
+        if history is not None:
+            previous = history.summary
+        else:
+            # メモリから外れたセッションはストアの要約に畳み込む
+            state = await self.__store.load_session(guild_id, channel_id)
+            previous = state.summary if state is not None else None
+
+        # 応答しないリクエストで枠を占有し続けないように期限を設ける
+        async with self.__background.slot(guild_id), asyncio.timeout(self.config.retry.total_timeout):
+            summary, usage = await self.__summarizer.summarize(previous, turns)
+        self.__metrics.add_tokens(guild_id, self.__summarizer.model, usage.prompt_tokens, usage.completion_tokens)
+        if epoch != self.__history_epoch.get(key, 0):
+            return
 
-    async def delete_old_history(self, guild_id: int) -> None:
-        """一番古い履歴(index = 1) を削除する"""
-        while self.config.bot.history_size < self.check_history_size(guild_id):
-            del self.__history[guild_id][1]
+        history = self.__sessions.get(key)
+        if history is not None:
+            history.set_summary(summary)
+        self.__store.save_summary(guild_id, channel_id, summary)
+        self.__logger.info(f"[Compaction] guild={guild_id} channel={channel_id} turns={len(turns)} usage={usage.total_tokens} summary={len(summary)} chars")
 
     async def parse_message(self, message: discord.message.Message) -> tuple[str, str | None, list]:
         """入力メッセージを処理して、入力・参照・添付ファイルにする
@@ -150,42 +628,246 @@ class BotCog(commands.Cog):
         Returns:
             tuple[str, str | None, list]: 入力, 参照, 添付ファイルのリスト
         """
+        return parser.parse_message(message)
 
-        reference_message = None
-        attachments_list = []
-
-        #
-        plane_message = re.sub(r"<@\d+>", "", message.content)
-        plane_message = plane_message.strip()
-        if message.reference is not None:
-            if message.reference.resolved is not None:
-                reference_message = message.reference.resolved.content
-
-        # 添付ファイルの抽出
-        # 対応ファイル形式
-        extention = re.compile(r".png|.jpg|.jpeg|.gif")
-        # 直接メッセージに添付
-        if 0 < len(message.attachments):
-            for attach in message.attachments:
-                if extention.search(attach.url) is not None:
-                    attachments_list.append(attach.url)
-                else:
-                    raise ValueError("そのファイル非対応やで")
-
-        # チャットから画像のURLを抽出
-        extractor = urlextract.URLExtract()
-        extracted_urls = extractor.find_urls(plane_message)
-        if len(extracted_urls) > 0:
-            for url in extracted_urls:
-                if extention.search(url) is not None:
-                    attachments_list.append(url)
-                    plane_message = plane_message.replace(url, "")
-                else:
-                    raise ValueError("そのURL非対応やで")
+    async def request_chat(
+        self, messages: list, guild_id: int, on_delta: Callable[[str], Awaitable[None]] | None = None, model: str | None = None
+    ) -> tuple[str, int]:
+        """Chat Completions APIにリクエストを送る. キャッシュがあればそれを返す
+
+        Args:
+            messages (list): 入力メッセージ
+            guild_id (int): サーバーID
+            on_delta (Callable[[str], Awaitable[None]] | None): 指定した場合はストリーミングで受信し差分ごとに呼び出す
+            model (str | None): 指定した場合は設定のモデルの代わりに使う
+
+        Returns:
+            tuple[str, int]: 応答, 消費トークン数
+        """
+        return await self.__cached(
+            "chat", model or self.config.gpt.model, messages, self.config.cache.ttl, on_delta, lambda: self.__call_chat(messages, guild_id, on_delta, model)
+        )
+
+    async def request_search(
+        self, messages: list, guild_id: int, on_delta: Callable[[str], Awaitable[None]] | None = None, model: str | None = None
+    ) -> tuple[str, int]:
+        """Web検索付きでResponses APIにリクエストを送る. キャッシュがあればそれを返す
+
+        Args:
+            messages (list): 入力メッセージ
+            guild_id (int): サーバーID
+            on_delta (Callable[[str], Awaitable[None]] | None): 指定した場合はストリーミングで受信し差分ごとに呼び出す
+            model (str | None): 指定した場合は設定のモデルの代わりに使う
+
+        Returns:
+            tuple[str, int]: 応答, 消費トークン数
+        """
+        return await self.__cached(
+            "search", model or self.config.gpt.model, messages, self.config.cache.search_ttl, on_delta, lambda: self.__call_search(messages, guild_id, on_delta, model)
+        )
+
+    async def __cached(
+        self,
+        kind: str,
+        model: str,
+        messages: list,
+        ttl: float,
+        on_delta: Callable[[str], Awaitable[None]] | None,
+        call: Callable[[], Awaitable[tuple[str, int]]],
+    ) -> tuple[str, int]:
+        if self.config.cache.enabled is False:
+            return await call()
+
+        key = self.__cache.make_key(kind, model, self.config.gpt.temperature, messages)
+        cached = self.__cache.get(key)
+        if cached is not None:
+            self.__logger.info(f"[Cache] hit {kind}")
+            if on_delta is not None:
+                await on_delta(cached)
+            return cached, 0
+
+        response, usage = await call()
+        if len(response) > 0:
+            self.__cache.put(key, response, ttl)
+        return response, usage
+
+    async def __call_chat(
+        self, messages: list, guild_id: int, on_delta: Callable[[str], Awaitable[None]] | None = None, model: str | None = None
+    ) -> tuple[str, int]:
+        """Chat Completions APIにリクエストを送る
+
+        Args:
+            messages (list): 入力メッセージ
+            guild_id (int): サーバーID
+            on_delta (Callable[[str], Awaitable[None]] | None): 指定した場合はストリーミングで受信し差分ごとに呼び出す
+            model (str | None): 指定した場合は設定のモデルの代わりに最初に試す
+
+        Returns:
+            tuple[str, int]: 応答, 消費トークン数
+        """
+        # 履歴のビューのままではJSONにできないため、ここで1回だけdictのlistにする
+        payload = to_payload(messages)
+        async with self.__scheduler.slot(guild_id) as wait:
+            self.__metrics.observe("queue_wait", wait)
+            if wait > 0.1:
+                self.__logger.info(f"[Queue] waited {wait:.2f}s")
+            with self.__metrics.span("upstream"):
+                return await self.__executor.run(
+                    self.__models(model), lambda model, attempt: self.__chat_once(model, payload, guild_id, attempt, on_delta)
+                )
+
+    async def __chat_once(
+        self, model: str, messages: list, guild_id: int, attempt: Attempt, on_delta: Callable[[str], Awaitable[None]] | None = None
+    ) -> tuple[str, int]:
+        start = time.perf_counter()
+        if on_delta is None:
+            response = await self.__client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=self.config.gpt.max_token,
+                temperature=self.config.gpt.temperature,
+            )
+            self.__record_usage(guild_id, model, response.usage.prompt_tokens, response.usage.completion_tokens, response.usage.prompt_tokens_details)
+            return str(response.choices[0].message.content), response.usage.total_tokens
+
+        stream = await self.__client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=self.config.gpt.max_token,
+            temperature=self.config.gpt.temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        chunks = []
+        usage = 0
+        async for chunk in stream:
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                if attempt.emitted is False:
+                    self.__metrics.observe("upstream_ttft", time.perf_counter() - start)
+                attempt.emit()
+                chunks.append(chunk.choices[0].delta.content)
+                await on_delta(chunk.choices[0].delta.content)
+            if chunk.usage is not None:
+                usage = chunk.usage.total_tokens
+                self.__record_usage(guild_id, model, chunk.usage.prompt_tokens, chunk.usage.completion_tokens, chunk.usage.prompt_tokens_details)
+        return "".join(chunks), usage
+
+    async def __call_search(
+        self, messages: list, guild_id: int, on_delta: Callable[[str], Awaitable[None]] | None = None, model: str | None = None
+    ) -> tuple[str, int]:
+        """Web検索付きでResponses APIにリクエストを送る
+
+        Args:
+            messages (list): 入力メッセージ
+            guild_id (int): サーバーID
+            on_delta (Callable[[str], Awaitable[None]] | None): 指定した場合はストリーミングで受信し差分ごとに呼び出す
+            model (str | None): 指定した場合は設定のモデルの代わりに最初に試す
+
+        Returns:
+            tuple[str, int]: 応答, 消費トークン数
+        """
+        # 履歴のビューのままではJSONにできないため、ここで1回だけdictのlistにする
+        payload = to_payload(messages)
+        async with self.__scheduler.slot(guild_id) as wait:
+            self.__metrics.observe("queue_wait", wait)
+            if wait > 0.1:
+                self.__logger.info(f"[Queue] waited {wait:.2f}s")
+            with self.__metrics.span("upstream"):
+                return await self.__executor.run(
+                    self.__models(model), lambda model, attempt: self.__search_once(model, payload, guild_id, attempt, on_delta)
+                )
+
+    async def __search_once(
+        self, model: str, messages: list, guild_id: int, attempt: Attempt, on_delta: Callable[[str], Awaitable[None]] | None = None
+    ) -> tuple[str, int]:
+        start = time.perf_counter()
+        if on_delta is None:
+            response = await self.__client.responses.create(model=model, tools=[{"type": "web_search_preview"}], input=messages, max_output_tokens=800)
+            self.__record_usage(guild_id, model, response.usage.input_tokens, response.usage.output_tokens, response.usage.input_tokens_details)
+            return str(response.output_text), response.usage.total_tokens
+
+        stream = await self.__client.responses.create(
+            model=model, tools=[{"type": "web_search_preview"}], input=messages, max_output_tokens=800, stream=True
+        )
+        chunks = []
+        usage = 0
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                if attempt.emitted is False:
+                    self.__metrics.observe("upstream_ttft", time.perf_counter() - start)
+                attempt.emit()
+                chunks.append(event.delta)
+                await on_delta(event.delta)
+            elif event.type == "response.completed":
+                usage = event.response.usage.total_tokens
+                self.__record_usage(
+                    guild_id, model, event.response.usage.input_tokens, event.response.usage.output_tokens, event.response.usage.input_tokens_details
+                )
+        return "".join(chunks), usage
+
+    def __record_usage(self, guild_id: int, model: str, prompt: int, completion: int, details: Any) -> None:
+        """使用量を記録する. プロンプトのうちキャッシュから読まれたトークン数も記録する
+
+        Args:
+            details (Any): prompt_tokens_details(Chat Completions) または input_tokens_details(Responses). 無い場合はNone
+        """
+        cached = getattr(details, "cached_tokens", None) or 0
+        self.__metrics.add_tokens(guild_id, model, prompt, completion, cached)
+        self.__logger.info(f"[Usage] {model} prompt={prompt} cached={cached} ({cached / prompt if prompt > 0 else 0:.0%}) completion={completion}")
+
+    def __models(self, model: str | None = None) -> list[str]:
+        """使用するモデル. 先頭から順に試す"""
+        return list(dict.fromkeys([model or self.config.gpt.model, *self.config.gpt.fallback_models]))
 
-        return plane_message, reference_message, attachments_list
+    def __admit(self, guild_id: int, user_ids: Sequence[int], predicted: int) -> tuple[list[tuple[int, QuotaDecision]], str | None]:
+        """トークン使用量の上限を確認し、予測したトークン数をユーザーごとに等分して予約する
 
-    async def send_question_gpt(self, question: str, reference: str, attachments: list, guild_id: int) -> tuple[str, int]:
+        Returns:
+            tuple[list[tuple[int, QuotaDecision]], str | None]: ユーザーごとの判定結果(上限が無効なら空), 代わりに使うモデル
+
+        Raises:
+            ValueError: 誰かが上限を超えていて拒否する場合. 他のユーザーの予約は戻す
+        """
+        if self.config.quota.enabled is False or len(user_ids) == 0:
+            return [], None
+
+        decisions: list[tuple[int, QuotaDecision]] = []
+        model = None
+        for user_id, share in zip(user_ids, self.__split(predicted, len(user_ids))):
+            decision = self.__quota.admit(guild_id, user_id, share)
+            if decision.admission is Admission.REJECT:
+                self.__settle(guild_id, decisions, 0)
+                self.__logger.info(f"[Quota] rejected guild={guild_id} user={user_id} scope={decision.scope} predicted={share}")
+                target = ("あんた" if len(user_ids) == 1 else f"<@{user_id}>") if decision.scope == "user" else "このサーバー"
+                raise ValueError(f"{target}のトークン使用量が上限に達したで. {decision.retry_after:.0f}秒くらい待ってな")
+            if decision.admission is Admission.DOWNGRADE:
+                self.__logger.info(f"[Quota] downgraded guild={guild_id} user={user_id} scope={decision.scope} -> {self.config.quota.downgrade_model}")
+                model = self.config.quota.downgrade_model
+            decisions.append((user_id, decision))
+        return decisions, model
+
+    def __settle(self, guild_id: int, decisions: list[tuple[int, QuotaDecision]], usage: int) -> None:
+        """予約したトークン数を実際の使用量で精算する. 使用量はユーザーで等分する"""
+        for (user_id, decision), share in zip(decisions, self.__split(usage, len(decisions))):
+            self.__quota.settle(guild_id, user_id, decision, share)
+
+    @staticmethod
+    def __split(tokens: int, count: int) -> list[int]:
+        """トークン数を等分する. 端数は先頭に加える"""
+        if count == 0:
+            return []
+        return [tokens // count + (tokens % count if index == 0 else 0) for index in range(count)]
+
+    async def send_question_gpt(
+        self,
+        question: str,
+        reference: str,
+        attachments: list,
+        guild_id: int,
+        channel_id: int,
+        on_delta: Callable[[str], Awaitable[None]] | None = None,
+        user_ids: Sequence[int] = (),
+    ) -> tuple[str, int]:
         """OpenAI APIでリクエストを送信し結果を得る
 
         Args:
@@ -193,73 +875,97 @@ class BotCog(commands.Cog):
             reference (str): 参照先テキスト
             attachments (list): 添付ファイル
             guild_id (int): サーバーID
+            channel_id (int): チャンネルID
+            on_delta (Callable[[str], Awaitable[None]] | None): ストリーミング時に差分ごとに呼び出す
+            user_ids (Sequence[int]): 質問したユーザーID. 指定した場合はトークン使用量の上限を確認する
 
         Returns:
             tuple[str, int]: 応答, 消費トークン数
         """
-        self.__logger.info(f"[Question] {question}")
+        self.__logger.debug(f"[Question] {question}")
 
-        self.__history[guild_id].append({"role": "user", "content": question})
+        with self.__metrics.span("history_load"):
+            history = await self.get_history(guild_id, channel_id)
+        content = question
         if reference is not None:
-            self.__history[guild_id][-1]["content"] += f"\n## 以下へ言及\n{reference}"
-            self.__logger.info(f"[Reference] {reference}")
-
-        # 画像入力を保持するか
-        if self.config.bot.save_image_input:
-            input_messages = self.__history[guild_id]
-        else:
-            input_messages = copy.deepcopy(self.__history[guild_id])
+            content += f"\n## 以下へ言及\n{reference}"
+            self.__logger.debug(f"[Reference] {reference}")
+        messages = [{"role": "user", "content": content}]
 
         # 画像入力作成
         image_input = []
+        image_content = []
         if len(attachments) > 0:
             if self.config.gpt.image_resolution == ImageReso.LOW:
                 reso = "low"
             else:
                 reso = "high"
 
-            for url in attachments:
+            # CDNのURLは期限切れになるため、縮小した画像をdata URLとして埋め込む
+            if self.config.image.inline:
+                with self.__metrics.span("image"):
+                    image_urls = await self.__images.to_data_urls(attachments, reso)
+            else:
+                image_urls = attachments
+
+            for url in image_urls:
                 image_input.append({"type": "image_url", "image_url": {"url": url, "detail": reso}})
 
-            self.__logger.info(f"[Attachments] {attachments}")
+            self.__logger.debug(f"[Attachments] {attachments}")
             image_content = [{"role": "user", "content": image_input}]
-            # Token使用料削減のため画像は履歴として保持しない
-            input_messages += image_content
+
+        # 画像入力を保持するか
+        # Token使用料削減のため通常は画像を履歴として保持しない
+        reserved = 0
+        if self.config.bot.save_image_input:
+            messages += image_content
+        else:
+            reserved = sum(self.__counter.count_message(image_message) for image_message in image_content)
+
+        with self.__metrics.span("history_build"):
+            # 履歴に追加し、トークン数の上限に収まるように古い履歴を削除
+            decisions, model = await self.add_input(history, guild_id, channel_id, messages, reserved, user_ids)
+            input_messages = history.messages()
+            if self.config.bot.save_image_input is False:
+                input_messages = input_messages.with_tail(image_content)
+        self.__logger.info(f"[Prompt] {history.predicted_tokens} tokens (predicted)")
 
         # APIに送る
-        response = openai.chat.completions.create(
-            model=self.config.gpt.model,
-            messages=input_messages,
-            max_tokens=self.config.gpt.max_token,
-            temperature=self.config.gpt.temperature,
-        )
-        self.__logger.info(f"[Response] {str(response.choices[0].message.content)}")
+        try:
+            response, usage = await self.request_chat(input_messages, guild_id, on_delta, model)
+        except BaseException:
+            self.__settle(guild_id, decisions, 0)
+            raise
+        self.__settle(guild_id, decisions, usage)
+        self.__logger.debug(f"[Response] {response}")
+        self.__logger.info(f"[Response] {len(response)} chars, {usage} tokens")
 
         if self.config.bot.save_api_response is True:
-            self.__history[guild_id].append({"role": "assistant", "content": str(response.choices[0].message.content)})
-
-        self.__last_activity = datetime.datetime.now()
+            self.add_history(history, guild_id, channel_id, {"role": "assistant", "content": response})
+        await self.delete_old_history(history, guild_id, channel_id)
 
-        return str(response.choices[0].message.content), response.usage.total_tokens
+        return response, usage
 
-    async def token_ranking(self, guild_id: int, author: discord.Member, usage: int):
-        if isinstance(self.__token_ranking[guild_id], dict) is False:
-            self.__token_ranking = {}
+    async def token_ranking(self, guild_id: int, author: discord.abc.Snowflake, usage: int):
+        self.__store.add_usage(guild_id, author.id, usage)
 
-        if author.id in self.__token_ranking[guild_id].keys():
-            self.__token_ranking[guild_id][author.id] += usage
-        else:
-            self.__token_ranking[guild_id].setdefault(author.id, usage)
+    def record_first_reply(self) -> None:
+        """起動してから最初の応答を返すまでの時間を記録する"""
+        started_at = getattr(self.bot, "started_at", None)
+        if self.__first_reply_seconds is None and started_at is not None:
+            self.__first_reply_seconds = time.monotonic() - started_at
+            self.__logger.info(f"first reply {self.__first_reply_seconds:.2f}s after start")
 
     # 立ち上げ完了時実行
     @commands.Cog.listener()
     async def on_ready(self):
         self.loop_reset.start()
+        self.loop_batch.start()
         self.__logger.info("loop start")
 
-    @commands.hybrid_command(name="reset_h", brief="会話履歴をリセットする. 60分ごとに自動実行")
+    @commands.hybrid_command(name="reset_h", brief="このチャンネルの会話履歴をリセットする. 60分発言が無ければ自動実行")
     async def reset_h(self, ctx):
-        ret = await self.reset_history(guild_id=ctx.guild.id)
+        ret = await self.reset_history(guild_id=ctx.guild.id, channel_id=ctx.channel.id)
         if ret:
             await ctx.send("会話履歴をリセットしました")
         else:
@@ -283,19 +989,21 @@ class BotCog(commands.Cog):
 
     @commands.hybrid_command(name="ranking", brief="トークン使用量ランキグン")
     async def ranking(self, ctx):
-        if ctx.guild.id not in self.__token_ranking.keys() or len(self.__token_ranking[ctx.guild.id]) < 1:
+        ranking_sorted = await self.__store.ranking(ctx.guild.id, 4)
+        if len(ranking_sorted) < 1:
             await ctx.send("まだ誰もAPIを使用していません")
             return
 
-        ranking_sorted = sorted(self.__token_ranking[ctx.guild.id].items(), key=lambda x: x[1], reverse=True)
         embed = discord.Embed(title="Token使用量ランキング", color=discord.Colour.red())
         for x, dict in enumerate(ranking_sorted):
-            if 3 < x:
-                break
-
             user = self.bot.get_user(dict[0])
-            if user is not None:
-                embed.add_field(name=f"{x + 1}位 {user.global_name}", value=f"{dict[1]} token", inline=False)
+            if user is None:
+                # ゲートウェイに接続していないワーカーではキャッシュが無いためREST APIで取得する
+                try:
+                    user = await self.bot.fetch_user(dict[0])
+                except discord.HTTPException:
+                    continue
+            embed.add_field(name=f"{x + 1}位 {user.global_name or user.name}", value=f"{dict[1]} token", inline=False)
 
         await ctx.send(embed=embed)
 
@@ -311,11 +1019,85 @@ class BotCog(commands.Cog):
         embed.add_field(name="Max history size", value=self.config.bot.history_size, inline=True)
         embed.add_field(name="Save api response", value=self.config.bot.save_api_response, inline=True)
         embed.add_field(name="Save image input", value=self.config.bot.save_image_input, inline=True)
-        if ctx.guild.id in self.__history.keys():
-            embed.add_field(name="System prompt", value=self.__history[ctx.guild.id][0]["content"], inline=False)
+        embed.add_field(
+            name="Response cache",
+            value=f"hit {self.__cache.hits} / miss {self.__cache.misses} ({len(self.__cache)} entries)" if self.config.cache.enabled else "off",
+            inline=True,
+        )
+        embed.add_field(name="Image cache", value=f"hit {self.__images.hits} / miss {self.__images.misses}", inline=True)
+        queue_stats = self.__scheduler.stats()
+        embed.add_field(
+            name="Request queue",
+            value=f"in flight {queue_stats.in_flight} / waiting {queue_stats.queue_depth}\navg wait {queue_stats.avg_wait:.2f}s (max {queue_stats.max_wait:.2f}s)",
+            inline=True,
+        )
+        circuits = "\n".join(f"{model}: {state}" for model, state in self.__executor.states().items())
+        embed.add_field(
+            name="API circuit",
+            value=f"{circuits or 'no requests yet'}\nretries {self.__executor.retries} / fallbacks {self.__executor.fallbacks}",
+            inline=True,
+        )
+        embed.add_field(name="Prompt token budget", value=self.config.bot.prompt_token_budget, inline=True)
+        if self.config.quota.enabled:
+            user_left, guild_left = self.__quota.remaining(ctx.guild.id, ctx.author.id)
+            embed.add_field(
+                name="Token quota",
+                value=f"you {user_left:.0f} / server {guild_left:.0f} left\nrejected {self.__quota.rejected} / downgraded {self.__quota.downgraded}",
+                inline=True,
+            )
+        else:
+            embed.add_field(name="Token quota", value="off", inline=True)
+        embed.add_field(name="Compaction", value=self.config.gpt.summary_model if self.config.bot.compaction else "off", inline=True)
+        embed.add_field(name="Active sessions", value=len(self.__sessions), inline=True)
+        embed.add_field(
+            name="Mention coalescing",
+            value=f"{self.__coalescer.submitted} mentions -> {self.__coalescer.batches} requests\nduplicates {self.__coalescer.deduplicated}",
+            inline=True,
+        )
+        history = await self.load_history(ctx.guild.id, ctx.channel.id)
+        if history is not None:
+            embed.add_field(name="Predicted prompt tokens", value=history.predicted_tokens, inline=True)
+        system = await self.get_system_prompt(ctx.guild.id)
+        embed.add_field(name="System prompt", value=system.message["content"], inline=False)
 
         await ctx.send(embed=embed)
 
+    @commands.hybrid_command(name="stats", brief="処理段階ごとの時間とトークン使用量を出力")
+    async def stats(self, ctx):
+        embed = discord.Embed(title="Stats", color=0x3498DB)
+        lines = []
+        for stage, histogram in self.__metrics.stages().items():
+            lines.append(
+                f"`{stage:14s}` p50 {histogram.percentile(50) * 1000:7.1f} / p95 {histogram.percentile(95) * 1000:7.1f} / p99 {histogram.percentile(99) * 1000:7.1f} ms ({histogram.count})"
+            )
+        embed.add_field(name="Stage latency", value="\n".join(lines) or "no requests yet", inline=False)
+
+        loop_lag = self.__metrics.loop_lag
+        embed.add_field(
+            name="Event loop lag",
+            value=f"p50 {loop_lag.percentile(50) * 1000:.1f} / p99 {loop_lag.percentile(99) * 1000:.1f} ms",
+            inline=True,
+        )
+        queue_stats = self.__scheduler.stats()
+        embed.add_field(
+            name="Request queue",
+            value=f"in flight {queue_stats.in_flight} / waiting {queue_stats.queue_depth}\nlast wait {queue_stats.last_wait:.2f}s",
+            inline=True,
+        )
+
+        tokens = self.__metrics.tokens(ctx.guild.id)
+        models = sorted({model for model, _ in tokens})
+        embed.add_field(
+            name="Tokens (this server)",
+            value="\n".join(
+                f"{model}: prompt {tokens.get((model, 'prompt'), 0)} (cached {tokens.get((model, 'cached'), 0)}) / completion {tokens.get((model, 'completion'), 0)}"
+                for model in models
+            )
+            or "none",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
+
     @commands.hybrid_command(name="change_config", brief="設定を変更")
     async def change_setting(
         self,
@@ -324,49 +1106,62 @@ class BotCog(commands.Cog):
         save_image_input: bool | None,
         save_response: bool | None,
         history_size: int | None,
+        model: str | None = None,
+        max_token: int | None = None,
     ):
-        msg = ""
+        # 変更をまとめて新しいスナップショットにし、処理中のリクエストには影響させない
+        config = self.__config.current
+        gpt_changes: Dict[str, Any] = {}
+        bot_changes: Dict[str, Any] = {}
         if input_highreso_img is not None:
-            self.config.gpt.image_resolution = ImageReso(int(input_highreso_img))
-            if self.config.gpt.image_resolution == ImageReso(int(input_highreso_img)):
-                msg += f"[Success] Input Image Resolution -> {self.config.gpt.image_resolution}\n"
-            else:
-                msg += "[Fail] Input Image Resolution\n"
+            gpt_changes["image_resolution"] = ImageReso(int(input_highreso_img))
+        if model is not None:
+            gpt_changes["model"] = model
+        if max_token is not None:
+            gpt_changes["max_token"] = max_token
         if history_size is not None and history_size > 0:
-            self.config.bot.history_size = history_size
-            if self.config.bot.history_size == history_size:
-                msg += f"[Success] history_size -> {self.config.bot.history_size}\n"
-            else:
-                msg += "[Fail] history_size\n"
+            bot_changes["history_size"] = history_size
         if save_image_input is not None:
-            self.config.bot.save_image_input = bool(save_image_input)
-            if self.config.bot.save_image_input == bool(save_image_input):
-                msg += f"[Success] save_image_input -> {self.config.bot.save_image_input}\n"
-            else:
-                msg += "[Fail] save_image_input\n"
+            bot_changes["save_image_input"] = bool(save_image_input)
         if save_response is not None:
-            self.config.bot.save_api_response = bool(save_response)
-            if self.config.bot.save_api_response == bool(save_response):
-                msg += f"[Success] save_api_response -> {self.config.bot.save_api_response}\n"
-            else:
-                msg += "[Fail] save_api_response\n"
-        if len(msg) == 0:
-            msg += "config is unchanged"
+            bot_changes["save_api_response"] = bool(save_response)
+
+        if len(gpt_changes) == 0 and len(bot_changes) == 0:
+            await ctx.send("config is unchanged")
+            return
+        try:
+            new_config = replace(config, gpt=replace(config.gpt, **gpt_changes), bot=replace(config.bot, **bot_changes))
+            self.__config.update(new_config)
+        except ValueError as e:
+            await ctx.send(f"[Fail] {e}")
+            return
+
+        msg = ""
+        for key in gpt_changes:
+            msg += f"[Success] {key} -> {getattr(new_config.gpt, key)}\n"
+        for key in bot_changes:
+            msg += f"[Success] {key} -> {getattr(new_config.bot, key)}\n"
         await ctx.send(msg)
 
     @commands.hybrid_command(name="reset_config", brief="設定をリセット yamlから再読み込み")
     async def reset_setting(self, ctx):
-        self.config = AppConfig.load((Path(__file__).resolve().parent / ".." / "setting.yaml").resolve())
+        try:
+            self.__config.reload()
+        except ValueError as e:
+            await ctx.send(f"[Fail] Reload config: {e}")
+            return
         await ctx.send("Reload config")
 
     @commands.hybrid_command(name="history", brief="対話履歴を出力")
     async def check_history(self, ctx):
-        if ctx.guild.id in self.__history.keys() and len(self.__history[ctx.guild.id]) > 0:
+        history = await self.load_history(ctx.guild.id, ctx.channel.id)
+        if history is not None:
             embed = discord.Embed(title="History", color=0x00FF4C)
-            for idx, hist in enumerate(self.__history[ctx.guild.id]):
-                if len(hist["content"]) > 150:
-                    hist["content"] = hist["content"][:150]
-                embed.add_field(name=f"{idx}\t{hist['role']}", value=f"{hist['content']}", inline=False)
+            for idx, hist in enumerate(history.messages()):
+                content = hist["content"]
+                if not isinstance(content, str):
+                    content = " ".join(part["text"] if part.get("type") == "text" else "[画像]" for part in content)
+                embed.add_field(name=f"{idx}\t{hist['role']}", value=content[:150], inline=False)
             await ctx.send(embed=embed)
         else:
             await ctx.send("対話履歴がありません")
@@ -396,43 +1191,189 @@ class BotCog(commands.Cog):
     @commands.hybrid_command(name="search", brief="[beta]Web検索を使用して回答")
     async def web_search_question(self, ctx: commands.context.Context, input: str):
         """サーチAPIを使って回答を生成する"""
-        try:
-            # 履歴リストの初期化
-            self.__history.setdefault(ctx.guild.id, copy.deepcopy(self.__init_message))
-            self.__token_ranking.setdefault(ctx.guild.id, {})
+        await ctx.defer()
+        await self.answer_search(ctx.guild.id, ctx.channel.id, ctx.author, input, ctx.send)
 
-            self.__logger.info(f"[Search Input] {str(input)}")
-            self.__history[ctx.guild.id].append({"role": "user", "content": input})
-
-            await ctx.defer()
-            response = openai.responses.create(
-                model=self.config.gpt.model, tools=[{"type": "web_search_preview"}], input=self.__history[ctx.guild.id], max_output_tokens=800
-            )
-            self.__logger.info(f"[Response] {str(response.output_text)}")
+    async def answer_search(
+        self, guild_id: int, channel_id: int, author: discord.abc.Snowflake, input: str, send: Callable[[str], Awaitable[discord.Message]]
+    ) -> None:
+        """Web検索付きで回答を生成してチャンネルに送信する
 
-            if self.config.bot.save_api_response is True:
-                self.__history[ctx.guild.id].append({"role": "assistant", "content": str(response.output_text)})
+        Args:
+            guild_id (int): サーバーID
+            channel_id (int): チャンネルID
+            author (discord.abc.Snowflake): 質問したユーザー
+            input (str): 入力テキスト
+            send (Callable[[str], Awaitable[discord.Message]]): 応答を送信する関数
+        """
+        with self.__config.pin():
+            reply = None
+            try:
+                # 履歴リストの初期化
+                with self.__metrics.span("history_load"):
+                    history = await self.get_history(guild_id, channel_id)
+
+                self.__logger.debug(f"[Search Input] {str(input)}")
+                with self.__metrics.span("history_build"):
+                    decisions, model = await self.add_input(history, guild_id, channel_id, [{"role": "user", "content": input}], user_ids=[author.id])
+                    input_messages = history.messages()
+                self.__logger.info(f"[Prompt] {history.predicted_tokens} tokens (predicted)")
+
+                try:
+                    if self.config.bot.stream_response:
+                        reply = StreamingReply(send, self.config.bot.stream_edit_interval)
+                        with self.__metrics.span("discord_send"):
+                            await reply.start()
+                        response, usage = await self.request_search(input_messages, guild_id, reply.feed, model)
+                        with self.__metrics.span("discord_send"):
+                            await reply.finish()
+                    else:
+                        response, usage = await self.request_search(input_messages, guild_id, model=model)
+                except BaseException:
+                    self.__settle(guild_id, decisions, 0)
+                    raise
+                self.__settle(guild_id, decisions, usage)
+                self.__logger.debug(f"[Response] {response}")
+                self.__logger.info(f"[Response] {len(response)} chars, {usage} tokens")
+
+                if self.config.bot.save_api_response is True:
+                    self.add_history(history, guild_id, channel_id, {"role": "assistant", "content": response})
+
+                await self.delete_old_history(history, guild_id, channel_id)
+
+                await self.token_ranking(guild_id, author, usage)
+                if reply is None:
+                    with self.__metrics.span("discord_send"):
+                        for chunk in split_message(response):
+                            await send(chunk)
+                self.record_first_reply()
 
-            await self.delete_old_history(guild_id=ctx.guild.id)
+            except Exception as e:
+                self.__logger.exception("error occured in seach api processing")
+                if reply is not None:
+                    await reply.abort(f"なんかエラー出た {e}")
+                else:
+                    await send(f"なんかエラー出た {e}")
 
-            await self.token_ranking(ctx.guild.id, ctx.author, response.usage.total_tokens)
-            await ctx.send(content=str(response.output_text))
+    @commands.hybrid_command(name="batch", brief="急がない処理をまとめて安く実行. 結果は後でこのチャンネルに送信")
+    async def batch(self, ctx: commands.context.Context, kind: Literal["prompt", "summary", "translate"], text: str = ""):
+        """Batch APIにジョブを積む
 
+        prompt: textへの回答 summary: このチャンネルの最近の会話の要約 translate: ピン留めされたメッセージの翻訳(textで言語を指定)
+        """
+        await ctx.defer()
+        try:
+            job_id = await self.queue_batch(ctx.guild.id, ctx.channel, ctx.author.id, kind, text)
         except Exception as e:
-            self.__logger.exception("error occured in seach api processing")
+            self.__logger.exception("error occured in queueing batch job")
             await ctx.send(f"なんかエラー出た {e}")
+            return
+        await ctx.send(f"バッチに追加しました (job {job_id[:8]}). 結果は後でこのチャンネルに送信します")
+
+    async def queue_batch(self, guild_id: int, channel: discord.abc.Messageable, author_id: int, kind: str, text: str) -> str:
+        """チャンネルの内容からリクエストを作り、Batch APIのジョブとして積む
+
+        Args:
+            guild_id (int): サーバーID
+            channel (discord.abc.Messageable): 結果を送信するチャンネル. summary・translateではここから読み込む
+            author_id (int): 依頼したユーザー
+            kind (str): "prompt" | "summary" | "translate"
+            text (str): prompt: 入力 summary: 追加の指示 translate: 翻訳先の言語
+
+        Returns:
+            str: ジョブID
+
+        Raises:
+            ValueError: バッチが無効な場合や、処理する内容が無い場合
+        """
+        config = self.config
+        if config.batch.enabled is False:
+            raise ValueError("バッチは無効になってるで")
+
+        if kind == "prompt":
+            if text.strip() == "":
+                raise ValueError("textを入力してな")
+            system = (await self.get_system_prompt(guild_id)).message.to_dict()
+            messages = [system, {"role": "user", "content": text}]
+        elif kind == "summary":
+            history = [message async for message in channel.history(limit=config.batch.history_limit)]
+            lines = [f"{message.author.display_name}: {message.content}" for message in reversed(history) if message.content != ""]
+            if len(lines) == 0:
+                raise ValueError("要約する会話が無いで")
+            instruction = "以下のチャンネルの会話を日本語で要約してください. 話題ごとに箇条書きにし、決まったことと未解決のことを分けてください."
+            messages = [
+                {"role": "system", "content": instruction + (f"\n{text}" if text != "" else "")},
+                {"role": "user", "content": "\n".join(lines)},
+            ]
+        elif kind == "translate":
+            pins = [message for message in await channel.pins() if message.content != ""]
+            if len(pins) == 0:
+                raise ValueError("翻訳するピン留めが無いで")
+            language = text or "日本語"
+            messages = [
+                {"role": "system", "content": f"以下のメッセージをそれぞれ{language}に翻訳してください. 区切り線 --- と順序はそのまま残してください."},
+                {"role": "user", "content": "\n---\n".join(f"{message.author.display_name}: {message.content}" for message in reversed(pins))},
+            ]
+        else:
+            raise ValueError(f"unknown batch kind: {kind}")
+
+        body = {"model": config.batch.model, "messages": messages, "max_tokens": config.batch.max_token}
+        job = self.__batches.submit(guild_id, channel.id, author_id, body)
+        self.__logger.info(f"[Batch] queued {kind} job={job.job_id} guild={guild_id} channel={channel.id}")
+        return job.job_id
+
+    async def deliver_batch(self, result: BatchResult) -> None:
+        """ジョブの結果を依頼されたチャンネルに送信する"""
+        job = result.job
+        channel = self.bot.get_partial_messageable(job.channel_id, guild_id=job.guild_id)
+        if result.error is not None:
+            await channel.send(f"<@{job.author_id}> バッチ(job {job.job_id[:8]})が失敗したで {result.error}")
+            return
+
+        usage = result.prompt_tokens + result.completion_tokens
+        self.__metrics.add_tokens(job.guild_id, job.body["model"], result.prompt_tokens, result.completion_tokens)
+        await self.token_ranking(job.guild_id, discord.Object(id=job.author_id), usage)
+        if self.config.quota.enabled:
+            # 送信時には予約していないため、使用量をそのまま差し引く
+            self.__quota.settle(job.guild_id, job.author_id, QuotaDecision(Admission.ACCEPT), usage)
+        for chunk in split_message(f"<@{job.author_id}> バッチの結果 (job {job.job_id[:8]})\n{result.content}"):
+            await channel.send(chunk)
 
     # ループ処理
+    @tasks.loop(seconds=60)
+    async def loop_batch(self):
+        # 積んだジョブを送信し、終わったバッチの結果を送信する
+        try:
+            await self.__batches.flush()
+        except Exception:
+            # 次の周期で再試行する
+            self.__logger.exception("error occured in batch submission")
+        for result in await self.__batches.poll():
+            try:
+                await self.deliver_batch(result)
+            except Exception:
+                self.__logger.exception(f"failed to deliver batch job {result.job.job_id}")
+            # 送信を試みた結果は削除する. 失敗した送信を繰り返して重複させない
+            self.__batches.complete([result])
+
     @tasks.loop(minutes=5)
     async def loop_reset(self):
-        # 最終アクティビティから60分後に履歴リセット
-        if (datetime.datetime.now() - self.__last_activity).total_seconds() > 60 * 60:
-            if len(self.__history.keys()) > 0:
-                for guild_id in self.__history.keys():
-                    await self.reset_history(guild_id)
-
-                self.__logger.info("cyclic history reset")
-                self.__last_activity = datetime.datetime.now()
+        # 最終アクティビティから一定時間経ったセッションの履歴をリセットしてメモリから外す
+        # 要約が有効な場合は履歴を要約に畳み込んでから消す
+        expired = self.__sessions.expire()
+        for (guild_id, channel_id), history in expired:
+            self.__expire_stored(guild_id, channel_id, history.turns())
+
+        if len(expired) > 0:
+            self.__logger.info(f"cyclic history reset sessions={len(expired)}")
+
+    def __expire_stored(self, guild_id: int, channel_id: int, turns: list) -> None:
+        """期限切れのセッションの履歴をストアから消す. 要約が有効な場合は履歴を要約に畳み込む"""
+        if self.config.bot.compaction:
+            self.__compaction.submit((guild_id, channel_id), turns)
+        else:
+            self.__store.save_summary(guild_id, channel_id, None)
+        self.__store.clear_turns(guild_id, channel_id)
 
     # メッセージ受信時実行
     @commands.Cog.listener()
@@ -443,23 +1384,85 @@ class BotCog(commands.Cog):
 
         if self.bot.user.id in [member.id for member in message.mentions]:
             try:
-                # 履歴リストの初期化
-                self.__history.setdefault(message.guild.id, copy.deepcopy(self.__init_message))
-                self.__token_ranking.setdefault(message.guild.id, {})
+                with self.__metrics.span("parse"):
+                    plane_message, reference_message, attatchments = await self.parse_message(message)
+            except Exception as e:
+                self.__logger.exception("error occured in gpt processing")
+                await message.channel.send(f"なんかエラー出た {e}")
+                return
+            await self.answer_mention(
+                message.guild.id, message.channel.id, message.author, plane_message, reference_message, attatchments, message.channel.send
+            )
+        return
 
+    async def answer_mention(
+        self,
+        guild_id: int,
+        channel_id: int,
+        author: discord.abc.Snowflake,
+        question: str,
+        reference: str | None,
+        attachments: list,
+        send: Callable[[str], Awaitable[discord.Message]],
+    ) -> None:
+        """メンションへの回答を生成してチャンネルに送信する
+
+        同じチャンネルに短時間に続いたメンションはまとめて1回で回答する.
+        処理中のメンションと同じ内容のものには回答しない
+
+        Args:
+            guild_id (int): サーバーID
+            channel_id (int): チャンネルID
+            author (discord.abc.Snowflake): 質問したユーザー
+            question (str): 入力テキスト
+            reference (str | None): 参照先テキスト
+            attachments (list): 添付ファイル
+            send (Callable[[str], Awaitable[discord.Message]]): 応答を送信する関数
+        """
+        mention = Mention(author, question, reference, attachments, send)
+        await self.__coalescer.submit((guild_id, channel_id), mention, mention.dedupe_key())
+
+    async def answer_mentions(self, key: SessionKey, mentions: list[Mention]) -> None:
+        """まとめたメンションに回答する"""
+        with self.__config.pin():
+            guild_id, channel_id = key
+            question, reference, attachments = merge_mentions(mentions)
+            # 発言者それぞれの使用量の上限で判定する
+            authors = list({mention.author.id: mention.author for mention in mentions}.values())
+            user_ids = [author.id for author in authors]
+            send = mentions[-1].send
+            if len(mentions) > 1:
+                self.__logger.info(f"[Coalesce] {len(mentions)} mentions guild={guild_id} channel={channel_id}")
+
+            reply = None
+            try:
                 # リクエスト
-                plane_message, reference_message, attatchments = await self.parse_message(message)
-                response, usage = await self.send_question_gpt(plane_message, reference_message, attatchments, message.guild.id)
+                if self.config.bot.stream_response:
+                    # プレースホルダーを送信し、受信した分から順に反映する
+                    reply = StreamingReply(send, self.config.bot.stream_edit_interval)
+                    with self.__metrics.span("discord_send"):
+                        await reply.start()
+                    response, usage = await self.send_question_gpt(question, reference, attachments, guild_id, channel_id, reply.feed, user_ids)
+                    with self.__metrics.span("discord_send"):
+                        await reply.finish()
+                else:
+                    response, usage = await self.send_question_gpt(question, reference, attachments, guild_id, channel_id, user_ids=user_ids)
 
-                # 履歴リスト更新
-                await self.token_ranking(message.guild.id, message.author, usage)
-                await self.delete_old_history(guild_id=message.guild.id)
-                await message.channel.send(response)
+                # 使用量は発言者で分ける
+                for index, member in enumerate(authors):
+                    await self.token_ranking(guild_id, member, usage // len(authors) + (usage % len(authors) if index == 0 else 0))
+                if reply is None:
+                    with self.__metrics.span("discord_send"):
+                        for chunk in split_message(response):
+                            await send(chunk)
+                self.record_first_reply()
 
             except Exception as e:
                 self.__logger.exception("error occured in gpt processing")
-                await message.channel.send(f"なんかエラー出た {e}")
-        return
+                if reply is not None:
+                    await reply.abort(f"なんかエラー出た {e}")
+                else:
+                    await send(f"なんかエラー出た {e}")
 
 
 async def setup(bot):
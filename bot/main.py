@@ -1,12 +1,37 @@
 import asyncio
+import json
+import multiprocessing
 import os
+import time
+from dataclasses import replace
+from pathlib import Path
+
+# 起動から最初の応答までの時間を計測するため最初に記録する
+STARTED_AT = time.monotonic()
 
 import discord
 from discord.ext import commands
 
+from utils.commandsync import CommandSyncer
+from utils.gateway import GatewayCog
+from utils.jobqueue import Job, JobQueue, LocalJobQueue, create_job_queue, partition_of
+
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-GUILD_ID_LIST = [id.strip() for id in os.getenv("GUILD_ID").split(",")]
+GUILD_ID_LIST = [int(id.strip()) for id in os.getenv("GUILD_ID").split(",")]
 PREFIX = os.getenv("BOT_PREFIX")
+# 前回同期したコマンドのハッシュ. 再ビルドしても引き継げるようにdata以下に置く
+COMMAND_SYNC_STATE = Path(__file__).resolve().parent / "data" / "command_sync.json"
+
+# single: 1プロセスで動かす
+# sharded: シャード化したゲートウェイからワーカーにジョブを渡す. キューがlocalならワーカーも起動する
+# worker: BOT_WORKER_ID番のワーカーだけを動かす. ゲートウェイとはRedisでつなぐ
+MODE = os.getenv("BOT_MODE", "single")
+WORKERS = int(os.getenv("BOT_WORKERS", "2"))
+WORKER_ID = int(os.getenv("BOT_WORKER_ID", "0"))
+JOB_QUEUE = os.getenv("BOT_JOB_QUEUE", "local")
+# 未指定ならDiscordの推奨シャード数. 複数のゲートウェイに分ける場合はBOT_SHARD_IDSで担当を指定する
+SHARD_COUNT = int(os.getenv("BOT_SHARD_COUNT")) if os.getenv("BOT_SHARD_COUNT") else None
+SHARD_IDS = [int(id.strip()) for id in os.getenv("BOT_SHARD_IDS").split(",")] if os.getenv("BOT_SHARD_IDS") else None
 
 print(GUILD_ID_LIST)
 
@@ -14,43 +39,180 @@ print(GUILD_ID_LIST)
 class DiscordBot(commands.Bot):
     """DiscordのBotを設定するクラス"""
 
-    def __init__(self, intents: discord.Intents, command_prefix: str, help_command=None):
-        super().__init__(intents=intents, command_prefix=command_prefix, help_command=help_command)
+    def __init__(self, intents: discord.Intents, command_prefix: str, help_command=None, **options):
+        super().__init__(intents=intents, command_prefix=command_prefix, help_command=help_command, **options)
+        self.started_at = STARTED_AT
+        self.__syncer = CommandSyncer(self.tree, COMMAND_SYNC_STATE)
+
+    async def cog_boot(self):
+        """Cogの読み込み処理\r\n
+        ./cogs内のファイルを名前順に読み込む
+        """
+        cogs_dir = Path(__file__).resolve().parent / "cogs"
+        for cog in sorted(os.listdir(cogs_dir)):
+            if cog.endswith(".py"):
+                await self.load_extension(f"cogs.{cog[:-3]}")
 
     async def sync_all_server(self):
-        """コマンドの同期処理"""
-        for id in GUILD_ID_LIST:
-            self.tree.copy_global_to(guild=discord.Object(id=id))
-            await self.tree.sync(guild=discord.Object(id=id))
+        """コマンドの同期処理. 前回から変更のあったサーバーだけ同期する"""
+        await self.__syncer.sync(GUILD_ID_LIST)
         print("sync")
 
     async def setup_hook(self):
         """Setup時に実行する処理"""
 
-        # Botコマンドの動機
+        # Cogの読み込み. コマンドが揃ってから同期する
+        await self.cog_boot()
+        # Botコマンドの同期
         await self.sync_all_server()
+        print(f"setup done in {time.monotonic() - self.started_at:.2f}s")
         return await super().setup_hook()
 
+    async def on_ready(self):
+        print(f"We have logged in as {self.user} ({time.monotonic() - self.started_at:.2f}s after start)")
+        await self.change_presence(activity=discord.Game(f"{PREFIX}help"))
 
-# Botインスタンス生成
-# DiscordBot側のIntentsの設定をすべてOnにしておく必要がある（面倒なので）
-intents = discord.Intents.all()
-bot = DiscordBot(intents=intents, command_prefix=PREFIX)
 
+class GatewayBot(DiscordBot, commands.AutoShardedBot):
+    """シャード構成のゲートウェイ. メンションとコマンドをワーカーに渡すだけで、履歴は持たない"""
+
+    def __init__(self, intents: discord.Intents, command_prefix: str, jobs: JobQueue, help_command=None, **options):
+        super().__init__(intents=intents, command_prefix=command_prefix, help_command=help_command, **options)
+        self.__jobs = jobs
+
+    async def cog_boot(self):
+        await self.add_cog(GatewayCog(self, self.__jobs))
+
+    async def close(self):
+        await super().close()
+        await self.__jobs.close()
 
-async def cog_boot():
-    """Cogの読み込み処理\r\n
-    ./cogs内のファイルを読み込む
-    """
-    asyncio.gather(*[bot.load_extension(f"cogs.{cog[:-3]}") for cog in os.listdir("cogs") if cog.endswith(".py")])
 
+class JobContext:
+    """ワーカーでコマンドを実行するためのContextの代わり. 応答はREST APIでチャンネルに送信する"""
 
-@bot.event
-async def on_ready():
-    print(f"We have logged in as {bot.user}")
-    await bot.change_presence(activity=discord.Game(f"{PREFIX}help"))
+    def __init__(self, bot: commands.Bot, job: Job, channel: discord.PartialMessageable, reply: bool = True) -> None:
+        self.bot = bot
+        self.guild = discord.Object(id=job.guild_id)
+        self.channel = channel
+        self.author = discord.Object(id=job.author_id)
+        self.__reply = reply
+
+    async def send(self, content: str | None = None, **kwargs) -> discord.Message | None:
+        # 受け付けた旨はゲートウェイが返しているため、ephemeralは扱わない
+        kwargs.pop("ephemeral", None)
+        if self.__reply:
+            return await self.channel.send(content, **kwargs)
+        return None
+
+    async def defer(self, **kwargs) -> None:
+        pass
+
+
+async def handle_job(bot: commands.Bot, cog, job: Job, reply: bool = True) -> None:
+    """ジョブを処理し、結果をREST APIでチャンネルに送信する
+
+    Args:
+        reply (bool): 結果を送信するか. 全ワーカーに配ったジョブは担当のワーカーだけが送信する
+    """
+    channel = bot.get_partial_messageable(job.channel_id, guild_id=job.guild_id)
+    author = discord.Object(id=job.author_id)
+    if job.kind == "mention":
+        await cog.answer_mention(job.guild_id, job.channel_id, author, job.text, job.reference, job.attachments, channel.send)
+    elif job.kind == "search":
+        await cog.answer_search(job.guild_id, job.channel_id, author, job.text, channel.send)
+    elif job.kind == "reset_history":
+        ret = await cog.reset_history(guild_id=job.guild_id, channel_id=job.channel_id)
+        await channel.send("会話履歴をリセットしました" if ret else "会話履歴のリセットに失敗しました")
+    elif job.kind == "reset_charactor":
+        ret = await cog.reset_charactor(guild_id=job.guild_id)
+        await channel.send("性格をリセットしました" if ret else "性格のリセットに失敗しました")
+    elif job.kind == "change_charactor":
+        ret = await cog.change_charactor(guild_id=job.guild_id, txt=job.text)
+        await channel.send("性格を変更しました" if ret else "性格の変更に失敗しました")
+    elif job.kind.startswith("batch_"):
+        try:
+            job_id = await cog.queue_batch(job.guild_id, channel, job.author_id, job.kind.removeprefix("batch_"), job.text)
+        except Exception as e:
+            await channel.send(f"なんかエラー出た {e}")
+        else:
+            await channel.send(f"バッチに追加しました (job {job_id[:8]}). 結果は後でこのチャンネルに送信します")
+    elif job.kind == "command":
+        request = json.loads(job.text)
+        command = bot.get_command(request["name"])
+        if command is None:
+            print(f"unknown command: {request['name']}")
+            return
+        await command.callback(cog, JobContext(bot, job, channel, reply), **request["args"])
+    else:
+        print(f"unknown job kind: {job.kind}")
+
+
+async def run_worker(worker_id: int, jobs: JobQueue) -> None:
+    """担当するサーバーのジョブを処理し続ける
+
+    ゲートウェイには接続せず、REST APIだけで応答を送る
+    """
+    from cogs.gpt import AppConfig, BotCog
+
+    def load_config(path: Path) -> AppConfig:
+        # ワーカーごとに別のポートでメトリクスを公開する
+        config = AppConfig.load(path)
+        return replace(config, metrics=replace(config.metrics, port=config.metrics.port + worker_id))
+
+    bot = commands.Bot(command_prefix=PREFIX, intents=discord.Intents.none(), help_command=None)
+    bot.started_at = STARTED_AT
+    bot.worker_id = worker_id
+    async with bot:
+        await bot.login(TOKEN)
+        cog = BotCog(bot, config_loader=load_config)
+        await bot.add_cog(cog)
+        cog.loop_reset.start()
+        cog.loop_batch.start()
+        print(f"worker {worker_id}/{jobs.partitions} ready in {time.monotonic() - STARTED_AT:.2f}s")
+
+        tasks: set[asyncio.Task] = set()
+        try:
+            while True:
+                job = await jobs.get(worker_id)
+                task = asyncio.create_task(handle_job(bot, cog, job, partition_of(job.guild_id, jobs.partitions) == worker_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await jobs.close()
+
+
+def worker_main(worker_id: int, jobs: JobQueue) -> None:
+    """ワーカープロセスのエントリーポイント"""
+    asyncio.run(run_worker(worker_id, jobs))
+
+
+def run_sharded() -> None:
+    jobs = create_job_queue(JOB_QUEUE, WORKERS)
+    workers = []
+    if isinstance(jobs, LocalJobQueue):
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=worker_main, args=(worker_id, jobs), daemon=True) for worker_id in range(jobs.partitions)]
+        for worker in workers:
+            worker.start()
+
+    bot = GatewayBot(intents=discord.Intents.all(), command_prefix=PREFIX, jobs=jobs, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+    try:
+        bot.run(TOKEN)
+    finally:
+        for worker in workers:
+            worker.terminate()
 
 
 if __name__ == "__main__":
-    asyncio.run(cog_boot())
-    bot.run(TOKEN)
+    if MODE == "sharded":
+        run_sharded()
+    elif MODE == "worker":
+        worker_main(WORKER_ID, create_job_queue(JOB_QUEUE, WORKERS))
+    else:
+        # Botインスタンス生成
+        # DiscordBot側のIntentsの設定をすべてOnにしておく必要がある（面倒なので）
+        intents = discord.Intents.all()
+        bot = DiscordBot(intents=intents, command_prefix=PREFIX)
+        bot.run(TOKEN)
@@ -0,0 +1,156 @@
+import json
+import logging
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+import openai
+
+from utils.store import BatchJob, ConversationStore
+
+ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# これ以上進まないバッチの状態. expiredの場合も完了した分の結果は取得できる
+FINISHED_STATUSES = frozenset({"completed", "failed", "expired", "cancelled"})
+
+
+@dataclass
+class BatchResult:
+    """ジョブ1件の結果"""
+
+    job: BatchJob
+    content: str | None
+    error: str | None = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class BatchRunner:
+    """急がないジョブをBatch APIでまとめて処理する
+
+    submit() で積んだジョブを flush() でJSONLファイルにまとめて送信し、
+    poll() で終わったバッチの結果を取り出し、届けた後に complete() で削除する. ジョブはストアに保存するため、再起動しても送信済みのバッチを追える.
+    ストアを共有する複数のワーカーでは owner に自分の番号を渡し、自分が積んだジョブだけを扱う
+    """
+
+    def __init__(self, client: openai.AsyncOpenAI, store: ConversationStore, max_jobs: int = 1000, owner: int = 0) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__client = client
+        self.__store = store
+        self.max_jobs = max_jobs
+        self.owner = owner
+        # 追加順
+        self.__jobs: Dict[str, BatchJob] = {}
+        self.submitted = 0
+        self.delivered = 0
+
+    async def open(self) -> None:
+        """ストアから自分が積んだ未完了のジョブを読み込む"""
+        for job in await self.__store.load_batch_jobs(self.owner):
+            self.__jobs[job.job_id] = job
+        if len(self.__jobs) > 0:
+            self.__logger.info(f"[Batch] restored {len(self.__jobs)} jobs ({len(self.in_flight())} batches in flight)")
+
+    def pending(self) -> List[BatchJob]:
+        """未送信のジョブ"""
+        return [job for job in self.__jobs.values() if job.batch_id is None]
+
+    def in_flight(self) -> List[str]:
+        """結果待ちのバッチID"""
+        return list(dict.fromkeys(job.batch_id for job in self.__jobs.values() if job.batch_id is not None))
+
+    def submit(self, guild_id: int, channel_id: int, author_id: int, body: Dict[str, Any]) -> BatchJob:
+        """ジョブを積む. 次の flush() で送信する
+
+        Args:
+            body (Dict[str, Any]): Chat Completions APIのリクエストボディ
+        """
+        job = BatchJob(uuid.uuid4().hex, guild_id, channel_id, author_id, body, owner=self.owner)
+        self.__jobs[job.job_id] = job
+        self.__store.add_batch_job(job)
+        return job
+
+    async def flush(self) -> List[str]:
+        """未送信のジョブをバッチとして送信する
+
+        Returns:
+            List[str]: 作成したバッチID
+        """
+        pending = self.pending()
+        batch_ids = []
+        for start in range(0, len(pending), self.max_jobs):
+            jobs = pending[start : start + self.max_jobs]
+            lines = [json.dumps({"custom_id": job.job_id, "method": "POST", "url": ENDPOINT, "body": job.body}, ensure_ascii=False) for job in jobs]
+            file = await self.__client.files.create(file=(f"batch_{uuid.uuid4().hex}.jsonl", ("\n".join(lines) + "\n").encode()), purpose="batch")
+            batch = await self.__client.batches.create(input_file_id=file.id, endpoint=ENDPOINT, completion_window=COMPLETION_WINDOW)
+
+            for job in jobs:
+                job.batch_id = batch.id
+            self.__store.mark_batch_submitted([job.job_id for job in jobs], batch.id)
+            # 再起動で送信済みのバッチを見失わないようにすぐ書き込む
+            await self.__store.flush()
+            self.submitted += len(jobs)
+            batch_ids.append(batch.id)
+            self.__logger.info(f"[Batch] submitted {batch.id} jobs={len(jobs)}")
+        return batch_ids
+
+    async def poll(self) -> List[BatchResult]:
+        """結果待ちのバッチの状態を確認し、終わったものの結果を返す
+
+        バッチごとに取得し、失敗したバッチは次の poll() で取得し直す.
+        ジョブは結果を届けた後に complete() で削除するまで残す
+        """
+        results = []
+        for batch_id in self.in_flight():
+            try:
+                results += await self.__collect(batch_id)
+            except Exception:
+                self.__logger.exception(f"[Batch] failed to collect {batch_id}")
+        return results
+
+    def complete(self, results: List[BatchResult]) -> None:
+        """結果を届けたジョブを削除する"""
+        jobs = [result.job for result in results if result.job.job_id in self.__jobs]
+        for job in jobs:
+            del self.__jobs[job.job_id]
+        self.__store.delete_batch_jobs([job.job_id for job in jobs])
+        self.delivered += len(jobs)
+
+    async def __collect(self, batch_id: str) -> List[BatchResult]:
+        """終わったバッチのジョブの結果. 終わっていなければ空"""
+        batch = await self.__client.batches.retrieve(batch_id)
+        if batch.status not in FINISHED_STATUSES:
+            return []
+
+        outputs: Dict[str, BatchResult] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is not None:
+                content = await self.__client.files.content(file_id)
+                for line in content.text.splitlines():
+                    if line.strip():
+                        result = self.__parse_line(json.loads(line))
+                        outputs[result[0]] = result[1]
+
+        results = []
+        for job in [job for job in self.__jobs.values() if job.batch_id == batch_id]:
+            output = outputs.get(job.job_id)
+            if output is None:
+                results.append(BatchResult(job, None, f"batch {batch.status}"))
+            else:
+                output.job = job
+                results.append(output)
+        self.__logger.info(f"[Batch] {batch.status} {batch_id} jobs={len(results)} errors={sum(1 for result in results if result.error is not None)}")
+        return results
+
+    @staticmethod
+    def __parse_line(line: Dict[str, Any]) -> tuple[str, BatchResult]:
+        """出力ファイルの1行を (ジョブID, 結果) にする. ジョブは呼び出し側で埋める"""
+        response = line.get("response")
+        if line.get("error") is None and response is not None and response.get("status_code") == 200:
+            body = response["body"]
+            usage = body.get("usage") or {}
+            content = body["choices"][0]["message"]["content"]
+            return line["custom_id"], BatchResult(None, content, None, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
+        error = line.get("error") or (response or {}).get("body", {}).get("error") or {}
+        return line["custom_id"], BatchResult(None, None, error.get("message", "unknown error"))
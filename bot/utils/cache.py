@@ -0,0 +1,73 @@
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def _normalize(content) -> object:
+    """キャッシュキー用に空白の違いを吸収する"""
+    if isinstance(content, str):
+        return WHITESPACE_PATTERN.sub(" ", content).strip()
+    return [
+        _normalize(part["text"]) if part.get("type") == "text" else part.get("image_url", {}).get("url")
+        for part in content
+    ]
+
+
+class ResponseCache:
+    """同じ入力への応答を再利用するためのキャッシュ
+
+    有効期限付きで、件数の上限を超えたら最も使われていないものから削除する
+    """
+
+    def __init__(self, max_entries: int, context_window: int) -> None:
+        self.max_entries = max_entries
+        self.context_window = context_window
+        # キー -> (有効期限, 応答)
+        self.__entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def make_key(self, kind: str, model: str, temperature: float, messages: list[dict]) -> str:
+        """キャッシュキーを作る
+
+        システムプロンプトと、末尾 context_window 件の会話をキーに含める.
+        context_window が0以下でも今回の入力である最後の1件は必ず含める
+
+        Args:
+            kind (str): リクエストの種類("chat", "search")
+            model (str): モデル名
+            temperature (float): temperature
+            messages (list[dict]): 送信するメッセージ
+        """
+        system = [_normalize(message["content"]) for message in messages if message["role"] == "system"]
+        turns = [message for message in messages if message["role"] != "system"][-max(1, self.context_window) :]
+        payload = [kind, model, temperature, system, [(message["role"], _normalize(message["content"])) for message in turns]]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self.__entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.__entries[key]
+            self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, response: str, ttl: float) -> None:
+        self.__entries[key] = (time.monotonic() + ttl, response)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.__entries.clear()
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Generic, List, TypeVar
+
+from utils.session import SessionKey
+
+T = TypeVar("T")
+
+
+@dataclass
+class Mention:
+    """まとめる前のメンション1件"""
+
+    author: Any
+    question: str
+    reference: str | None
+    attachments: List[str]
+    send: Callable[[str], Awaitable[Any]]
+
+    @property
+    def author_name(self) -> str:
+        return getattr(self.author, "display_name", None) or f"<@{self.author.id}>"
+
+    def dedupe_key(self) -> str:
+        """同じ内容の入力を同じとみなすためのキー. 空白の違いは無視する"""
+        return "\n".join([" ".join(self.question.split()), self.reference or "", *self.attachments])
+
+
+def merge_mentions(mentions: List[Mention]) -> tuple[str, str | None, List[str]]:
+    """複数のメンションを発言者付きの1つの入力にまとめる
+
+    Returns:
+        tuple[str, str | None, List[str]]: 入力, 参照, 添付ファイルのリスト
+    """
+    if len(mentions) == 1:
+        return mentions[0].question, mentions[0].reference, mentions[0].attachments
+
+    question = "\n".join(f"{mention.author_name}: {mention.question}" for mention in mentions)
+    references = [f"{mention.author_name}: {mention.reference}" for mention in mentions if mention.reference is not None]
+    attachments = [url for mention in mentions for url in mention.attachments]
+    return question, "\n".join(references) if len(references) > 0 else None, attachments
+
+
+@dataclass
+class _Lane(Generic[T]):
+    """チャンネルごとの待ち行列"""
+
+    # (受け付けた時刻, 入力, 完了を通知するFuture)
+    pending: List[tuple[float, T, asyncio.Future]] = field(default_factory=list)
+    # 重複判定のキー -> 処理が終わるまでのFuture
+    inflight: Dict[str, asyncio.Future] = field(default_factory=dict)
+    task: asyncio.Task | None = None
+
+
+class MentionCoalescer(Generic[T]):
+    """短時間に続いたメンションをまとめて1回のリクエストにする
+
+    チャンネルで処理中のものが無ければ入力をすぐに handler に渡す. 処理中に届いた入力は積んでおき、
+    処理が終わった後に最も古い入力から window 秒経つまで待ってまとめて渡す. 単発のメンションは待たされない.
+    handler はチャンネルごとに1つずつ順番に実行するため、応答の順序が入れ替わらない.
+    処理中の入力と同じ内容の入力は新たに積まず、同じFutureを返す
+    """
+
+    def __init__(self, window: float, handler: Callable[[SessionKey, List[T]], Awaitable[None]], max_batch: int = 8) -> None:
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.__handler = handler
+        self.__lanes: Dict[SessionKey, _Lane[T]] = {}
+        self.submitted = 0
+        self.batches = 0
+        self.deduplicated = 0
+
+    def submit(self, key: SessionKey, item: T, dedupe_key: str) -> asyncio.Future:
+        """入力を積む
+
+        Args:
+            key (SessionKey): セッション
+            item (T): 入力
+            dedupe_key (str): 重複判定のキー. 処理中の入力と同じなら新たに積まない
+
+        Returns:
+            asyncio.Future: 入力を含むまとまりの処理が終わると完了する
+        """
+        lane = self.__lanes.get(key)
+        if lane is None:
+            lane = _Lane()
+            self.__lanes[key] = lane
+
+        self.submitted += 1
+        future = lane.inflight.get(dedupe_key)
+        if future is not None:
+            self.deduplicated += 1
+            return future
+
+        future = asyncio.get_running_loop().create_future()
+        lane.pending.append((time.monotonic(), item, future))
+        lane.inflight[dedupe_key] = future
+        # 完了したら重複判定から外す
+        future.add_done_callback(lambda _: lane.inflight.pop(dedupe_key, None))
+        if lane.task is None:
+            lane.task = asyncio.create_task(self.__drain(key, lane))
+        return future
+
+    async def __drain(self, key: SessionKey, lane: _Lane[T]) -> None:
+        busy = False
+        try:
+            while len(lane.pending) > 0:
+                # 処理中に届いた入力は最も古いものから window 秒経つまで待つ. 前のまとまりの処理中に経っていれば待たない
+                delay = lane.pending[0][0] + self.window - time.monotonic()
+                if busy and delay > 0 and len(lane.pending) < self.max_batch:
+                    await asyncio.sleep(delay)
+                busy = True
+                batch, lane.pending = lane.pending[: self.max_batch], lane.pending[self.max_batch :]
+
+                self.batches += 1
+                try:
+                    await self.__handler(key, [item for _, item, _ in batch])
+                except asyncio.CancelledError:
+                    for _, _, future in batch:
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    for _, _, future in batch:
+                        if future.done() is False:
+                            future.set_exception(e)
+                else:
+                    for _, _, future in batch:
+                        if future.done() is False:
+                            future.set_result(None)
+        finally:
+            lane.task = None
+            if len(lane.pending) == 0:
+                self.__lanes.pop(key, None)
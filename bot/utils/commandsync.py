@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import discord
+from discord import app_commands
+
+
+def tree_hash(tree: app_commands.CommandTree, guild: discord.abc.Snowflake) -> str:
+    """サーバーに同期されるコマンド定義のハッシュ
+
+    tree.syncが送るものと同じペイロードから計算する
+    """
+    payload = sorted((command.to_dict() for command in tree.get_commands(guild=guild)), key=lambda command: (command["type"], command["name"]))
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+class RateLimiter:
+    """同時実行数と開始間隔を制限する"""
+
+    def __init__(self, concurrency: int, interval: float) -> None:
+        self.interval = interval
+        self.__semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.__lock = asyncio.Lock()
+        self.__next_start = 0.0
+
+    async def __aenter__(self) -> None:
+        await self.__semaphore.acquire()
+        async with self.__lock:
+            delay = self.__next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.__next_start = time.monotonic() + self.interval
+
+    async def __aexit__(self, *exc) -> None:
+        self.__semaphore.release()
+
+
+class CommandSyncer:
+    """スラッシュコマンドをサーバーごとに同期する
+
+    前回同期したコマンド定義のハッシュをファイルに保存し、変わっていないサーバーは同期しない.
+    同期が必要なサーバーはRateLimiterの範囲で並列に同期する
+    """
+
+    def __init__(self, tree: app_commands.CommandTree, state_path: Path, concurrency: int = 4, interval: float = 0.5) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__tree = tree
+        self.__state_path = state_path
+        self.__limiter = RateLimiter(concurrency, interval)
+
+    def __load_state(self) -> Dict[str, str]:
+        try:
+            with open(self.__state_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def __save_state(self, state: Dict[str, str]) -> None:
+        self.__state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.__state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        tmp_path.replace(self.__state_path)
+
+    async def __sync_guild(self, guild: discord.Object) -> None:
+        async with self.__limiter:
+            start = time.perf_counter()
+            await self.__tree.sync(guild=guild)
+            self.__logger.info(f"synced guild={guild.id} in {time.perf_counter() - start:.2f}s")
+
+    async def sync(self, guild_ids: List[int], force: bool = False) -> List[int]:
+        """グローバルコマンドを各サーバーにコピーし、変更があったサーバーだけ同期する
+
+        Args:
+            guild_ids (List[int]): サーバーID
+            force (bool): Trueの場合はハッシュに関わらず同期する
+
+        Returns:
+            List[int]: 同期したサーバーID
+        """
+        state = self.__load_state()
+        pending: Dict[int, str] = {}
+        for guild_id in guild_ids:
+            guild = discord.Object(id=guild_id)
+            self.__tree.copy_global_to(guild=guild)
+            digest = tree_hash(self.__tree, guild)
+            if force or state.get(str(guild_id)) != digest:
+                pending[guild_id] = digest
+
+        results = await asyncio.gather(*[self.__sync_guild(discord.Object(id=guild_id)) for guild_id in pending], return_exceptions=True)
+        synced = []
+        for (guild_id, digest), result in zip(pending.items(), results):
+            if isinstance(result, BaseException):
+                # 失敗したサーバーは次回の起動で再同期する
+                self.__logger.error(f"failed to sync guild={guild_id}", exc_info=result)
+                state.pop(str(guild_id), None)
+            else:
+                state[str(guild_id)] = digest
+                synced.append(guild_id)
+        self.__save_state(state)
+        self.__logger.info(f"command sync: {len(synced)} synced, {len(guild_ids) - len(pending)} unchanged, {len(pending) - len(synced)} failed")
+        return synced
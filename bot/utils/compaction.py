@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List
+
+import openai
+from openai.types import CompletionUsage
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a Discord conversation with an assistant. "
+    "Merge the previous summary and the new messages into one updated summary. "
+    "Keep names, facts, decisions, open questions and the users' preferences. "
+    "Drop greetings and small talk. Write in the language of the conversation, as concise bullet points."
+)
+
+
+def _format_turn(message: dict) -> str:
+    content = message["content"]
+    if not isinstance(content, str):
+        # 画像は要約に含めない
+        content = " ".join(part["text"] for part in content if part.get("type") == "text")
+    return f"{message['role']}: {content}"
+
+
+class Summarizer:
+    """履歴から溢れたメッセージを要約に畳み込む"""
+
+    def __init__(self, client: openai.AsyncOpenAI, model: str, max_tokens: int) -> None:
+        self.__client = client
+        self.model = model
+        self.max_tokens = max_tokens
+
+    async def summarize(self, previous: str | None, turns: List[dict]) -> tuple[str, CompletionUsage]:
+        """要約を更新する
+
+        Args:
+            previous (str | None): これまでの要約
+            turns (List[dict]): 要約に追加するメッセージ
+
+        Returns:
+            tuple[str, CompletionUsage]: 更新後の要約, 消費トークン数
+        """
+        transcript = "\n".join(_format_turn(turn) for turn in turns)
+        response = await self.__client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTION},
+                {"role": "user", "content": f"## Previous summary\n{previous or '(none)'}\n\n## New messages\n{transcript}"},
+            ],
+            max_tokens=self.max_tokens,
+            temperature=0.2,
+        )
+        return str(response.choices[0].message.content).strip(), response.usage
+
+
+class CompactionQueue:
+    """セッションごとに要約処理をバックグラウンドで直列に実行する
+
+    要約中に追加で溢れたメッセージは次の要約にまとめる
+    """
+
+    def __init__(self, run: Callable[[Hashable, List[dict]], Awaitable[None]]) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__run = run
+        self.__pending: Dict[Hashable, List[dict]] = {}
+        self.__tasks: Dict[Hashable, asyncio.Task] = {}
+
+    def submit(self, key: Hashable, turns: List[dict]) -> None:
+        """要約するメッセージを追加する"""
+        if len(turns) == 0:
+            return
+        self.__pending.setdefault(key, []).extend(turns)
+        if key not in self.__tasks:
+            self.__tasks[key] = asyncio.create_task(self.__worker(key))
+
+    def discard(self, key: Hashable) -> None:
+        """未処理のメッセージを破棄する"""
+        self.__pending.pop(key, None)
+
+    async def __worker(self, key: Hashable) -> None:
+        try:
+            while len(self.__pending.get(key, [])) > 0:
+                turns = self.__pending.pop(key)
+                try:
+                    await self.__run(key, turns)
+                except Exception:
+                    self.__logger.exception(f"compaction failed session={key}")
+        finally:
+            del self.__tasks[key]
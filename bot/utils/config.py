@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Generic, Iterator, List, TypeVar
+
+T = TypeVar("T")
+
+
+class ConfigService(Generic[T]):
+    """設定のスナップショットを管理する
+
+    設定ファイルの更新時刻を監視し、変更があれば読み込んで検証してから丸ごと差し替える.
+    スナップショットは変更できないため、pin() したリクエストは最後まで同じ設定を見る
+    """
+
+    def __init__(self, initial: T, path: Path | None = None, loader: Callable[[Path], T] | None = None, interval: float = 2.0) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__current = initial
+        self.__path = path
+        self.__loader = loader
+        self.interval = interval
+        self.__pinned: contextvars.ContextVar[T | None] = contextvars.ContextVar(f"config_{id(self)}", default=None)
+        self.__subscribers: List[Callable[[T], None]] = []
+        self.__validators: List[Callable[[T, T], None]] = []
+        self.__stat = self.__file_stat()
+        self.__task: asyncio.Task | None = None
+        self.reloads = 0
+
+    @property
+    def current(self) -> T:
+        """最新のスナップショット"""
+        return self.__current
+
+    def snapshot(self) -> T:
+        """pin() 中ならその時のスナップショット、そうでなければ最新のもの"""
+        pinned = self.__pinned.get()
+        return pinned if pinned is not None else self.__current
+
+    @contextmanager
+    def pin(self) -> Iterator[T]:
+        """ブロック内(とそこから作ったタスク)で使う設定を現在のスナップショットに固定する"""
+        token = self.__pinned.set(self.snapshot())
+        try:
+            yield self.__pinned.get()
+        finally:
+            self.__pinned.reset(token)
+
+    def subscribe(self, callback: Callable[[T], None]) -> None:
+        """差し替え時に新しいスナップショットで呼び出す"""
+        self.__subscribers.append(callback)
+
+    def add_validator(self, callback: Callable[[T, T], None]) -> None:
+        """差し替え前に (現在のスナップショット, 新しいスナップショット) で呼び出す. ValueErrorを送出すると差し替えない"""
+        self.__validators.append(callback)
+
+    def update(self, config: T) -> None:
+        """スナップショットを差し替える
+
+        Raises:
+            ValueError: 検証で拒否された場合. 現在の設定はそのまま
+        """
+        for validator in self.__validators:
+            validator(self.__current, config)
+        self.__current = config
+        for callback in self.__subscribers:
+            try:
+                callback(config)
+            except Exception:
+                self.__logger.exception("config subscriber failed")
+
+    def reload(self) -> T:
+        """設定ファイルから読み込み直す
+
+        Raises:
+            ValueError: 設定ファイルが無い、または内容が不正な場合. 現在の設定はそのまま
+        """
+        if self.__path is None or self.__loader is None:
+            raise ValueError("config file is not set")
+        self.__stat = self.__file_stat()
+        try:
+            config = self.__loader(self.__path)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f"failed to load {self.__path}: {e}") from e
+        self.update(config)
+        self.reloads += 1
+        self.__logger.info(f"config reloaded from {self.__path}")
+        return config
+
+    def start(self) -> None:
+        """設定ファイルの監視を始める"""
+        if self.__task is None and self.__path is not None:
+            self.__task = asyncio.create_task(self.__watch())
+
+    async def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    def __file_stat(self) -> tuple[int, int] | None:
+        if self.__path is None:
+            return None
+        try:
+            stat = os.stat(self.__path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def __watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.__file_stat() == self.__stat:
+                continue
+            try:
+                self.reload()
+            except ValueError:
+                # 書きかけや不正な内容の場合は今の設定を使い続ける
+                self.__logger.exception("config reload failed, keeping the current config")
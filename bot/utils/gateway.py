@@ -0,0 +1,121 @@
+import json
+import logging
+from typing import Literal
+
+import discord
+from discord.ext import commands
+
+from utils import parser
+from utils.jobqueue import Job, JobQueue
+
+ACCEPTED = "受け付けました"
+
+
+class GatewayCog(commands.Cog):
+    """シャード構成のゲートウェイ側Cog
+
+    メンションとBotCogの全コマンドをジョブにしてワーカーに渡す.
+    履歴や使用量はワーカーが持つため、ここでは入力の解析だけ行う
+    """
+
+    def __init__(self, bot: commands.Bot, jobs: JobQueue) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.bot = bot
+        self.__jobs = jobs
+
+    async def __forward(self, ctx: commands.context.Context, kind: str, text: str = "", broadcast: bool = False) -> None:
+        job = Job(kind, ctx.guild.id, ctx.channel.id, ctx.author.id, text)
+        if broadcast:
+            await self.__jobs.broadcast(job)
+        else:
+            await self.__jobs.put(job)
+        # 結果はワーカーがチャンネルに送信する
+        await ctx.send(ACCEPTED, ephemeral=True)
+
+    async def __forward_command(self, ctx: commands.context.Context, name: str, broadcast: bool = False, **args) -> None:
+        """ワーカーのBotCogの同名のコマンドを実行させる. broadcastの場合は全ワーカーで実行し、担当のワーカーだけが応答する"""
+        await self.__forward(ctx, "command", json.dumps({"name": name, "args": args}, ensure_ascii=False), broadcast)
+
+    @commands.hybrid_command(name="reset_h", brief="このチャンネルの会話履歴をリセットする. 60分発言が無ければ自動実行")
+    async def reset_h(self, ctx):
+        await self.__forward(ctx, "reset_history")
+
+    @commands.hybrid_command(name="reset_c", brief="性格を初期化する")
+    async def reset_c(self, ctx):
+        await self.__forward(ctx, "reset_charactor")
+
+    @commands.hybrid_command(name="chara", brief="引数で入力した文を性格として設定する")
+    async def change(self, ctx: commands.context.Context, text):
+        await self.__forward(ctx, "change_charactor", text)
+
+    @commands.hybrid_command(name="search", brief="[beta]Web検索を使用して回答")
+    async def web_search_question(self, ctx: commands.context.Context, input: str):
+        await self.__forward(ctx, "search", input)
+
+    @commands.hybrid_command(name="batch", brief="急がない処理をまとめて安く実行. 結果は後でこのチャンネルに送信")
+    async def batch(self, ctx: commands.context.Context, kind: Literal["prompt", "summary", "translate"], text: str = ""):
+        await self.__forward(ctx, f"batch_{kind}", text)
+
+    @commands.hybrid_command(name="ranking", brief="トークン使用量ランキグン")
+    async def ranking(self, ctx):
+        await self.__forward_command(ctx, "ranking")
+
+    @commands.hybrid_command(name="info", brief="現在の設定を出力")
+    async def check_setting(self, ctx):
+        await self.__forward_command(ctx, "info")
+
+    @commands.hybrid_command(name="stats", brief="処理段階ごとの時間とトークン使用量を出力")
+    async def stats(self, ctx):
+        await self.__forward_command(ctx, "stats")
+
+    @commands.hybrid_command(name="change_config", brief="設定を変更")
+    async def change_setting(
+        self,
+        ctx: commands.context.Context,
+        input_highreso_img: bool | None,
+        save_image_input: bool | None,
+        save_response: bool | None,
+        history_size: int | None,
+        model: str | None = None,
+        max_token: int | None = None,
+    ):
+        # 設定はワーカーごとに持つため全ワーカーで変更する
+        await self.__forward_command(
+            ctx,
+            "change_config",
+            broadcast=True,
+            input_highreso_img=input_highreso_img,
+            save_image_input=save_image_input,
+            save_response=save_response,
+            history_size=history_size,
+            model=model,
+            max_token=max_token,
+        )
+
+    @commands.hybrid_command(name="reset_config", brief="設定をリセット yamlから再読み込み")
+    async def reset_setting(self, ctx):
+        await self.__forward_command(ctx, "reset_config", broadcast=True)
+
+    @commands.hybrid_command(name="history", brief="対話履歴を出力")
+    async def check_history(self, ctx):
+        await self.__forward_command(ctx, "history")
+
+    @commands.hybrid_command(name="help", brief="help")
+    async def help(self, ctx: commands.context.Context, args=None):
+        await self.__forward_command(ctx, "help", args=args)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.message.Message):
+        # Bot自身からの入力なら無視
+        if message.author == self.bot.user:
+            return
+
+        if self.bot.user.id in [member.id for member in message.mentions]:
+            try:
+                plane_message, reference_message, attatchments = parser.parse_message(message)
+                await self.__jobs.put(
+                    Job("mention", message.guild.id, message.channel.id, message.author.id, plane_message, reference_message, attatchments)
+                )
+            except Exception as e:
+                self.__logger.exception("error occured in forwarding mention")
+                await message.channel.send(f"なんかエラー出た {e}")
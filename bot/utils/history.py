@@ -0,0 +1,317 @@
+from collections import deque
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+from itertools import chain
+from types import MappingProxyType
+from typing import Any, Deque, Iterable, Iterator
+
+import tiktoken
+
+# メッセージ1件あたりの固定オーバーヘッド(role等)
+MESSAGE_OVERHEAD = 3
+# 応答の開始に付与されるトークン数
+REPLY_PRIMER = 3
+# 画像1枚あたりの見積もりトークン数
+IMAGE_TOKENS_LOW = 85
+IMAGE_TOKENS_HIGH = 765
+# 要約をプロンプトに入れる際の見出し
+SUMMARY_HEADER = "## これまでの会話の要約\n"
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+class TokenCounter:
+    """ローカルのトークナイザでトークン数を数える"""
+
+    def __init__(self, model: str) -> None:
+        self.__encoding = _encoding(model)
+
+    def set_model(self, model: str) -> None:
+        """トークナイザを変更する. 数え済みのメッセージのトークン数はそのまま"""
+        self.__encoding = _encoding(model)
+
+    def count_text(self, text: str) -> int:
+        return len(self.__encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: Mapping) -> int:
+        """メッセージ1件のトークン数
+
+        Args:
+            message (Mapping): {"role": ..., "content": ...} 形式のメッセージ
+
+        Returns:
+            int: トークン数
+        """
+        content = message["content"]
+        if isinstance(content, str):
+            return MESSAGE_OVERHEAD + self.count_text(content)
+
+        tokens = MESSAGE_OVERHEAD
+        for part in content:
+            if part.get("type") == "text":
+                tokens += self.count_text(part["text"])
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS_LOW if part["image_url"].get("detail") == "low" else IMAGE_TOKENS_HIGH
+        return tokens
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: _freeze(val) for key, val in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(val) for val in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    if isinstance(value, Mapping):
+        return {key: _thaw(val) for key, val in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(val) for val in value]
+    return value
+
+
+class Turn(Mapping):
+    """履歴のメッセージ1件. 作成後は変更できない
+
+    {"role": ..., "content": ...} のMappingとしてそのままAPIに渡せる
+    """
+
+    __slots__ = ("__role", "__content", "__tokens")
+
+    def __init__(self, role: str, content: str | Sequence, tokens: int) -> None:
+        object.__setattr__(self, "_Turn__role", role)
+        object.__setattr__(self, "_Turn__content", content if isinstance(content, str) else _freeze(content))
+        object.__setattr__(self, "_Turn__tokens", tokens)
+
+    @classmethod
+    def from_message(cls, message: Mapping, counter: TokenCounter) -> "Turn":
+        if isinstance(message, Turn):
+            return message
+        return cls(message["role"], message["content"], counter.count_message(message))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("Turn is immutable")
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "role":
+            return self.__role
+        if key == "content":
+            return self.__content
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(("role", "content"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def __repr__(self) -> str:
+        return f"Turn(role={self.__role!r}, content={self.__content!r}, tokens={self.__tokens})"
+
+    @property
+    def role(self) -> str:
+        return self.__role
+
+    @property
+    def content(self) -> str | tuple:
+        return self.__content
+
+    @property
+    def tokens(self) -> int:
+        return self.__tokens
+
+    def to_dict(self) -> dict:
+        """変更可能なdictに変換する"""
+        return {"role": self.__role, "content": _thaw(self.__content)}
+
+
+def to_payload(messages: Iterable[Mapping]) -> list[dict]:
+    """APIに渡すためにメッセージ列をdictのlistに変換する
+
+    SDKはlistで型付けされた引数(Responses APIのinputなど)を変換せずにJSONにするため、
+    TurnやPromptViewのままでは送れない
+    """
+    return [_thaw(message) for message in messages]
+
+
+class PromptView(Sequence):
+    """APIに送るメッセージ列
+
+    システムプロンプト・要約, 履歴, その回だけ送るメッセージ(画像など)を連結して見せる.
+    メッセージ自体はコピーせず参照を持つ
+    """
+
+    __slots__ = ("__head", "__turns", "__tail")
+
+    def __init__(self, head: tuple, turns: tuple, tail: tuple = ()) -> None:
+        self.__head = head
+        self.__turns = turns
+        self.__tail = tail
+
+    def __len__(self) -> int:
+        return len(self.__head) + len(self.__turns) + len(self.__tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        for part in (self.__head, self.__turns, self.__tail):
+            if 0 <= index < len(part):
+                return part[index]
+            index -= len(part)
+        raise IndexError(index)
+
+    def __iter__(self) -> Iterator[Mapping]:
+        return chain(self.__head, self.__turns, self.__tail)
+
+    def with_tail(self, tail: list[Mapping]) -> "PromptView":
+        """末尾にその回だけ送るメッセージを加える"""
+        return PromptView(self.__head, self.__turns, self.__tail + tuple(tail))
+
+
+class SystemPrompt:
+    """サーバーのシステムプロンプト. 同じサーバーのセッションで共有する"""
+
+    def __init__(self, text: str, counter: TokenCounter) -> None:
+        self.__counter = counter
+        self.set(text)
+
+    def set(self, text: str) -> None:
+        self.message = Turn.from_message({"role": "system", "content": text}, self.__counter)
+
+    @property
+    def tokens(self) -> int:
+        return self.message.tokens
+
+
+class SessionHistory:
+    """チャンネルごとの対話履歴
+
+    各メッセージのトークン数をキャッシュし、上限を超えた古い履歴から削除する
+    """
+
+    def __init__(self, system: SystemPrompt, counter: TokenCounter) -> None:
+        self.__counter = counter
+        self.__system = system
+        self.__turns: Deque[Turn] = deque()
+        self.__turn_tokens = 0
+        self.set_summary(None)
+        self.predicted_tokens = 0
+
+    @property
+    def system(self) -> Turn:
+        return self.__system.message
+
+    @property
+    def summary(self) -> str | None:
+        return self.__summary
+
+    @property
+    def prompt_tokens(self) -> int:
+        """システムプロンプト・要約・履歴を合わせたトークン数"""
+        return self.__system.tokens + self.__summary_tokens + self.__turn_tokens + REPLY_PRIMER
+
+    @property
+    def base_tokens(self) -> int:
+        """履歴を全て削除しても残るトークン数(システムプロンプト・要約)"""
+        return self.__system.tokens + self.__summary_tokens + REPLY_PRIMER
+
+    def __len__(self) -> int:
+        return len(self.__turns)
+
+    def set_summary(self, text: str | None) -> None:
+        """履歴から溢れた会話の要約を設定する. Noneで削除"""
+        self.__summary = text
+        if text is None:
+            self.__summary_message = None
+            self.__summary_tokens = 0
+        else:
+            self.__summary_message = Turn.from_message({"role": "system", "content": SUMMARY_HEADER + text}, self.__counter)
+            self.__summary_tokens = self.__summary_message.tokens
+
+    def append(self, message: Mapping) -> Turn:
+        """履歴の末尾にメッセージを追加する
+
+        Returns:
+            Turn: 追加したメッセージ
+        """
+        turn = Turn.from_message(message, self.__counter)
+        self.__turns.append(turn)
+        self.__turn_tokens += turn.tokens
+        return turn
+
+    def clear(self) -> None:
+        self.__turns.clear()
+        self.__turn_tokens = 0
+
+    def turns(self) -> list[Turn]:
+        return list(self.__turns)
+
+    def messages(self) -> PromptView:
+        """APIに送るメッセージ列
+
+        システムプロンプト, 要約, 履歴の順に並べる.
+        履歴はこの時点のものを参照するため、送信中に履歴が変わっても影響しない
+        """
+        if self.__summary_message is None:
+            head = (self.__system.message,)
+        else:
+            head = (self.__system.message, self.__summary_message)
+        return PromptView(head, tuple(self.__turns))
+
+    def predict(self, max_turns: int, token_budget: int, reserved: int = 0, trim_ratio: float = 0.0, incoming: Sequence[Turn] = ()) -> int:
+        """incoming を追加して fit() した後のプロンプトのトークン数. 履歴は変更しない
+
+        Args:
+            incoming (Sequence[Turn]): これから追加するメッセージ. 削除されないものとして数える
+        """
+        return self.__plan(max_turns, token_budget, reserved, trim_ratio, len(incoming), incoming)[1]
+
+    def fit(self, max_turns: int, token_budget: int, reserved: int = 0, trim_ratio: float = 0.0, keep: int = 1) -> list[Turn]:
+        """上限に収まるまで古い履歴から削除する
+
+        最新の keep 件のメッセージは削除しない.
+        trim_ratio を指定すると、上限を超えた時点で件数・トークン数とも上限の (1 - trim_ratio) 倍までまとめて削除する.
+        削除しない間はプロンプトの先頭が変わらないため、APIのプロンプトキャッシュが効く
+
+        Args:
+            max_turns (int): 履歴の最大件数
+            token_budget (int): プロンプトの最大トークン数
+            reserved (int): 履歴以外に追加で送るトークン数(画像など)
+            trim_ratio (float): 上限を超えた際に追加で空ける割合. 0なら上限に収まる分だけ削除する
+            keep (int): 削除しない最新のメッセージ数. 1回の入力で追加したメッセージ数を指定する
+
+        Returns:
+            list[Turn]: 削除したメッセージ
+        """
+        count, _ = self.__plan(max_turns, token_budget, reserved, trim_ratio, keep)
+        evicted = [self.__turns.popleft() for _ in range(count)]
+        self.__turn_tokens -= sum(turn.tokens for turn in evicted)
+        self.predicted_tokens = self.prompt_tokens + reserved
+        return evicted
+
+    def __plan(
+        self, max_turns: int, token_budget: int, reserved: int, trim_ratio: float, keep: int, incoming: Sequence[Turn] = ()
+    ) -> tuple[int, int]:
+        """(古い方から削除する件数, 削除後のプロンプトのトークン数)"""
+        count = len(self.__turns) + len(incoming)
+        tokens = self.prompt_tokens + sum(turn.tokens for turn in incoming) + reserved
+        if count > max_turns or tokens > token_budget:
+            max_turns = max(1, int(max_turns * (1 - trim_ratio)))
+            token_budget = int(token_budget * (1 - trim_ratio))
+
+        evict = 0
+        for turn in self.__turns:
+            if count - evict <= max(1, keep) or (count - evict <= max_turns and tokens <= token_budget):
+                break
+            tokens -= turn.tokens
+            evict += 1
+        return evict, tokens
@@ -0,0 +1,328 @@
+import asyncio
+import base64
+import hashlib
+import io
+import ipaddress
+import multiprocessing
+import os
+import socket
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from PIL import Image
+
+# detail=low はモデル側で512x512に縮小される
+LOW_SIZE = 512
+# detail=high は2048四方に収めた後、短辺が768になるように縮小される
+HIGH_MAX_SIZE = 2048
+HIGH_SHORT_SIDE = 768
+JPEG_QUALITY = 85
+
+# 署名付きクエリで期限切れになるCDN. クエリを除いたURLで同じ画像とみなす
+SIGNED_CDN_HOSTS = frozenset({"cdn.discordapp.com", "media.discordapp.net"})
+# 取得時にたどるリダイレクトの最大数. 転送先も毎回確認する
+MAX_REDIRECTS = 3
+REDIRECT_STATUSES = frozenset({301, 302, 303, 307, 308})
+
+
+def target_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """detailに応じた送信サイズを計算する. 拡大はしない"""
+    if detail == "low":
+        scale = min(1.0, LOW_SIZE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_MAX_SIZE / max(width, height))
+        short_side = min(width, height) * scale
+        if short_side > HIGH_SHORT_SIDE:
+            scale *= HIGH_SHORT_SIDE / short_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def downscale(data: bytes, detail: str) -> tuple[str, bytes]:
+    """画像を縮小して再エンコードする. プロセスプールで実行する
+
+    Returns:
+        tuple[str, bytes]: MIMEタイプ, エンコード後のデータ
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        # アニメーションGIFは先頭フレームのみ
+        img.seek(0)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        img = img.convert("RGBA" if has_alpha else "RGB")
+
+        size = target_size(img.width, img.height, detail)
+        if size != img.size:
+            img = img.resize(size, Image.LANCZOS)
+
+        out = io.BytesIO()
+        if has_alpha:
+            img.save(out, format="PNG", optimize=True)
+            return "image/png", out.getvalue()
+        img.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return "image/jpeg", out.getvalue()
+
+
+def _is_ip_literal(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.split("%", 1)[0])
+    except ValueError:
+        return False
+    return True
+
+
+def is_public_address(address: str) -> bool:
+    """インターネット上のアドレスか. プライベート・ループバック・リンクローカル・予約済みなどは False"""
+    try:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return not (ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast or ip.is_unspecified)
+
+
+class PublicResolver(AbstractResolver):
+    """名前解決の結果に内部向けのアドレスが含まれる場合は接続しないリゾルバ
+
+    接続時に解決したアドレスをそのまま確認するため、確認後に別のアドレスを返すDNSでも内部に接続しない
+    """
+
+    def __init__(self) -> None:
+        self.__resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> list:
+        hosts = await self.__resolver.resolve(host, port, family)
+        if any(is_public_address(entry["host"]) is False for entry in hosts):
+            raise OSError(f"{host} resolves to a non-public address")
+        return hosts
+
+    async def close(self) -> None:
+        await self.__resolver.close()
+
+
+def _url_key(url: str, detail: str) -> str:
+    parts = urlsplit(url)
+    if parts.hostname in SIGNED_CDN_HOSTS:
+        parts = parts._replace(query="", fragment="")
+    return f"{detail}:{urlunsplit(parts)}"
+
+
+class ImageIngestor:
+    """画像を取得・縮小してdata URLに変換する
+
+    変換結果は内容のハッシュをキーにメモリとディスクのLRUキャッシュに保持し、
+    同じ画像の再取得・再エンコードを行わない.
+    取得するのは fetch_hosts のhttp(s)のURLだけで、それ以外のhttp(s)のURLは変換せずにそのまま返す.
+    取得先・リダイレクト先が内部向けのアドレスの場合は取得しない
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        memory_items: int,
+        disk_items: int,
+        workers: int,
+        max_download_bytes: int,
+        fetch_hosts: Iterable[str] = SIGNED_CDN_HOSTS,
+        allow_private_addresses: bool = False,
+    ) -> None:
+        self.__cache_dir = cache_dir
+        self.__memory_items = memory_items
+        self.__disk_items = disk_items
+        self.__workers = workers
+        self.__max_download_bytes = max_download_bytes
+        self.__fetch_hosts = frozenset(host.lower() for host in fetch_hosts)
+        self.__allow_private_addresses = allow_private_addresses
+
+        self.__session: aiohttp.ClientSession | None = None
+        self.__pool: ProcessPoolExecutor | None = None
+        # URL -> 内容のハッシュ
+        self.__url_index: OrderedDict[str, str] = OrderedDict()
+        # 内容のハッシュ -> data URL
+        self.__memory: OrderedDict[str, str] = OrderedDict()
+        self.__inflight: dict[str, asyncio.Future] = {}
+        self.__disk_writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    async def open(self) -> None:
+        await asyncio.to_thread(self.__cache_dir.mkdir, parents=True, exist_ok=True)
+        resolver = None if self.__allow_private_addresses else PublicResolver()
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, resolver=resolver), timeout=aiohttp.ClientTimeout(total=20)
+        )
+
+    async def close(self) -> None:
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+
+    async def to_data_urls(self, urls: list[str], detail: str) -> list[str]:
+        """画像のURLをまとめてdata URLに変換する
+
+        Args:
+            urls (list[str]): 画像のURL
+            detail (str): "low" または "high"
+
+        Returns:
+            list[str]: data URL. 取得対象外のホストのURLはそのまま
+
+        Raises:
+            ValueError: 画像を取得・変換できなかった場合や、http(s)以外のURLの場合
+        """
+        return list(await asyncio.gather(*[self.__ingest(url, detail) for url in urls]))
+
+    def is_fetchable(self, url: str) -> bool:
+        """取得してよいURLか
+
+        Raises:
+            ValueError: http(s)以外のURLや、内部向けのアドレスを直接指定したURLの場合
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("そのURL非対応やで")
+        host = parts.hostname.lower()
+        # IPアドレスを直接指定した場合は名前解決を通らないためここで確認する. ホスト名は接続時に確認する
+        if self.__allow_private_addresses is False and _is_ip_literal(host) and is_public_address(host) is False:
+            raise ValueError("そのURL非対応やで")
+        return host in self.__fetch_hosts
+
+    async def __ingest(self, url: str, detail: str) -> str:
+        if "://" not in url:
+            url = "https://" + url
+        if self.is_fetchable(url) is False:
+            return url
+
+        url_key = _url_key(url, detail)
+        content_key = self.__url_index.get(url_key)
+        if content_key is not None:
+            cached = await self.__lookup(content_key)
+            if cached is not None:
+                self.__url_index.move_to_end(url_key)
+                self.hits += 1
+                return cached
+
+        # 同じURLを同時に処理している場合は結果を共有する
+        if url_key in self.__inflight:
+            return await asyncio.shield(self.__inflight[url_key])
+
+        future = asyncio.get_running_loop().create_future()
+        self.__inflight[url_key] = future
+        try:
+            data_url = await self.__fetch_and_encode(url, url_key, detail)
+            future.set_result(data_url)
+            return data_url
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待機者がいない場合に警告を出さないようにする
+            future.exception()
+            raise
+        finally:
+            del self.__inflight[url_key]
+
+    async def __fetch_and_encode(self, url: str, url_key: str, detail: str) -> str:
+        data = await self.__download(url)
+        content_key = f"{hashlib.sha256(data).hexdigest()}-{detail}"
+        self.__remember_url(url_key, content_key)
+
+        cached = await self.__lookup(content_key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        if self.__pool is None:
+            # スレッドが動いているプロセスをforkすると子がロックを握ったまま止まることがあるためspawnで起動する
+            self.__pool = ProcessPoolExecutor(max_workers=self.__workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            mime, encoded = await asyncio.get_running_loop().run_in_executor(self.__pool, downscale, data, detail)
+        except Exception as e:
+            raise ValueError("その画像読まれへんわ") from e
+
+        data_url = f"data:{mime};base64,{base64.b64encode(encoded).decode('ascii')}"
+        self.__remember(content_key, data_url)
+        await asyncio.to_thread(self.__write_disk, content_key, data_url)
+        return data_url
+
+    async def __download(self, url: str) -> bytes:
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                async with self.__session.get(url, allow_redirects=False) as response:
+                    if response.status in REDIRECT_STATUSES:
+                        # 転送先も取得対象のホストに限る
+                        url = urljoin(url, response.headers.get("Location", ""))
+                        if self.is_fetchable(url) is False:
+                            raise ValueError("そのURL非対応やで")
+                        continue
+                    response.raise_for_status()
+                    if (response.content_length or 0) > self.__max_download_bytes:
+                        raise ValueError("画像が大きすぎるで")
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        data += chunk
+                        if len(data) > self.__max_download_bytes:
+                            raise ValueError("画像が大きすぎるで")
+                    return bytes(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            raise ValueError("画像の取得に失敗したで") from e
+        raise ValueError("画像の取得に失敗したで (リダイレクトが多すぎる)")
+
+    def __remember_url(self, url_key: str, content_key: str) -> None:
+        self.__url_index[url_key] = content_key
+        self.__url_index.move_to_end(url_key)
+        while len(self.__url_index) > self.__disk_items:
+            self.__url_index.popitem(last=False)
+
+    def __remember(self, content_key: str, data_url: str) -> None:
+        self.__memory[content_key] = data_url
+        self.__memory.move_to_end(content_key)
+        while len(self.__memory) > self.__memory_items:
+            self.__memory.popitem(last=False)
+
+    async def __lookup(self, content_key: str) -> str | None:
+        if content_key in self.__memory:
+            self.__memory.move_to_end(content_key)
+            return self.__memory[content_key]
+
+        data_url = await asyncio.to_thread(self.__read_disk, content_key)
+        if data_url is not None:
+            self.__remember(content_key, data_url)
+        return data_url
+
+    def __read_disk(self, content_key: str) -> str | None:
+        path = self.__cache_dir / content_key
+        try:
+            data_url = path.read_text()
+        except FileNotFoundError:
+            return None
+        # 最終アクセス日時をLRUの順序に使う
+        os.utime(path)
+        return data_url
+
+    def __write_disk(self, content_key: str, data_url: str) -> None:
+        tmp = self.__cache_dir / f"{content_key}.tmp"
+        tmp.write_text(data_url)
+        tmp.replace(self.__cache_dir / content_key)
+
+        self.__disk_writes += 1
+        if self.__disk_writes % 64 == 0:
+            self.__prune_disk()
+
+    def __prune_disk(self) -> None:
+        files = sorted((entry for entry in os.scandir(self.__cache_dir) if entry.is_file()), key=lambda entry: entry.stat().st_mtime)
+        for entry in files[: max(0, len(files) - self.__disk_items)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
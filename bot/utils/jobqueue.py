@@ -0,0 +1,158 @@
+import asyncio
+import json
+import multiprocessing
+import queue
+import zlib
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+# ワーカーが受け取り待ちで一度にブロックする時間(秒). 終了要求に気づくまでの最大時間
+POLL_INTERVAL = 1.0
+
+
+@dataclass
+class Job:
+    """ゲートウェイからワーカーに渡す処理
+
+    kind:
+        "mention": メンションへの回答
+        "search": Web検索付きの回答
+        "reset_history": 履歴のリセット
+        "reset_charactor": 性格設定のリセット
+        "change_charactor": 性格設定の変更. textに変更先
+        "batch_<種類>": Batch APIのジョブの追加. textに入力
+        "command": その他のコマンド. textに {"name": コマンド名, "args": 引数} のJSON
+    """
+
+    kind: str
+    guild_id: int
+    channel_id: int
+    author_id: int
+    text: str = ""
+    reference: str | None = None
+    attachments: List[str] = field(default_factory=list)
+
+    def dumps(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False)
+
+    @classmethod
+    def loads(cls, data: str | bytes) -> "Job":
+        return cls(**json.loads(data))
+
+
+def partition_of(guild_id: int, partitions: int) -> int:
+    """サーバーを担当するワーカーの番号. プロセスをまたいで同じ値になる"""
+    return zlib.crc32(str(guild_id).encode()) % partitions
+
+
+class JobQueue(ABC):
+    """ワーカーごとのジョブのキュー
+
+    同じサーバーのジョブは常に同じワーカーに渡し、履歴や使用量をワーカー内で完結させる
+    """
+
+    def __init__(self, partitions: int) -> None:
+        self.partitions = max(1, partitions)
+
+    async def put(self, job: Job) -> None:
+        """サーバーを担当するワーカーのキューに積む"""
+        await self._put(partition_of(job.guild_id, self.partitions), job.dumps())
+
+    async def broadcast(self, job: Job) -> None:
+        """全ワーカーのキューに積む. 設定の変更など全ワーカーで実行する処理に使う"""
+        for partition in range(self.partitions):
+            await self._put(partition, job.dumps())
+
+    async def get(self, partition: int) -> Job:
+        """ワーカーのキューからジョブを取り出す. 無ければ届くまで待つ"""
+        while True:
+            data = await self._get(partition, POLL_INTERVAL)
+            if data is not None:
+                return Job.loads(data)
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def _put(self, partition: int, data: str) -> None:
+        pass
+
+    @abstractmethod
+    async def _get(self, partition: int, timeout: float) -> str | bytes | None:
+        """timeout秒待っても無ければNone"""
+
+
+class LocalJobQueue(JobQueue):
+    """multiprocessingのキューによる同一ホスト内のキュー
+
+    子プロセスに引数として渡して共有する
+    """
+
+    def __init__(self, partitions: int) -> None:
+        super().__init__(partitions)
+        context = multiprocessing.get_context("spawn")
+        self.__queues = [context.Queue() for _ in range(self.partitions)]
+
+    async def _put(self, partition: int, data: str) -> None:
+        # 送信は別スレッドで行われるためブロックしない
+        self.__queues[partition].put_nowait(data)
+
+    async def _get(self, partition: int, timeout: float) -> str | None:
+        try:
+            return await asyncio.to_thread(self.__queues[partition].get, True, timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisJobQueue(JobQueue):
+    """Redisのリストによるキュー. ゲートウェイとワーカーを別ホストに置ける
+
+    redisパッケージが必要
+    """
+
+    def __init__(self, url: str, partitions: int, prefix: str = "bot:jobs") -> None:
+        super().__init__(partitions)
+        self.__url = url
+        self.__prefix = prefix
+        self.__client = None
+
+    def __redis(self):
+        # 別プロセスに渡してから接続する
+        if self.__client is None:
+            import redis.asyncio
+
+            self.__client = redis.asyncio.from_url(self.__url)
+        return self.__client
+
+    def __key(self, partition: int) -> str:
+        return f"{self.__prefix}:{partition}"
+
+    async def _put(self, partition: int, data: str) -> None:
+        await self.__redis().rpush(self.__key(partition), data)
+
+    async def _get(self, partition: int, timeout: float) -> bytes | None:
+        item = await self.__redis().blpop([self.__key(partition)], timeout=timeout)
+        return item[1] if item is not None else None
+
+    async def close(self) -> None:
+        if self.__client is not None:
+            await self.__client.aclose()
+            self.__client = None
+
+
+def create_job_queue(url: str, partitions: int) -> JobQueue:
+    """設定からキューを作成する
+
+    Args:
+        url (str): "local" またはRedisのURL(redis://...)
+        partitions (int): ワーカー数
+
+    Raises:
+        ValueError: 未対応のURLの場合
+    """
+    if url == "local":
+        return LocalJobQueue(partitions)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisJobQueue(url, partitions)
+    raise ValueError(f"unknown job queue: {url}")
@@ -0,0 +1,43 @@
+import logging
+import logging.config
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+_listener: QueueListener | None = None
+
+
+def configure_logging(config: dict) -> None:
+    """dictConfigで設定したハンドラーを別スレッドで実行する
+
+    ロガーにはキューに積むだけのQueueHandlerを付け、標準出力やファイルへの書き込みで
+    イベントループが止まらないようにする
+    """
+    stop_logging()
+    logging.config.dictConfig(config)
+
+    loggers = [logging.getLogger(name) for name in config.get("loggers", {})] + [logging.getLogger()]
+    handlers = []
+    for logger in loggers:
+        for handler in logger.handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+    if len(handlers) == 0:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    for logger in loggers:
+        if len(logger.handlers) > 0:
+            logger.handlers = [queue_handler]
+
+    global _listener
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """キューに残ったログを書き出してスレッドを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
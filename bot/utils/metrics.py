@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, List, Tuple
+
+from aiohttp import web
+
+# 秒
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Prometheus形式のヒストグラム. /stats 用に直近の値も保持する"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, recent: int = 1024) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.__recent: Deque[float] = deque(maxlen=recent)
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+        self.__recent.append(value)
+
+    def percentile(self, q: float) -> float:
+        """直近の値のパーセンタイル"""
+        if len(self.__recent) == 0:
+            return 0.0
+        ordered = sorted(self.__recent)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def render(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+    """リクエストの処理段階ごとの時間とトークン数を集計する"""
+
+    def __init__(self) -> None:
+        self.__stages: Dict[str, Histogram] = {}
+        self.__loop_lag = Histogram()
+        # (サーバーID, モデル, "prompt" | "cached" | "completion") -> トークン数. cachedはpromptのうちキャッシュから読まれた分
+        self.__tokens: Dict[Tuple[int, str, str], int] = {}
+        # 名前 -> (説明, 値を返す関数)
+        self.__gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """ブロックの実行時間を処理段階の時間として記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if stage not in self.__stages:
+            self.__stages[stage] = Histogram()
+        self.__stages[stage].observe(seconds)
+
+    def observe_loop_lag(self, seconds: float) -> None:
+        self.__loop_lag.observe(seconds)
+
+    def add_tokens(self, guild_id: int, model: str, prompt: int, completion: int, cached: int = 0) -> None:
+        for kind, count in (("prompt", prompt), ("cached", cached), ("completion", completion)):
+            key = (guild_id, model, kind)
+            self.__tokens[key] = self.__tokens.get(key, 0) + count
+
+    def register_gauge(self, name: str, description: str, value: Callable[[], float]) -> None:
+        """出力時に値を取得するゲージを登録する"""
+        self.__gauges[name] = (description, value)
+
+    def stages(self) -> Dict[str, Histogram]:
+        return dict(self.__stages)
+
+    @property
+    def loop_lag(self) -> Histogram:
+        return self.__loop_lag
+
+    def tokens(self, guild_id: int) -> Dict[Tuple[str, str], int]:
+        """サーバーのモデル・種類ごとのトークン数"""
+        return {(model, kind): count for (guild, model, kind), count in self.__tokens.items() if guild == guild_id}
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式で出力する"""
+        lines = ["# HELP bot_stage_duration_seconds Time spent in each request stage", "# TYPE bot_stage_duration_seconds histogram"]
+        for stage, histogram in sorted(self.__stages.items()):
+            lines += histogram.render("bot_stage_duration_seconds", f'stage="{stage}"')
+
+        lines += ["# HELP bot_event_loop_lag_seconds Event loop scheduling delay", "# TYPE bot_event_loop_lag_seconds histogram"]
+        lines += self.__loop_lag.render("bot_event_loop_lag_seconds", "")
+
+        lines += ["# HELP bot_tokens_total Tokens consumed", "# TYPE bot_tokens_total counter"]
+        for (guild_id, model, kind), count in sorted(self.__tokens.items()):
+            lines.append(f'bot_tokens_total{{guild="{guild_id}",model="{model}",type="{kind}"}} {count}')
+
+        for name, (description, value) in sorted(self.__gauges.items()):
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {value()}"]
+        return "\n".join(lines) + "\n"
+
+
+class LoopLagMonitor:
+    """一定間隔でsleepし、予定からの遅れをイベントループの遅延として記録する"""
+
+    def __init__(self, metrics: Metrics, interval: float) -> None:
+        self.__metrics = metrics
+        self.interval = interval
+        self.__task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.__metrics.observe_loop_lag(max(0.0, loop.time() - start - self.interval))
+
+
+class MetricsServer:
+    """/metrics でPrometheus形式の値を返すHTTPサーバー"""
+
+    def __init__(self, metrics: Metrics, host: str, port: int) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__metrics = metrics
+        self.host = host
+        self.port = port
+        self.__runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.__handle)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.host, self.port).start()
+        self.__logger.info(f"metrics listening on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    async def __handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.__metrics.render(), content_type="text/plain", charset="utf-8")
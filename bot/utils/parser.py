@@ -0,0 +1,115 @@
+import re
+from functools import lru_cache
+from typing import Iterable
+from urllib.parse import urlsplit
+
+import urlextract
+
+# メンション(<@123> / <@!123>)
+MENTION_PATTERN = re.compile(r"<@!?\d+>")
+# 対応する画像の拡張子. URLのパス末尾にのみマッチさせる
+IMAGE_PATH_PATTERN = re.compile(r"\.(?:png|jpe?g|gif)$", re.IGNORECASE)
+IMAGE_CONTENT_TYPES = frozenset({"image/png", "image/jpeg", "image/gif"})
+
+
+@lru_cache(maxsize=1)
+def get_extractor() -> urlextract.URLExtract:
+    """URL抽出器を取得する
+
+    生成時にTLDリストをディスクから読み込むため、プロセス内で1つを使い回す
+    """
+    return urlextract.URLExtract()
+
+
+def strip_mentions(text: str) -> str:
+    """メンションを取り除く"""
+    return MENTION_PATTERN.sub("", text).strip()
+
+
+def is_image_url(url: str) -> bool:
+    """URLのパスが対応する画像の拡張子で終わっているか"""
+    if "://" not in url:
+        url = "//" + url
+    return IMAGE_PATH_PATTERN.search(urlsplit(url).path) is not None
+
+
+def is_image_attachment(content_type: str | None, filename: str) -> bool:
+    """添付ファイルが対応する画像か
+
+    content_typeがあればそれで判定し、無ければファイル名の拡張子で判定する
+    """
+    if content_type is not None:
+        return content_type.split(";")[0].strip().lower() in IMAGE_CONTENT_TYPES
+    return IMAGE_PATH_PATTERN.search(filename) is not None
+
+
+def extract_image_urls(text: str) -> tuple[str, list[str]]:
+    """本文から画像のURLを抜き出す
+
+    Args:
+        text (str): 本文
+
+    Raises:
+        ValueError: 画像以外のURLが含まれる場合
+
+    Returns:
+        tuple[str, list[str]]: URLを除いた本文, 画像のURLのリスト
+    """
+    # ドメインを含まない文はURL抽出をスキップする
+    if "." not in text:
+        return text, []
+
+    urls = []
+    for url in get_extractor().find_urls(text, only_unique=True):
+        if is_image_url(url) is False:
+            raise ValueError("そのURL非対応やで")
+        urls.append(url)
+        text = text.replace(url, "")
+    return text, urls
+
+
+def attachment_urls(attachments: Iterable) -> list[str]:
+    """添付ファイルのURLを取得する
+
+    Args:
+        attachments (Iterable): discord.Attachmentのリスト
+
+    Raises:
+        ValueError: 画像以外のファイルが含まれる場合
+    """
+    urls = []
+    for attach in attachments:
+        if is_image_attachment(attach.content_type, attach.filename) is False:
+            raise ValueError("そのファイル非対応やで")
+        urls.append(attach.url)
+    return urls
+
+
+def parse_message(message) -> tuple[str, str | None, list[str]]:
+    """入力メッセージを処理して、入力・参照・添付ファイルにする
+
+    Args:
+        message (discord.Message): 入力メッセージ
+
+    Raises:
+        ValueError: 非対応な拡張子の場合
+        ValueError: 無効なURLの場合
+
+    Returns:
+        tuple[str, str | None, list[str]]: 入力, 参照, 添付ファイルのリスト
+    """
+    reference_message = None
+
+    plane_message = strip_mentions(message.content)
+    if message.reference is not None:
+        if message.reference.resolved is not None:
+            reference_message = message.reference.resolved.content
+
+    # 直接メッセージに添付された画像
+    attachments_list = attachment_urls(message.attachments)
+
+    # チャットから画像のURLを抽出
+    plane_message, extracted_urls = extract_image_urls(plane_message)
+    attachments_list += extracted_urls
+
+    return plane_message, reference_message, attachments_list
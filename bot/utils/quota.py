@@ -0,0 +1,161 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Dict, Tuple
+
+
+class TokenBucket:
+    """トークンバケット. capacity まで貯まり、毎秒 rate ずつ回復する
+
+    実際の使用量が見積もりを超えた分は負の残高として次の回復で埋める
+    """
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float, now: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, tokens: float) -> None:
+        self.tokens -= tokens
+
+
+class Admission(Enum):
+    ACCEPT = "accept"
+    DOWNGRADE = "downgrade"
+    REJECT = "reject"
+
+
+@dataclass
+class QuotaDecision:
+    """アドミッションの結果"""
+
+    admission: Admission
+    # 予約したトークン数. 応答後に実際の使用量で精算する
+    reserved: int = 0
+    # 上限を超えた対象. "user" | "guild"
+    scope: str | None = None
+    # 次のリクエストが通るまでの見込み(秒)
+    retry_after: float = 0.0
+
+
+class QuotaController:
+    """ユーザーごと・サーバーごとのトークン使用量の上限
+
+    リクエスト前に予測したプロンプトのトークン数で O(1) で判定して予約し、
+    応答後に実際の使用量との差を精算する. イベントループ内でのみ使うためロックは持たない
+    """
+
+    def __init__(
+        self,
+        user_capacity: float,
+        user_rate: float,
+        guild_capacity: float,
+        guild_rate: float,
+        downgrade: bool,
+        max_users: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.user_capacity = user_capacity
+        self.user_rate = user_rate
+        self.guild_capacity = guild_capacity
+        self.guild_rate = guild_rate
+        self.downgrade = downgrade
+        self.max_users = max_users
+        self.__clock = clock
+
+        self.__users: OrderedDict[Tuple[int, int], TokenBucket] = OrderedDict()
+        self.__guilds: Dict[int, TokenBucket] = {}
+        self.rejected = 0
+        self.downgraded = 0
+
+    def configure(self, user_capacity: float, user_rate: float, guild_capacity: float, guild_rate: float, downgrade: bool) -> None:
+        """上限を変更する. 既存のバケットの残高はそのままで、新しい上限を超える分は切り捨てる"""
+        self.user_capacity = user_capacity
+        self.user_rate = user_rate
+        self.guild_capacity = guild_capacity
+        self.guild_rate = guild_rate
+        self.downgrade = downgrade
+        for buckets, capacity, rate in ((self.__users.values(), user_capacity, user_rate), (self.__guilds.values(), guild_capacity, guild_rate)):
+            for bucket in buckets:
+                bucket.capacity = capacity
+                bucket.rate = rate
+                bucket.tokens = min(bucket.tokens, capacity)
+
+    def __user(self, guild_id: int, user_id: int, now: float) -> TokenBucket:
+        key = (guild_id, user_id)
+        bucket = self.__users.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.user_capacity, self.user_rate, now)
+            self.__users[key] = bucket
+            # 使われていないユーザーから外す. 外れたユーザーは満タンから再開する
+            if len(self.__users) > self.max_users:
+                self.__users.popitem(last=False)
+        else:
+            self.__users.move_to_end(key)
+        bucket.refill(now)
+        return bucket
+
+    def __guild(self, guild_id: int, now: float) -> TokenBucket:
+        bucket = self.__guilds.get(guild_id)
+        if bucket is None:
+            bucket = TokenBucket(self.guild_capacity, self.guild_rate, now)
+            self.__guilds[guild_id] = bucket
+        bucket.refill(now)
+        return bucket
+
+    def admit(self, guild_id: int, user_id: int, predicted: int) -> QuotaDecision:
+        """リクエストを送ってよいか判定し、予測したトークン数を予約する
+
+        Args:
+            guild_id (int): サーバーID
+            user_id (int): ユーザーID
+            predicted (int): 予測したプロンプトのトークン数
+
+        Returns:
+            QuotaDecision: 判定結果
+        """
+        now = self.__clock()
+        user = self.__user(guild_id, user_id, now)
+        guild = self.__guild(guild_id, now)
+
+        # 上限より大きいリクエストはバケットが満タンなら通す
+        scope = None
+        bucket = None
+        if user.tokens < min(predicted, user.capacity):
+            scope, bucket = "user", user
+        elif guild.tokens < min(predicted, guild.capacity):
+            scope, bucket = "guild", guild
+
+        if scope is None:
+            admission = Admission.ACCEPT
+        elif self.downgrade:
+            admission = Admission.DOWNGRADE
+            self.downgraded += 1
+        else:
+            self.rejected += 1
+            retry_after = (min(predicted, bucket.capacity) - bucket.tokens) / bucket.rate if bucket.rate > 0 else float("inf")
+            return QuotaDecision(Admission.REJECT, scope=scope, retry_after=retry_after)
+
+        user.charge(predicted)
+        guild.charge(predicted)
+        return QuotaDecision(admission, reserved=predicted, scope=scope)
+
+    def settle(self, guild_id: int, user_id: int, decision: QuotaDecision, usage: int) -> None:
+        """予約したトークン数を実際の使用量で精算する. 失敗した場合はusage=0で予約を戻す"""
+        now = self.__clock()
+        delta = usage - decision.reserved
+        self.__user(guild_id, user_id, now).charge(delta)
+        self.__guild(guild_id, now).charge(delta)
+
+    def remaining(self, guild_id: int, user_id: int) -> Tuple[float, float]:
+        """(ユーザーの残り, サーバーの残り)"""
+        now = self.__clock()
+        return self.__user(guild_id, user_id, now).tokens, self.__guild(guild_id, now).tokens
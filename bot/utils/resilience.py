@@ -0,0 +1,239 @@
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, TypeVar
+
+import openai
+
+R = TypeVar("R")
+
+# 5xx以外で再試行するステータス
+RETRYABLE_STATUS = frozenset({408, 409, 429})
+
+
+class CircuitOpenError(Exception):
+    """全てのモデルのサーキットブレーカーが開いている"""
+
+    def __init__(self, models: List[str]) -> None:
+        super().__init__("APIの調子が悪いみたいやわ、ちょっと待ってからもう一回頼むで")
+        self.models = models
+
+
+@dataclass
+class RetryPolicy:
+    """再試行の設定"""
+
+    max_attempts: int = 3
+    # 1回の試行の期限. ストリーミングの場合は最初のトークンまで
+    attempt_timeout: float = 60.0
+    # ストリーミング中にトークンが途切れてよい時間
+    stream_idle_timeout: float = 20.0
+    # 再試行・フォールバックを含めた全体の期限
+    total_timeout: float = 90.0
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+
+
+def is_retryable(error: BaseException) -> bool:
+    """一時的なエラーか判定する"""
+    if isinstance(error, (TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.RateLimitError):
+        # クォータ切れは待っても回復しない
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_after(error: BaseException) -> float | None:
+    """レート制限のヘッダーから待機時間(秒)を取得する"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """指数バックオフの待機時間. 同時に失敗したリクエストが揃って再試行しないようにジッターを入れる"""
+    return random.uniform(0, min(max_delay, base_delay * (2**attempt)))
+
+
+class CircuitBreaker:
+    """連続して失敗したら一定時間リクエストを止める
+
+    closed: 通常, open: 即座に失敗させる, half_open: 1件だけ試して復旧を確認する
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+
+        self.__failures = 0
+        self.__opened_at: float | None = None
+        self.__probing = False
+
+    @property
+    def state(self) -> str:
+        if self.__opened_at is None:
+            return "closed"
+        if time.monotonic() - self.__opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        """リクエストを送ってよいか"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and self.__probing is False:
+            self.__probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.__failures = 0
+        self.__opened_at = None
+        self.__probing = False
+
+    def record_failure(self) -> None:
+        self.__failures += 1
+        if self.__probing or self.__failures >= self.failure_threshold:
+            self.__opened_at = time.monotonic()
+        self.__probing = False
+
+    def release(self) -> None:
+        """失敗とも成功とも数えずに試行を終える"""
+        self.__probing = False
+
+
+class Attempt:
+    """1回の試行. ストリーミングで受信するたびに期限を延ばす"""
+
+    def __init__(self, timeout: asyncio.Timeout, idle_timeout: float) -> None:
+        self.__timeout = timeout
+        self.__idle_timeout = idle_timeout
+        self.emitted = False
+
+    def emit(self) -> None:
+        """トークンを受信した. 以降は同じ内容を二重に表示しないよう再試行しない"""
+        self.emitted = True
+        self.__timeout.reschedule(asyncio.get_running_loop().time() + self.__idle_timeout)
+
+
+class ResilientExecutor:
+    """OpenAI APIの呼び出しを期限・再試行・サーキットブレーカー・モデルのフォールバック付きで実行する"""
+
+    def __init__(self, policy: RetryPolicy, breaker_threshold: int, breaker_reset: float) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.policy = policy
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.__breakers: Dict[str, CircuitBreaker] = {}
+
+        self.retries = 0
+        self.fallbacks = 0
+
+    def configure(self, policy: RetryPolicy, breaker_threshold: int, breaker_reset: float) -> None:
+        """再試行とサーキットブレーカーの設定を変更する. 作成済みのブレーカーにも反映する"""
+        self.policy = policy
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        for breaker in self.__breakers.values():
+            breaker.failure_threshold = max(1, breaker_threshold)
+            breaker.reset_timeout = breaker_reset
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.__breakers:
+            self.__breakers[model] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return self.__breakers[model]
+
+    def states(self) -> Dict[str, str]:
+        """モデルごとのサーキットブレーカーの状態"""
+        return {model: breaker.state for model, breaker in self.__breakers.items()}
+
+    async def run(self, models: List[str], call: Callable[[str, Attempt], Awaitable[R]]) -> R:
+        """モデルを順番に試して最初に成功した結果を返す
+
+        Args:
+            models (List[str]): 試すモデル. 先頭から順に使う
+            call (Callable[[str, Attempt], Awaitable[R]]): モデル名と試行を受け取ってAPIを呼び出す
+
+        Raises:
+            CircuitOpenError: 全てのモデルのサーキットブレーカーが開いている場合
+        """
+        deadline = time.monotonic() + self.policy.total_timeout
+        last_error: BaseException | None = None
+
+        for index, model in enumerate(models):
+            breaker = self.breaker(model)
+            for attempt_no in range(self.policy.max_attempts):
+                if breaker.allow() is False:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    async with asyncio.timeout(min(self.policy.attempt_timeout, remaining)) as timeout:
+                        attempt = Attempt(timeout, self.policy.stream_idle_timeout)
+                        result = await call(model, attempt)
+                except asyncio.CancelledError:
+                    breaker.release()
+                    raise
+                except Exception as e:
+                    if is_retryable(e) is False:
+                        # 入力が原因のエラーはモデルを変えても同じ
+                        breaker.release()
+                        if isinstance(e, openai.NotFoundError) and index + 1 < len(models):
+                            self.__logger.warning(f"[Retry] model={model} not available, falling back")
+                            last_error = e
+                            break
+                        raise
+                    breaker.record_failure()
+                    last_error = e
+                    if attempt.emitted:
+                        # 途中まで表示した応答はやり直せない
+                        raise
+                    delay = retry_after(e)
+                    if delay is None:
+                        delay = backoff_delay(attempt_no, self.policy.base_delay, self.policy.max_delay)
+                    if attempt_no + 1 >= self.policy.max_attempts or delay > self.policy.max_delay or time.monotonic() + delay >= deadline:
+                        # 待っても間に合わない場合は次のモデルへ
+                        self.__logger.warning(f"[Retry] model={model} gave up after {attempt_no + 1} attempts: {e!r}")
+                        break
+                    self.__logger.warning(f"[Retry] model={model} attempt={attempt_no + 1} retry in {delay:.2f}s: {e!r}")
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                else:
+                    breaker.record_success()
+                    if index > 0:
+                        self.fallbacks += 1
+                        self.__logger.warning(f"[Retry] served by fallback model={model}")
+                    return result
+
+        if last_error is None:
+            raise CircuitOpenError(models)
+        raise last_error
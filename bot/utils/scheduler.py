@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Deque, Dict
+
+
+@dataclass
+class SchedulerStats:
+    """スケジューラの状態"""
+
+    in_flight: int
+    queue_depth: int
+    last_wait: float
+    avg_wait: float
+    max_wait: float
+
+
+class RequestScheduler:
+    """OpenAI APIへの同時リクエスト数を制限するスケジューラ
+
+    全体の同時実行数とサーバーごとの同時実行数を制限し、
+    超過したリクエストはサーバー単位のラウンドロビンで順番に実行する
+    """
+
+    def __init__(self, max_concurrency: int, max_per_guild: int) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_guild = max(1, max_per_guild)
+
+        self.__queues: Dict[int, Deque[asyncio.Future]] = {}
+        self.__ring: Deque[int] = deque()
+        self.__in_flight: Dict[int, int] = {}
+        self.__in_flight_total = 0
+
+        self.__wait_count = 0
+        self.__wait_total = 0.0
+        self.__last_wait = 0.0
+        self.__max_wait = 0.0
+
+    def resize(self, max_concurrency: int, max_per_guild: int) -> None:
+        """同時実行数の上限を変更する"""
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_guild = max(1, max_per_guild)
+        self.__dispatch()
+
+    def queue_depth(self, guild_id: int | None = None) -> int:
+        """待機中のリクエスト数
+
+        Args:
+            guild_id (int | None): 指定した場合はそのサーバーのみ
+        """
+        if guild_id is not None:
+            return len(self.__queues.get(guild_id, ()))
+        return sum(len(q) for q in self.__queues.values())
+
+    def stats(self) -> SchedulerStats:
+        avg = self.__wait_total / self.__wait_count if self.__wait_count > 0 else 0.0
+        return SchedulerStats(
+            in_flight=self.__in_flight_total,
+            queue_depth=self.queue_depth(),
+            last_wait=self.__last_wait,
+            avg_wait=avg,
+            max_wait=self.__max_wait,
+        )
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int) -> AsyncIterator[float]:
+        """実行枠を確保する
+
+        Args:
+            guild_id (int): サーバーID
+
+        Yields:
+            float: 枠の確保までに待機した秒数
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        if guild_id not in self.__queues:
+            self.__queues[guild_id] = deque()
+            self.__ring.append(guild_id)
+        self.__queues[guild_id].append(waiter)
+
+        started = time.monotonic()
+        self.__dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 枠を得た直後にキャンセルされた場合は返却する
+                self.__release(guild_id)
+            else:
+                self.__discard(guild_id, waiter)
+            raise
+
+        wait = time.monotonic() - started
+        self.__record_wait(wait)
+        try:
+            yield wait
+        finally:
+            self.__release(guild_id)
+
+    def __record_wait(self, wait: float) -> None:
+        self.__wait_count += 1
+        self.__wait_total += wait
+        self.__last_wait = wait
+        self.__max_wait = max(self.__max_wait, wait)
+
+    def __discard(self, guild_id: int, waiter: asyncio.Future) -> None:
+        queue = self.__queues.get(guild_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+        if len(queue) == 0:
+            del self.__queues[guild_id]
+            self.__ring.remove(guild_id)
+
+    def __release(self, guild_id: int) -> None:
+        self.__in_flight_total -= 1
+        self.__in_flight[guild_id] -= 1
+        if self.__in_flight[guild_id] == 0:
+            del self.__in_flight[guild_id]
+        self.__dispatch()
+
+    def __dispatch(self) -> None:
+        """空き枠に待機中のリクエストを割り当てる"""
+        skipped = 0
+        while self.__in_flight_total < self.max_concurrency and skipped < len(self.__ring):
+            guild_id = self.__ring[0]
+            self.__ring.rotate(-1)
+            if self.__in_flight.get(guild_id, 0) >= self.max_per_guild:
+                skipped += 1
+                continue
+
+            queue = self.__queues[guild_id]
+            waiter = queue.popleft()
+            if len(queue) == 0:
+                del self.__queues[guild_id]
+                self.__ring.remove(guild_id)
+            skipped = 0
+
+            if waiter.done():
+                continue
+            waiter.set_result(None)
+            self.__in_flight_total += 1
+            self.__in_flight[guild_id] = self.__in_flight.get(guild_id, 0) + 1
@@ -0,0 +1,92 @@
+import heapq
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, List, Tuple, TypeVar
+
+# (サーバーID, チャンネルID). スレッドの場合はスレッドのID
+SessionKey = Tuple[int, int]
+V = TypeVar("V")
+
+
+class SessionManager(Generic[V]):
+    """チャンネルごとの会話セッションを管理する
+
+    一定時間操作の無いセッションはヒープで期限順に管理して O(log n) で取り出し、
+    セッション数が上限を超えた場合は最も使われていないものから取り出す
+    """
+
+    def __init__(self, idle_seconds: float, max_sessions: int) -> None:
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+
+        # 挿入順を最終アクセス順として使う
+        self.__sessions: OrderedDict[SessionKey, V] = OrderedDict()
+        self.__last_activity: Dict[SessionKey, float] = {}
+        # (期限, キー). セッションごとに1件だけ積む
+        self.__deadlines: List[Tuple[float, SessionKey]] = []
+        self.__scheduled: Dict[SessionKey, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    def __contains__(self, key: SessionKey) -> bool:
+        return key in self.__sessions
+
+    def get(self, key: SessionKey) -> V | None:
+        return self.__sessions.get(key)
+
+    def add(self, key: SessionKey, value: V) -> List[Tuple[SessionKey, V]]:
+        """セッションを追加する
+
+        Returns:
+            List[Tuple[SessionKey, V]]: 上限を超えたため取り出したセッション
+        """
+        self.__sessions[key] = value
+        self.touch(key)
+
+        evicted = []
+        while len(self.__sessions) > self.max_sessions:
+            old_key, old_value = self.__sessions.popitem(last=False)
+            self.__forget(old_key)
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def touch(self, key: SessionKey) -> None:
+        """セッションの最終アクティビティを更新する"""
+        if key not in self.__sessions:
+            return
+        now = time.monotonic()
+        self.__last_activity[key] = now
+        self.__sessions.move_to_end(key)
+        if key not in self.__scheduled:
+            self.__schedule(key, now + self.idle_seconds)
+
+    def expire(self) -> List[Tuple[SessionKey, V]]:
+        """期限切れのセッションを取り出す"""
+        now = time.monotonic()
+        expired = []
+        while len(self.__deadlines) > 0 and self.__deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.__deadlines)
+            if self.__scheduled.get(key) != deadline:
+                # 削除済みのセッション
+                continue
+            del self.__scheduled[key]
+
+            idle_until = self.__last_activity[key] + self.idle_seconds
+            if idle_until > now:
+                # 期限までに操作があったので期限を延ばす
+                self.__schedule(key, idle_until)
+                continue
+
+            expired.append((key, self.__sessions.pop(key)))
+            del self.__last_activity[key]
+        return expired
+
+    def __schedule(self, key: SessionKey, deadline: float) -> None:
+        self.__scheduled[key] = deadline
+        heapq.heappush(self.__deadlines, (deadline, key))
+
+    def __forget(self, key: SessionKey) -> None:
+        self.__last_activity.pop(key, None)
+        # ヒープ上のエントリは取り出した時点で捨てる
+        self.__scheduled.pop(key, None)
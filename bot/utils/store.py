@@ -0,0 +1,396 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+
+@dataclass
+class SessionState:
+    """永続化されたセッションの状態"""
+
+    summary: str | None = None
+    turns: List[dict] = field(default_factory=list)
+    # 最後に履歴を追加した時刻(UNIX時間). 不明ならNone
+    last_active: float | None = None
+
+
+@dataclass
+class BatchJob:
+    """Batch APIに送る非対話のジョブ
+
+    batch_id は送信済みのバッチのID. 未送信ならNone
+    owner はジョブを積んだワーカーの番号. 同じストアを共有するワーカーが互いのジョブを回収しないようにする
+    """
+
+    job_id: str
+    guild_id: int
+    channel_id: int
+    author_id: int
+    # Chat Completions APIのリクエストボディ
+    body: Dict[str, Any]
+    batch_id: str | None = None
+    owner: int = 0
+
+
+class ConversationStore(ABC):
+    """対話履歴とトークン使用量の永続化層
+
+    書き込み系のメソッドはイベントループをブロックしないようにキューに積むだけにし、
+    実際の書き込みは実装側でまとめて行う
+    """
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    @abstractmethod
+    async def load_system(self, guild_id: int) -> str | None:
+        """サーバーのシステムプロンプトを読み込む. 無ければNone"""
+
+    @abstractmethod
+    async def load_session(self, guild_id: int, channel_id: int) -> SessionState | None:
+        """セッションの状態を読み込む. 無ければNone"""
+
+    @abstractmethod
+    def save_system(self, guild_id: int, text: str | None) -> None:
+        """システムプロンプトを保存する. Noneはデフォルトに戻す"""
+
+    @abstractmethod
+    def save_summary(self, guild_id: int, channel_id: int, text: str | None) -> None:
+        """履歴から溢れた会話の要約を保存する"""
+
+    @abstractmethod
+    def append_turn(self, guild_id: int, channel_id: int, message: dict) -> None:
+        """履歴の末尾にメッセージを追加し、セッションの最終アクティビティを更新する"""
+
+    @abstractmethod
+    def delete_oldest_turns(self, guild_id: int, channel_id: int, count: int) -> None:
+        """古い履歴から count 件削除する"""
+
+    @abstractmethod
+    def clear_turns(self, guild_id: int, channel_id: int) -> None:
+        """履歴をすべて削除する"""
+
+    @abstractmethod
+    def add_usage(self, guild_id: int, user_id: int, tokens: int) -> None:
+        """トークン使用量を加算する"""
+
+    @abstractmethod
+    async def ranking(self, guild_id: int, limit: int) -> List[Tuple[int, int]]:
+        """トークン使用量の多い順に (ユーザーID, トークン数) を返す"""
+
+    @abstractmethod
+    def add_batch_job(self, job: BatchJob) -> None:
+        """バッチのジョブを追加する"""
+
+    @abstractmethod
+    def mark_batch_submitted(self, job_ids: List[str], batch_id: str) -> None:
+        """ジョブを送信済みにする"""
+
+    @abstractmethod
+    def delete_batch_jobs(self, job_ids: List[str]) -> None:
+        """結果を届けたジョブを削除する"""
+
+    @abstractmethod
+    async def load_batch_jobs(self, owner: int = 0) -> List[BatchJob]:
+        """ownerが積んだ未完了のジョブを追加順に読み込む"""
+
+
+class MemoryStore(ConversationStore):
+    """永続化しないストア. 再起動すると消える"""
+
+    def __init__(self) -> None:
+        self.__usage: Dict[int, Dict[int, int]] = {}
+        self.__batch_jobs: Dict[str, BatchJob] = {}
+
+    async def load_system(self, guild_id: int) -> str | None:
+        return None
+
+    async def load_session(self, guild_id: int, channel_id: int) -> SessionState | None:
+        return None
+
+    def save_system(self, guild_id: int, text: str | None) -> None:
+        pass
+
+    def save_summary(self, guild_id: int, channel_id: int, text: str | None) -> None:
+        pass
+
+    def append_turn(self, guild_id: int, channel_id: int, message: dict) -> None:
+        pass
+
+    def delete_oldest_turns(self, guild_id: int, channel_id: int, count: int) -> None:
+        pass
+
+    def clear_turns(self, guild_id: int, channel_id: int) -> None:
+        pass
+
+    def add_usage(self, guild_id: int, user_id: int, tokens: int) -> None:
+        usage = self.__usage.setdefault(guild_id, {})
+        usage[user_id] = usage.get(user_id, 0) + tokens
+
+    async def ranking(self, guild_id: int, limit: int) -> List[Tuple[int, int]]:
+        return sorted(self.__usage.get(guild_id, {}).items(), key=lambda x: x[1], reverse=True)[:limit]
+
+    def add_batch_job(self, job: BatchJob) -> None:
+        self.__batch_jobs[job.job_id] = job
+
+    def mark_batch_submitted(self, job_ids: List[str], batch_id: str) -> None:
+        for job_id in job_ids:
+            self.__batch_jobs[job_id].batch_id = batch_id
+
+    def delete_batch_jobs(self, job_ids: List[str]) -> None:
+        for job_id in job_ids:
+            self.__batch_jobs.pop(job_id, None)
+
+    async def load_batch_jobs(self, owner: int = 0) -> List[BatchJob]:
+        return [job for job in self.__batch_jobs.values() if job.owner == owner]
+
+
+class SqliteStore(ConversationStore):
+    """SQLite(WALモード)による永続化
+
+    書き込みはメモリ上にためておき、flush_interval 秒ごとか batch_size 件たまった時点で
+    別スレッドから1トランザクションでまとめてコミットする. トークン使用量はユーザーごとに合算してから書き込む
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guild (
+            guild_id INTEGER PRIMARY KEY,
+            system_prompt TEXT
+        );
+        CREATE TABLE IF NOT EXISTS session (
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            summary TEXT,
+            last_active REAL,
+            PRIMARY KEY (guild_id, channel_id)
+        );
+        CREATE TABLE IF NOT EXISTS turn (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            message TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS token_usage (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            tokens INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS token_usage_rank ON token_usage (guild_id, tokens DESC);
+        CREATE TABLE IF NOT EXISTS batch_job (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL UNIQUE,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            body TEXT NOT NULL,
+            batch_id TEXT,
+            owner INTEGER NOT NULL DEFAULT 0
+        );
+    """
+    USAGE_SQL = (
+        "INSERT INTO token_usage (guild_id, user_id, tokens) VALUES (?, ?, ?) "
+        "ON CONFLICT(guild_id, user_id) DO UPDATE SET tokens = tokens + excluded.tokens"
+    )
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS turn_session ON turn (guild_id, channel_id, id);
+        CREATE INDEX IF NOT EXISTS batch_job_owner ON batch_job (owner, id);
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 1.0, batch_size: int = 100) -> None:
+        self.__logger = logging.getLogger("gpt")
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__batch_size = batch_size
+
+        self.__conn: sqlite3.Connection | None = None
+        # sqlite3の接続は複数スレッドから同時に使えないため排他する
+        self.__conn_lock = threading.Lock()
+        self.__flush_lock = asyncio.Lock()
+        self.__pending: List[Tuple[str, Tuple[Any, ...]]] = []
+        # (サーバーID, ユーザーID) -> 未書き込みのトークン数. 書き込み時に1件にまとめる
+        self.__usage: Dict[Tuple[int, int], int] = {}
+        self.__wakeup = asyncio.Event()
+        self.__task: asyncio.Task | None = None
+
+    async def open(self) -> None:
+        await asyncio.to_thread(self.__connect)
+        self.__task = asyncio.create_task(self.__flush_loop())
+
+    async def close(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        await self.flush()
+        if self.__conn is not None:
+            await asyncio.to_thread(self.__conn.close)
+            self.__conn = None
+
+    async def flush(self) -> None:
+        async with self.__flush_lock:
+            if len(self.__pending) == 0 and len(self.__usage) == 0:
+                return
+            pending, self.__pending = self.__pending, []
+            usage, self.__usage = self.__usage, {}
+            batch = pending + [(self.USAGE_SQL, (guild_id, user_id, tokens)) for (guild_id, user_id), tokens in usage.items()]
+            try:
+                await asyncio.to_thread(self.__write_batch, batch)
+            except Exception:
+                # ロールバックされるので次回に再試行する
+                self.__pending = pending + self.__pending
+                for (guild_id, user_id), tokens in usage.items():
+                    self.add_usage(guild_id, user_id, tokens)
+                raise
+
+    async def load_system(self, guild_id: int) -> str | None:
+        await self.flush()
+        rows = await asyncio.to_thread(self.__query, "SELECT system_prompt FROM guild WHERE guild_id = ?", (guild_id,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    async def load_session(self, guild_id: int, channel_id: int) -> SessionState | None:
+        await self.flush()
+        return await asyncio.to_thread(self.__read_session, guild_id, channel_id)
+
+    def save_system(self, guild_id: int, text: str | None) -> None:
+        self.__enqueue(
+            "INSERT INTO guild (guild_id, system_prompt) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET system_prompt = excluded.system_prompt",
+            (guild_id, text),
+        )
+
+    def save_summary(self, guild_id: int, channel_id: int, text: str | None) -> None:
+        self.__enqueue(
+            "INSERT INTO session (guild_id, channel_id, summary) VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id, channel_id) DO UPDATE SET summary = excluded.summary",
+            (guild_id, channel_id, text),
+        )
+
+    def append_turn(self, guild_id: int, channel_id: int, message: dict) -> None:
+        self.__enqueue(
+            "INSERT INTO turn (guild_id, channel_id, message) VALUES (?, ?, ?)", (guild_id, channel_id, json.dumps(message, ensure_ascii=False))
+        )
+        self.__enqueue(
+            "INSERT INTO session (guild_id, channel_id, last_active) VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id, channel_id) DO UPDATE SET last_active = excluded.last_active",
+            (guild_id, channel_id, time.time()),
+        )
+
+    def delete_oldest_turns(self, guild_id: int, channel_id: int, count: int) -> None:
+        self.__enqueue(
+            "DELETE FROM turn WHERE id IN (SELECT id FROM turn WHERE guild_id = ? AND channel_id = ? ORDER BY id LIMIT ?)",
+            (guild_id, channel_id, count),
+        )
+
+    def clear_turns(self, guild_id: int, channel_id: int) -> None:
+        self.__enqueue("DELETE FROM turn WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id))
+
+    def add_usage(self, guild_id: int, user_id: int, tokens: int) -> None:
+        key = (guild_id, user_id)
+        self.__usage[key] = self.__usage.get(key, 0) + tokens
+
+    async def ranking(self, guild_id: int, limit: int) -> List[Tuple[int, int]]:
+        await self.flush()
+        return await asyncio.to_thread(
+            self.__query, "SELECT user_id, tokens FROM token_usage WHERE guild_id = ? ORDER BY tokens DESC LIMIT ?", (guild_id, limit)
+        )
+
+    def add_batch_job(self, job: BatchJob) -> None:
+        self.__enqueue(
+            "INSERT INTO batch_job (job_id, guild_id, channel_id, author_id, body, batch_id, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job.job_id, job.guild_id, job.channel_id, job.author_id, json.dumps(job.body, ensure_ascii=False), job.batch_id, job.owner),
+        )
+
+    def mark_batch_submitted(self, job_ids: List[str], batch_id: str) -> None:
+        for job_id in job_ids:
+            self.__enqueue("UPDATE batch_job SET batch_id = ? WHERE job_id = ?", (batch_id, job_id))
+
+    def delete_batch_jobs(self, job_ids: List[str]) -> None:
+        for job_id in job_ids:
+            self.__enqueue("DELETE FROM batch_job WHERE job_id = ?", (job_id,))
+
+    async def load_batch_jobs(self, owner: int = 0) -> List[BatchJob]:
+        await self.flush()
+        rows = await asyncio.to_thread(
+            self.__query,
+            "SELECT job_id, guild_id, channel_id, author_id, body, batch_id FROM batch_job WHERE owner = ? ORDER BY id",
+            (owner,),
+        )
+        return [
+            BatchJob(job_id, guild_id, channel_id, author_id, json.loads(body), batch_id, owner)
+            for job_id, guild_id, channel_id, author_id, body, batch_id in rows
+        ]
+
+    def __enqueue(self, sql: str, params: Tuple[Any, ...]) -> None:
+        self.__pending.append((sql, params))
+        if len(self.__pending) >= self.__batch_size:
+            self.__wakeup.set()
+
+    async def __flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout=self.__flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.__logger.exception("store flush failed")
+
+    def __connect(self) -> None:
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        self.__conn = sqlite3.connect(str(self.__path), check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.executescript(self.SCHEMA)
+        self.__conn.executescript(self.INDEXES)
+        self.__conn.commit()
+
+    def __write_batch(self, batch: List[Tuple[str, Tuple[Any, ...]]]) -> None:
+        with self.__conn_lock, self.__conn:
+            for sql, params in batch:
+                self.__conn.execute(sql, params)
+
+    def __query(self, sql: str, params: Tuple[Any, ...]) -> list:
+        with self.__conn_lock:
+            return self.__conn.execute(sql, params).fetchall()
+
+    def __read_session(self, guild_id: int, channel_id: int) -> SessionState | None:
+        with self.__conn_lock:
+            row = self.__conn.execute(
+                "SELECT summary, last_active FROM session WHERE guild_id = ? AND channel_id = ?", (guild_id, channel_id)
+            ).fetchone()
+            turns = self.__conn.execute(
+                "SELECT message FROM turn WHERE guild_id = ? AND channel_id = ? ORDER BY id", (guild_id, channel_id)
+            ).fetchall()
+        if row is None and len(turns) == 0:
+            return None
+        summary, last_active = row if row is not None else (None, None)
+        return SessionState(summary=summary, turns=[json.loads(message) for (message,) in turns], last_active=last_active)
+
+
+def create_store(backend: str, path: Path, flush_interval: float, batch_size: int) -> ConversationStore:
+    """設定からストアを作成する
+
+    Args:
+        backend (str): "sqlite" または "memory"
+
+    Raises:
+        ValueError: 未対応のbackendの場合
+    """
+    if backend == "sqlite":
+        return SqliteStore(path, flush_interval, batch_size)
+    if backend == "memory":
+        return MemoryStore()
+    raise ValueError(f"unknown store backend: {backend}")
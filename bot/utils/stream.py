@@ -0,0 +1,98 @@
+import time
+from typing import Awaitable, Callable
+
+import discord
+
+# Discordの1メッセージあたりの最大文字数
+MESSAGE_LIMIT = 2000
+PLACEHOLDER = "…"
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """文字数制限に収まるようにテキストを分割する
+
+    なるべく改行位置で分割する
+
+    Args:
+        text (str): 分割するテキスト
+        limit (int): 1メッセージの最大文字数
+
+    Returns:
+        list[str]: 分割されたテキスト
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut < 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if len(text) > 0 or len(chunks) == 0:
+        chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """ストリーミング応答を逐次Discordのメッセージに反映する
+
+    editの呼び出しは edit_interval 秒に1回にまとめ、
+    文字数制限を超えた分は続きのメッセージとして送信する
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable[discord.Message]], edit_interval: float = 1.0) -> None:
+        self.__send = send
+        self.__edit_interval = edit_interval
+
+        self.__message: discord.Message | None = None
+        self.__current = ""
+        self.__pending = ""
+        self.__last_edit = 0.0
+
+    async def start(self) -> None:
+        """プレースホルダーのメッセージを送信する"""
+        self.__message = await self.__send(PLACEHOLDER)
+        self.__last_edit = time.monotonic()
+
+    async def feed(self, delta: str) -> None:
+        """受信した差分を追加する"""
+        self.__pending += delta
+        if time.monotonic() - self.__last_edit >= self.__edit_interval:
+            await self.__flush()
+
+    async def finish(self) -> None:
+        """残りの差分をすべて反映する"""
+        await self.__flush()
+        if len(self.__current.strip()) == 0:
+            await self.__message.edit(content="(空の応答)")
+
+    async def abort(self, text: str) -> None:
+        """エラー時にプレースホルダーを差し替える"""
+        if self.__message is None:
+            await self.__send(text)
+            return
+        if len(self.__current) == 0:
+            await self.__message.edit(content=text)
+        else:
+            await self.__send(text)
+
+    async def __flush(self) -> None:
+        text = self.__current + self.__pending
+        self.__pending = ""
+
+        # 文字数制限を超えた場合は続きのメッセージを送る
+        while len(text) > MESSAGE_LIMIT:
+            head, text = self.__split_head(text)
+            if head != self.__current:
+                await self.__message.edit(content=head)
+            self.__message = await self.__send(PLACEHOLDER)
+            self.__current = ""
+
+        if len(text.strip()) > 0 and text != self.__current:
+            await self.__message.edit(content=text)
+        self.__current = text
+        self.__last_edit = time.monotonic()
+
+    @staticmethod
+    def __split_head(text: str) -> tuple[str, str]:
+        head = split_message(text)[0]
+        return head, text[len(head) :].lstrip("\n")
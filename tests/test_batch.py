@@ -0,0 +1,59 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+pytest.importorskip("openai")
+
+from utils.batch import BatchRunner  # noqa: E402
+from utils.store import MemoryStore  # noqa: E402
+
+
+class FakeClient:
+    """batch_a は完了し、batch_b の取得は失敗する"""
+
+    def __init__(self) -> None:
+        self.batches = SimpleNamespace(retrieve=self.retrieve)
+        self.files = SimpleNamespace(content=self.content)
+        self.outputs: dict[str, list[str]] = {}
+
+    async def retrieve(self, batch_id: str):
+        if batch_id == "batch_b":
+            raise ConnectionError("stub")
+        return SimpleNamespace(status="completed", output_file_id=f"file_{batch_id}", error_file_id=None)
+
+    async def content(self, file_id: str):
+        return SimpleNamespace(text="\n".join(self.outputs[file_id.removeprefix("file_")]))
+
+
+def output_line(job_id: str, content: str) -> str:
+    body = {"choices": [{"message": {"content": content}}], "usage": {"prompt_tokens": 3, "completion_tokens": 2}}
+    return json.dumps({"custom_id": job_id, "response": {"status_code": 200, "body": body}})
+
+
+def test_poll_keeps_results_of_other_batches_when_one_fails():
+    async def run():
+        client = FakeClient()
+        store = MemoryStore()
+        runner = BatchRunner(client, store)
+        first = runner.submit(1, 10, 100, {"model": "m"})
+        second = runner.submit(1, 10, 100, {"model": "m"})
+        first.batch_id, second.batch_id = "batch_a", "batch_b"
+        client.outputs["batch_a"] = [output_line(first.job_id, "done")]
+
+        results = await runner.poll()
+        # 届けるまではジョブを残す
+        in_flight_before = runner.in_flight()
+        runner.complete(results)
+        return results, in_flight_before, runner.in_flight(), [job.job_id for job in await store.load_batch_jobs()], second.job_id
+
+    results, in_flight_before, in_flight_after, stored, second_id = asyncio.run(run())
+    assert [(result.content, result.prompt_tokens) for result in results] == [("done", 3)]
+    assert in_flight_before == ["batch_a", "batch_b"]
+    assert in_flight_after == ["batch_b"]
+    assert stored == [second_id]
@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.cache import ResponseCache  # noqa: E402
+
+SYSTEM = {"role": "system", "content": "system prompt"}
+
+
+def key(cache: ResponseCache, *contents: str) -> str:
+    return cache.make_key("chat", "model", 1.0, [SYSTEM] + [{"role": "user", "content": content} for content in contents])
+
+
+def test_context_window_limits_turns_in_key():
+    cache = ResponseCache(16, 2)
+    assert key(cache, "a", "b", "c") == key(cache, "x", "b", "c")
+    assert key(cache, "a", "b", "c") != key(cache, "a", "x", "c")
+
+
+def test_zero_context_window_still_keys_on_latest_input():
+    cache = ResponseCache(16, 0)
+    # 入力が違えば別のキー. 以前の会話は含めない
+    assert key(cache, "a", "b") != key(cache, "a", "c")
+    assert key(cache, "a", "b") == key(cache, "x", "b")
+    assert key(cache, "hello  world") == key(cache, "hello world")
@@ -0,0 +1,41 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.coalesce import MentionCoalescer  # noqa: E402
+
+
+def test_single_mention_is_dispatched_without_waiting():
+    async def run():
+        dispatched = []
+
+        async def handler(key, items):
+            dispatched.append(time.monotonic())
+
+        coalescer = MentionCoalescer(0.8, handler)
+        start = time.monotonic()
+        await coalescer.submit((1, 1), "a", "a")
+        return dispatched[0] - start
+
+    assert asyncio.run(run()) < 0.1
+
+
+def test_mentions_during_a_request_are_coalesced():
+    async def run():
+        batches = []
+
+        async def handler(key, items):
+            batches.append(items)
+            await asyncio.sleep(0.05)
+
+        coalescer = MentionCoalescer(0.1, handler)
+        first = coalescer.submit((1, 1), "a", "a")
+        await asyncio.sleep(0.01)
+        rest = [coalescer.submit((1, 1), item, item) for item in ("b", "c")]
+        await asyncio.gather(first, *rest)
+        return batches, coalescer.batches
+
+    assert asyncio.run(run()) == ([["a"], ["b", "c"]], 2)
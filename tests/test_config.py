@@ -0,0 +1,29 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.config import ConfigService  # noqa: E402
+
+
+def test_rejected_update_keeps_current_config():
+    applied = []
+
+    def restart_only(current, config):
+        if current["store"] != config["store"]:
+            raise ValueError("store cannot be changed without a restart")
+
+    service = ConfigService({"store": "a", "model": "x"})
+    service.add_validator(restart_only)
+    service.subscribe(applied.append)
+
+    with pytest.raises(ValueError):
+        service.update({"store": "b", "model": "y"})
+    assert service.current == {"store": "a", "model": "x"}
+    assert applied == []
+
+    service.update({"store": "a", "model": "y"})
+    assert service.current == {"store": "a", "model": "y"}
+    assert applied == [{"store": "a", "model": "y"}]
@@ -0,0 +1,31 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+pytest.importorskip("tiktoken")
+
+from utils.history import PromptView, Turn, to_payload  # noqa: E402
+
+
+def test_prompt_view_payload_is_json_serializable():
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA", "detail": "low"}}
+    view = PromptView(
+        (Turn("system", "system prompt", 5),),
+        (Turn("user", "hello", 4), Turn("user", [{"type": "text", "text": "look"}, image], 90)),
+    ).with_tail([{"role": "user", "content": [image]}])
+
+    payload = to_payload(view)
+
+    assert json.loads(json.dumps(payload)) == [
+        {"role": "system", "content": "system prompt"},
+        {"role": "user", "content": "hello"},
+        {"role": "user", "content": [{"type": "text", "text": "look"}, image]},
+        {"role": "user", "content": [image]},
+    ]
+    assert all(type(message) is dict for message in payload)
+    with pytest.raises(TypeError):
+        json.dumps(list(view))
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("PIL")
+
+from utils.image import ImageIngestor, is_public_address  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "address",
+    ["127.0.0.1", "10.0.0.1", "172.16.0.1", "192.168.1.1", "169.254.169.254", "0.0.0.0", "224.0.0.1", "::1", "fe80::1%eth0", "::ffff:127.0.0.1"],
+)
+def test_internal_addresses_are_not_public(address):
+    assert is_public_address(address) is False
+
+
+def test_internet_address_is_public():
+    assert is_public_address("162.159.128.233") is True
+
+
+def test_only_cdn_hosts_are_fetched(tmp_path):
+    images = ImageIngestor(tmp_path, 1, 1, 1, 1024)
+
+    assert images.is_fetchable("https://cdn.discordapp.com/attachments/1/2/a.png?ex=1") is True
+    assert images.is_fetchable("https://example.com/a.png") is False
+    for url in ("file:///etc/passwd", "http://169.254.169.254/latest/meta-data/a.png", "http://[::1]/a.png"):
+        with pytest.raises(ValueError):
+            images.is_fetchable(url)
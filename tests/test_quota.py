@@ -0,0 +1,99 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.quota import Admission, QuotaController  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def controller(clock: FakeClock, downgrade: bool = False, guild_capacity: float = 1000, guild_rate: float = 100) -> QuotaController:
+    # ユーザーは 100 トークンまで毎秒 10 回復
+    return QuotaController(100, 10, guild_capacity, guild_rate, downgrade, clock=clock)
+
+
+def test_rejects_until_bucket_refills():
+    clock = FakeClock()
+    quota = controller(clock)
+
+    assert quota.admit(1, 10, 80).admission is Admission.ACCEPT
+    decision = quota.admit(1, 10, 50)
+    assert decision.admission is Admission.REJECT
+    assert decision.scope == "user"
+    assert decision.retry_after == pytest.approx(3.0)
+    assert quota.rejected == 1
+
+    clock.now += 2.9
+    assert quota.admit(1, 10, 50).admission is Admission.REJECT
+    clock.now += 0.1
+    assert quota.admit(1, 10, 50).admission is Admission.ACCEPT
+    assert quota.remaining(1, 10)[0] == pytest.approx(0.0)
+
+
+def test_refill_is_capped_at_capacity():
+    clock = FakeClock()
+    quota = controller(clock)
+
+    quota.admit(1, 10, 100)
+    clock.now += 3600
+    assert quota.remaining(1, 10) == (pytest.approx(100.0), pytest.approx(1000.0))
+
+
+def test_guild_bucket_is_shared_between_users():
+    clock = FakeClock()
+    quota = controller(clock, guild_capacity=150, guild_rate=1)
+
+    assert quota.admit(1, 10, 100).admission is Admission.ACCEPT
+    decision = quota.admit(1, 20, 100)
+    assert decision.admission is Admission.REJECT
+    assert decision.scope == "guild"
+    assert decision.retry_after == pytest.approx(50.0)
+    # 別のサーバーには影響しない
+    assert quota.admit(2, 20, 100).admission is Admission.ACCEPT
+
+
+def test_downgrade_instead_of_reject():
+    clock = FakeClock()
+    quota = controller(clock, downgrade=True)
+
+    quota.admit(1, 10, 100)
+    decision = quota.admit(1, 10, 30)
+    assert decision.admission is Admission.DOWNGRADE
+    assert decision.reserved == 30
+    assert quota.downgraded == 1
+    assert quota.rejected == 0
+
+
+def test_oversized_request_passes_on_full_bucket():
+    clock = FakeClock()
+    quota = controller(clock)
+
+    assert quota.admit(1, 10, 500).admission is Admission.ACCEPT
+    # 超過分は負の残高として回復を待つ
+    assert quota.remaining(1, 10)[0] == pytest.approx(-400.0)
+    clock.now += 40
+    assert quota.admit(1, 10, 1).admission is Admission.REJECT
+    clock.now += 1
+    assert quota.admit(1, 10, 1).admission is Admission.ACCEPT
+
+
+def test_settle_refunds_unused_reservation():
+    clock = FakeClock()
+    quota = controller(clock)
+
+    decision = quota.admit(1, 10, 80)
+    quota.settle(1, 10, decision, 20)
+    assert quota.remaining(1, 10) == (pytest.approx(80.0), pytest.approx(980.0))
+
+    decision = quota.admit(1, 10, 50)
+    quota.settle(1, 10, decision, 0)
+    assert quota.remaining(1, 10) == (pytest.approx(80.0), pytest.approx(980.0))
@@ -0,0 +1,183 @@
+import asyncio
+import email.utils
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+openai = pytest.importorskip("openai")
+httpx = pytest.importorskip("httpx")
+
+from utils import resilience  # noqa: E402
+from utils.resilience import CircuitBreaker, ResilientExecutor, RetryPolicy, retry_after  # noqa: E402
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(cls, status: int, headers: dict[str, str] | None = None):
+    return cls("stub", response=httpx.Response(status, headers=headers, request=REQUEST), body=None)
+
+
+def executor(**policy) -> ResilientExecutor:
+    # base_delay=0 でバックオフを待たない
+    return ResilientExecutor(RetryPolicy(**{"base_delay": 0.0, **policy}), breaker_threshold=5, breaker_reset=30.0)
+
+
+def test_no_retry_after_emit():
+    calls = []
+
+    async def call(model, attempt):
+        calls.append(model)
+        attempt.emit()
+        raise openai.APIConnectionError(request=REQUEST)
+
+    runner = executor(max_attempts=3)
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(runner.run(["a", "b"], call))
+    assert calls == ["a"]
+    assert runner.retries == 0
+
+
+def test_retries_transient_errors_on_the_same_model():
+    calls = []
+
+    async def call(model, attempt):
+        calls.append(model)
+        if len(calls) < 3:
+            raise status_error(openai.InternalServerError, 503)
+        return "ok"
+
+    runner = executor(max_attempts=3)
+    assert asyncio.run(runner.run(["a", "b"], call)) == "ok"
+    assert calls == ["a", "a", "a"]
+    assert runner.retries == 2
+    assert runner.fallbacks == 0
+
+
+def test_not_found_falls_back_to_next_model():
+    calls = []
+
+    async def call(model, attempt):
+        calls.append(model)
+        if model == "a":
+            raise status_error(openai.NotFoundError, 404)
+        return model
+
+    runner = executor(max_attempts=3)
+    assert asyncio.run(runner.run(["a", "b"], call)) == "b"
+    assert calls == ["a", "b"]
+    assert runner.fallbacks == 1
+    # 存在しないモデルは障害として数えない
+    assert runner.states() == {"a": "closed", "b": "closed"}
+
+
+def test_not_found_on_last_model_is_raised():
+    async def call(model, attempt):
+        raise status_error(openai.NotFoundError, 404)
+
+    with pytest.raises(openai.NotFoundError):
+        asyncio.run(executor().run(["a"], call))
+
+
+def test_half_open_allows_a_single_probe(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30.0)
+
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.allow() is False
+
+    now[0] += 30.0
+    assert breaker.state == "half_open"
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+
+    # 試行が失敗したら閾値に関係なく開き直す
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    now[0] += 30.0
+    assert breaker.allow() is True
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() is True
+
+
+def test_half_open_probe_released_without_result(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0)
+
+    breaker.record_failure()
+    now[0] += 10.0
+    assert breaker.allow() is True
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow() is True
+
+
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [
+        ({"retry-after-ms": "1500"}, 1.5),
+        ({"retry-after-ms": "250", "retry-after": "9"}, 0.25),
+        ({"retry-after-ms": "soon", "retry-after": "2"}, 2.0),
+        ({"retry-after": "3"}, 3.0),
+        ({"retry-after": "soon"}, None),
+        ({}, None),
+    ],
+)
+def test_retry_after_parses_headers(headers, expected):
+    error = SimpleNamespace(response=SimpleNamespace(headers=headers))
+    assert retry_after(error) == expected
+
+
+def test_retry_after_parses_http_date():
+    value = email.utils.formatdate(time.time() + 60, usegmt=True)
+    error = SimpleNamespace(response=SimpleNamespace(headers={"retry-after": value}))
+    assert 55 <= retry_after(error) <= 60
+
+    past = email.utils.formatdate(time.time() - 60, usegmt=True)
+    error = SimpleNamespace(response=SimpleNamespace(headers={"retry-after": past}))
+    assert retry_after(error) == 0.0
+
+
+def test_retry_after_without_response():
+    assert retry_after(TimeoutError()) is None
+
+
+def test_total_timeout_stops_waiting_for_retry_after():
+    calls = []
+
+    async def call(model, attempt):
+        calls.append(model)
+        raise status_error(openai.RateLimitError, 429, {"retry-after-ms": "2000"})
+
+    # 待機が全体の期限を超えるので再試行せず次のモデルへ
+    runner = executor(max_attempts=5, total_timeout=1.0, max_delay=8.0)
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(runner.run(["a", "b"], call))
+    assert calls == ["a", "b"]
+    assert runner.retries == 0
+
+
+def test_total_timeout_bounds_a_hanging_attempt():
+    calls = []
+
+    async def call(model, attempt):
+        calls.append(model)
+        await asyncio.sleep(60)
+
+    runner = executor(max_attempts=5, attempt_timeout=60.0, total_timeout=0.1)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(runner.run(["a", "b"], call))
+    assert time.monotonic() - started < 5
+    assert calls == ["a"]
@@ -0,0 +1,65 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.scheduler import RequestScheduler  # noqa: E402
+
+
+def test_round_robin_across_guilds():
+    async def run():
+        scheduler = RequestScheduler(1, 1)
+        order = []
+        release = asyncio.Event()
+
+        async def request(guild_id: int, name: str, hold: asyncio.Event | None = None) -> None:
+            async with scheduler.slot(guild_id):
+                order.append(name)
+                if hold is not None:
+                    await hold.wait()
+
+        tasks = [asyncio.create_task(request(1, "a0", release))]
+        await asyncio.sleep(0)
+        # 1つのサーバーが先にまとめて積んでも他のサーバーを待たせない
+        for guild_id, name in ((1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (2, "b2"), (3, "c1")):
+            tasks.append(asyncio.create_task(request(guild_id, name)))
+            await asyncio.sleep(0)
+        depth = scheduler.queue_depth(), scheduler.queue_depth(1)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return order, depth, scheduler.stats()
+
+    order, depth, stats = asyncio.run(run())
+    assert order == ["a0", "a1", "b1", "c1", "a2", "b2", "a3"]
+    assert depth == (6, 3)
+    assert stats.in_flight == 0
+    assert stats.queue_depth == 0
+
+
+def test_per_guild_limit_leaves_slots_for_other_guilds():
+    async def run():
+        scheduler = RequestScheduler(4, 2)
+        release = asyncio.Event()
+        started = []
+
+        async def request(guild_id: int) -> None:
+            async with scheduler.slot(guild_id):
+                started.append(guild_id)
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(guild_id)) for guild_id in (1, 1, 1, 1, 2)]
+        for _ in range(3):
+            await asyncio.sleep(0)
+        snapshot = sorted(started), scheduler.stats().in_flight, scheduler.queue_depth(1)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return snapshot, started
+
+    (running, in_flight, waiting), started = asyncio.run(run())
+    assert running == [1, 1, 2]
+    assert in_flight == 3
+    assert waiting == 2
+    assert sorted(started) == [1, 1, 1, 1, 2]
@@ -0,0 +1,43 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from utils.store import BatchJob, create_store  # noqa: E402
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_load_batch_jobs_filters_by_owner(tmp_path, backend):
+    async def run():
+        store = create_store(backend, tmp_path / "bot.db", 1.0, 100)
+        await store.open()
+        store.add_batch_job(BatchJob("a", 1, 10, 100, {"n": 0}, owner=0))
+        store.add_batch_job(BatchJob("b", 2, 20, 200, {"n": 1}, owner=1))
+        store.add_batch_job(BatchJob("c", 3, 30, 300, {"n": 2}, owner=1))
+        owned = {owner: [job.job_id for job in await store.load_batch_jobs(owner)] for owner in (0, 1, 2)}
+        await store.close()
+        return owned
+
+    assert asyncio.run(run()) == {0: ["a"], 1: ["b", "c"], 2: []}
+
+
+
+def test_session_records_last_activity(tmp_path):
+    async def run():
+        store = create_store("sqlite", tmp_path / "bot.db", 1.0, 100)
+        await store.open()
+        before = time.time()
+        store.append_turn(1, 10, {"role": "user", "content": "hello"})
+        store.save_summary(1, 10, "summary")
+        state = await store.load_session(1, 10)
+        await store.close()
+        return before, state
+
+    before, state = asyncio.run(run())
+    assert state.summary == "summary"
+    assert state.turns == [{"role": "user", "content": "hello"}]
+    assert before <= state.last_active <= time.time()